@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+Offline backtest of the classifier.
+
+Stored `delete_msg` events (from Mongo or an exported JSONL file) and
+optionally a corpus of kept messages are classified again with the
+current rules, whitelist and USERNAME_EXCEPTIONS, and verdicts which
+differ from the stored ones are reported by reason and by chat.
+
+Nothing is sent to Telegram or t.me: usernames are resolved from `user`
+collection only, the unknown ones are treated as users. Events are read
+with a streaming cursor and classified in chunks by a process pool with
+a bounded number of chunks in flight, so memory does not depend on the
+number of events. Compacted events (see retention.py) have no text and
+are not read.
+"""
+import json
+import logging
+import multiprocessing
+import time
+from argparse import ArgumentParser
+from collections import Counter, deque
+from datetime import datetime, timedelta
+from itertools import islice
+
+from bson import json_util
+from pymongo import MongoClient
+from telebot.types import Message
+
+from classify import Classifier, CLASSIFY_SETTINGS
+from groupconfig import GroupConfigStore
+from resolver import UserTypeResolver
+from stats import get_chat_label
+
+KEEP_LABEL = 'keep'
+ERROR_LABEL = 'error'
+UPDATE_MESSAGE_FIELDS = ('message', 'edited_message', 'channel_post')
+_worker = None
+
+
+def connect(uri, name):
+    return MongoClient(uri)[name]
+
+
+def get_legacy_origin(data):
+    """
+    Return `forward_origin` for event saved before it existed in Bot API,
+    with `forward_from`, `forward_from_chat` or `forward_sender_name`.
+    """
+    date = data.get('forward_date') or 0
+    if data.get('forward_from_chat'):
+        chat = data['forward_from_chat']
+        if chat.get('type') == 'channel':
+            return {
+                'type': 'channel', 'date': date, 'chat': chat,
+                'message_id': data.get('forward_from_message_id') or 0,
+            }
+        return {'type': 'chat', 'date': date, 'sender_chat': chat}
+    if data.get('forward_from'):
+        return {'type': 'user', 'date': date, 'sender_user': data['forward_from']}
+    if data.get('forward_sender_name'):
+        return {'type': 'hidden_user', 'date': date, 'sender_user_name': data['forward_sender_name']}
+    return None
+
+
+def load_message(data):
+    """
+    Build Message from an event (compact or full form, see serialize.py,
+    or all attributes of the message as saved by old versions) or a Bot
+    API message or update.
+    """
+    if 'update_id' in data:
+        for field in UPDATE_MESSAGE_FIELDS:
+            if field in data:
+                data = data[field]
+                break
+    if isinstance(data.get('json'), dict):
+        # Old events keep the message as received in "json" field
+        data = data['json']
+    data = dict(data)
+    if 'from_user' in data:
+        # Compact form keeps library attribute names
+        data['from'] = data.pop('from_user')
+    if 'forward_origin' not in data:
+        origin = get_legacy_origin(data)
+        if origin:
+            data['forward_origin'] = origin
+    data.setdefault('date', 0)
+    return Message.de_json(data)
+
+
+class BacktestWorker(object):
+    """
+    Classifies chunks of (stored reason, event) items, stored reason is
+    None for kept messages. Group settings and username types are read
+    from `db`.
+    """
+
+    def __init__(self, db):
+        from graphenebot import LINKS_EXCEPTIONS, USERNAME_EXCEPTIONS
+
+        self.classifier = Classifier(LINKS_EXCEPTIONS, USERNAME_EXCEPTIONS)
+        self.resolver = UserTypeResolver(db, fetch=None)
+        self.group_config = GroupConfigStore(db, watch=False)
+
+    def classify(self, msg):
+        group = self.group_config.get(msg.chat.id)
+        verdict = self.classifier.classify(
+            msg, group.get_many(CLASSIFY_SETTINGS), self.resolver.get_types,
+            group.allowed_domains,
+        )
+        return verdict.reason if verdict.action == 'delete' else None
+
+    def run_chunk(self, items):
+        result = BacktestResult()
+        unknown = self.resolver.counters['db_miss']
+        for reason, data in items:
+            chat = None
+            try:
+                msg = load_message(data)
+                chat = msg.chat
+                new_reason = self.classify(msg)
+            except Exception:
+                logging.exception('Failed to classify event')
+                new_label = ERROR_LABEL
+            else:
+                new_label = new_reason or KEEP_LABEL
+            result.add(chat, reason or KEEP_LABEL, new_label)
+        result.unknown_usernames = self.resolver.counters['db_miss'] - unknown
+        return result
+
+
+class BacktestResult(object):
+    """
+    Verdict counters, merged from the results of all chunks.
+    """
+
+    def __init__(self):
+        self.total = 0
+        self.elapsed = 0
+        self.unknown_usernames = 0
+        # (stored verdict, new verdict) -> number of messages
+        self.transitions = Counter()
+        self.chat_totals = Counter()
+        self.chat_changes = Counter()
+        self.chat_labels = {}
+
+    def add(self, chat, old, new):
+        chat_id = chat.id if chat else None
+        self.total += 1
+        self.transitions[(old, new)] += 1
+        self.chat_totals[chat_id] += 1
+        if old != new:
+            self.chat_changes[chat_id] += 1
+            if chat_id not in self.chat_labels and chat_id is not None:
+                self.chat_labels[chat_id] = get_chat_label(chat_id, chat.username)
+
+    def merge(self, other):
+        self.total += other.total
+        self.unknown_usernames += other.unknown_usernames
+        self.transitions.update(other.transitions)
+        self.chat_totals.update(other.chat_totals)
+        self.chat_changes.update(other.chat_changes)
+        for chat_id, label in other.chat_labels.items():
+            self.chat_labels.setdefault(chat_id, label)
+
+    @property
+    def changed(self):
+        return sum(num for (old, new), num in self.transitions.items() if old != new)
+
+
+def init_worker(db_factory, db_args):
+    global _worker
+    _worker = BacktestWorker(db_factory(*db_args))
+
+
+def run_worker_chunk(items):
+    return _worker.run_chunk(items)
+
+
+def iter_chunks(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_backtest(items, db_factory, db_args=(), processes=2, chunk_size=1000,
+                 progress_interval=10):
+    """
+    Classify (stored reason, event) `items` and return BacktestResult.
+    With `processes` = 0 chunks are classified in this process.
+    """
+    result = BacktestResult()
+    started = last_progress = time.monotonic()
+
+    def collect(chunk_result):
+        nonlocal last_progress
+        result.merge(chunk_result)
+        now = time.monotonic()
+        if progress_interval and now - last_progress >= progress_interval:
+            logging.info('Backtested %d events, %.0f/s' % (
+                result.total, result.total / (now - started),
+            ))
+            last_progress = now
+
+    if not processes:
+        worker = BacktestWorker(db_factory(*db_args))
+        for chunk in iter_chunks(items, chunk_size):
+            collect(worker.run_chunk(chunk))
+    else:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes, initializer=init_worker,
+                      initargs=(db_factory, db_args)) as pool:
+            # Pool.imap reads the whole input ahead, chunks are submitted
+            # only when there is room for them
+            inflight = deque()
+            for chunk in iter_chunks(items, chunk_size):
+                if len(inflight) >= processes * 2:
+                    collect(inflight.popleft().get())
+                inflight.append(pool.apply_async(run_worker_chunk, (chunk,)))
+            while inflight:
+                collect(inflight.popleft().get())
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+def iter_db_events(db, since=None, batch_size=1000):
+    query = {'type': 'delete_msg', 'compact': {'$exists': False}}
+    if since:
+        query['date'] = {'$gte': since}
+    cursor = db.event.find(query, {'_id': 0}, batch_size=batch_size)
+    for event in cursor:
+        yield event.get('reason'), event
+
+
+def iter_file(path, kept=False):
+    """
+    Read JSONL file exported with mongoexport (or written by hand). With
+    `kept` every item is a message (or update) which was not deleted.
+    """
+    with open(path) as inp:
+        for line in inp:
+            if not line.strip():
+                continue
+            data = json_util.loads(line)
+            if kept:
+                yield None, data
+            elif data.get('type') == 'delete_msg' and not data.get('compact'):
+                yield data.get('reason'), data
+
+
+def format_report(result, top_chats=20):
+    lines = ['%d messages, %d changed, %.1fs, %.0f messages/s' % (
+        result.total, result.changed, result.elapsed,
+        result.total / result.elapsed if result.elapsed else 0,
+    )]
+    if result.unknown_usernames:
+        lines.append('%d usernames not found in user collection' % result.unknown_usernames)
+    lines.append('')
+    lines.append('By stored verdict:')
+    by_old = {}
+    for (old, new), num in result.transitions.items():
+        by_old.setdefault(old, Counter())[new] += num
+    for old, news in sorted(by_old.items(), key=lambda x: -sum(x[1].values())):
+        total = sum(news.values())
+        lines.append('  %-28s %8d, unchanged %d' % (old, total, news[old]))
+        for new, num in news.most_common():
+            if new != old:
+                lines.append('    -> %-24s %8d' % (new, num))
+    if result.chat_changes:
+        lines.append('')
+        lines.append('Chats with most changes:')
+        for chat_id, num in result.chat_changes.most_common(top_chats):
+            lines.append('  %-28s %8d of %d' % (
+                result.chat_labels.get(chat_id, chat_id), num, result.chat_totals[chat_id],
+            ))
+    return lines
+
+
+def main():
+    parser = ArgumentParser(description='Classify stored events again with current rules')
+    parser.add_argument('--events', help='JSONL file with exported events, '
+                        'events collection is read by default')
+    parser.add_argument('--kept', help='JSONL file with messages which were not deleted')
+    parser.add_argument('--days', type=int, help='only events of last days')
+    parser.add_argument('--mongo-uri', default='mongodb://localhost')
+    parser.add_argument('--db-name', default='graphene')
+    parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--top-chats', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help='print counters as JSON')
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    since = datetime.utcnow() - timedelta(days=opts.days) if opts.days else None
+    db_args = (opts.mongo_uri, opts.db_name)
+
+    def iter_items():
+        if opts.events:
+            for reason, data in iter_file(opts.events):
+                if since is None or data.get('date', since) >= since:
+                    yield reason, data
+        else:
+            yield from iter_db_events(connect(*db_args), since)
+        if opts.kept:
+            yield from iter_file(opts.kept, kept=True)
+
+    result = run_backtest(
+        iter_items(), connect, db_args, processes=opts.processes, chunk_size=opts.chunk_size,
+    )
+    if opts.json:
+        print(json.dumps({
+            'total': result.total,
+            'changed': result.changed,
+            'elapsed': result.elapsed,
+            'transitions': [[old, new, num] for (old, new), num in result.transitions.items()],
+            'chats': dict((str(x), y) for x, y in result.chat_changes.items()),
+        }, indent=2))
+    else:
+        for line in format_report(result, opts.top_chats):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+"""
+Replay benchmark of the message pipeline.
+
+Synthetic (or recorded, see --corpus) updates are passed through handlers
+built by `create_bot` running against local fake Bot API, fake t.me and
+in-memory Mongo stand-in. For each scenario messages/sec, handling latency
+and number of API calls per message are reported and saved to JSON file,
+use --compare to see changes against previous run.
+"""
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import time
+from argparse import ArgumentParser
+from datetime import datetime
+
+from telebot import apihelper
+from telebot.types import Update
+
+from fakes import FakeBotApi, FakeTme, FakeDatabase
+from graphenebot import create_bot, shutdown
+
+CHATS = 20
+USERS = 500
+LOG_CHANNEL_ID = -1009999
+# Share of `count` used as number of distinct usernames/domains, so that
+# caches see both misses and repeats
+DISTINCT_RATIO = 0.2
+REGRESSION_THRESHOLD = 0.1
+
+
+def make_message(idx, text=None, **fields):
+    chat_id = -1000000 - idx % CHATS
+    user_id = 10000 + idx % USERS
+    ret = {
+        'message_id': idx + 1,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'supergroup', 'username': 'group%d' % (idx % CHATS)},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User%d' % user_id},
+    }
+    if text is not None:
+        ret['text'] = text
+    ret.update(fields)
+    return ret
+
+
+def entity(text, part, type_):
+    return {'type': type_, 'offset': text.index(part), 'length': len(part)}
+
+
+def distinct(idx, count):
+    return idx % max(1, int(count * DISTINCT_RATIO))
+
+
+def gen_clean_text(idx, count):
+    return {'message': make_message(idx, 'Hello everyone, message number %d' % idx)}
+
+
+def gen_url_entities(idx, count):
+    if idx % 2:
+        url = 'https://en.wikipedia.org/wiki/Page%d' % idx
+    else:
+        url = 'http://spam%d.com/offer' % distinct(idx, count)
+    text = 'Look at %s' % url
+    return {'message': make_message(idx, text, entities=[entity(text, url, 'url')])}
+
+
+def gen_mentions(idx, count):
+    name = ('channel', 'group', 'user', 'unknown')[idx % 4]
+    mention = '@%s_%d' % (name, distinct(idx, count))
+    text = 'Subscribe %s' % mention
+    return {'message': make_message(idx, text, entities=[entity(text, mention, 'mention')])}
+
+
+def gen_forwards(idx, count):
+    return {'message': make_message(
+        idx, 'Forwarded news %d' % idx,
+        forward_origin={
+            'type': 'channel', 'date': int(time.time()), 'message_id': idx,
+            'chat': {'id': -1005000 - distinct(idx, count), 'type': 'channel', 'title': 'News'},
+        },
+    )}
+
+
+def gen_captioned_media(idx, count):
+    if idx % 3 == 0:
+        caption = 'Nice photo'
+    elif idx % 3 == 1:
+        caption = 'Join @channel_%d' % distinct(idx, count)
+    else:
+        caption = 'Visit promo%d.io today' % distinct(idx, count)
+    return {'message': make_message(idx, caption=caption, photo=[{
+        'file_id': 'photo%d' % idx, 'file_unique_id': 'u%d' % idx,
+        'width': 100, 'height': 100,
+    }])}
+
+
+def gen_join_wave(idx, count):
+    members = [
+        {'id': 500000 + idx * 5 + x, 'is_bot': x % 2 == 0, 'first_name': 'Joiner'}
+        for x in range(5)
+    ]
+    return {'message': make_message(
+        idx, new_chat_members=members, new_chat_member=members[0],
+        new_chat_participant=members[0],
+    )}
+
+
+def gen_join_raid(idx, count):
+    # Mass join to one chat, one member per join message as with real raids
+    member = {'id': 600000 + idx, 'is_bot': idx % 3 != 0, 'first_name': 'Raider'}
+    msg = make_message(
+        idx, new_chat_members=[member], new_chat_member=member,
+        new_chat_participant=member,
+    )
+    msg['chat'] = {'id': -1000000, 'type': 'supergroup', 'username': 'group0'}
+    msg['from'] = member
+    return {'message': msg}
+
+
+def gen_edited(idx, count):
+    update = gen_url_entities(idx, count)
+    update['message']['edit_date'] = int(time.time())
+    return {'edited_message': update['message']}
+
+
+def gen_raid(idx, count):
+    # The same few spam texts posted to all chats, spacing varies
+    mention = '@channel_raid%d' % (idx % 3)
+    text = 'Free tokens!%sJoin %s' % (' ' * (1 + idx % 2), mention)
+    return {'message': make_message(idx, text, entities=[entity(text, mention, 'mention')])}
+
+
+SCENARIOS = {
+    'clean_text': gen_clean_text,
+    'url_entities': gen_url_entities,
+    'mentions': gen_mentions,
+    'forwards': gen_forwards,
+    'captioned_media': gen_captioned_media,
+    'join_wave': gen_join_wave,
+    'join_raid': gen_join_raid,
+    'edited': gen_edited,
+    'raid': gen_raid,
+}
+
+
+def build_updates(name, count):
+    ret = []
+    for idx in range(count):
+        update = SCENARIOS[name](idx, count)
+        update['update_id'] = idx + 1
+        ret.append(update)
+    return ret
+
+
+def load_corpus(path):
+    ret = []
+    with open(path) as inp:
+        for line in inp:
+            if line.strip():
+                ret.append(json.loads(line))
+    return ret
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round((len(values) - 1) * share)))]
+
+
+def make_database():
+    db = FakeDatabase()
+    # Half of the groups log deleted messages to a channel
+    for idx in range(0, CHATS, 2):
+        db.config.insert_one({
+            'group_id': -1000000 - idx, 'key': 'log_channel_id', 'value': LOG_CHANNEL_ID,
+        })
+    return db
+
+
+def run_scenario(updates, api, tme, config):
+    db = make_database()
+    startup_started = time.perf_counter()
+    bot = create_bot('123456:BENCH', db, config)
+    startup = time.perf_counter() - startup_started
+    updates = [Update.de_json(json.dumps(x)) for x in updates]
+    api_calls = api.calls.copy()
+    tme_calls = tme.total_calls()
+    latencies = []
+
+    dispatcher = getattr(bot, 'dispatcher', None)
+    if dispatcher:
+        queued = {}
+        handler = dispatcher.handler
+
+        def timed_handler(update):
+            handler(update)
+            latencies.append(time.perf_counter() - queued[update.update_id])
+
+        dispatcher.handler = timed_handler
+
+    started = time.perf_counter()
+    for update in updates:
+        if dispatcher:
+            queued[update.update_id] = time.perf_counter()
+            bot.process_new_updates([update])
+        else:
+            handling_started = time.perf_counter()
+            bot.process_new_updates([update])
+            latencies.append(time.perf_counter() - handling_started)
+    if dispatcher:
+        dispatcher.join()
+    # Deletions are sent in background
+    bot.transport.join()
+    elapsed = time.perf_counter() - started
+    # Wait for background delivery, so its API calls are counted too
+    shutdown(bot)
+
+    calls = api.calls.copy()
+    calls.subtract(api_calls)
+    calls = dict((key, val) for key, val in calls.items() if val)
+    count = len(updates)
+    return {
+        'count': count,
+        'elapsed': elapsed,
+        'msgs_per_sec': count / elapsed if elapsed else 0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'startup_ms': startup * 1000,
+        'api_calls_per_msg': sum(calls.values()) / count,
+        'api_calls': calls,
+        'tme_fetches_per_msg': (tme.total_calls() - tme_calls) / count,
+        'db_ops_per_msg': sum(db.operation_counts().values()) / count,
+    }
+
+
+def get_version():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """
+    Return list of lines describing changes against previous results.
+    """
+    ret = []
+    for name, res in sorted(results['scenarios'].items()):
+        prev = previous.get('scenarios', {}).get(name)
+        if not prev:
+            continue
+        if prev['count'] != res['count']:
+            ret.append('%-16s update count differs: %d -> %d' % (
+                name, prev['count'], res['count'],
+            ))
+        # (metric, True if bigger is better)
+        for metric, higher_better in (
+                ('msgs_per_sec', True),
+                ('p99_ms', False),
+                ('api_calls_per_msg', False),
+                ('startup_ms', False),
+            ):
+            old, new = prev.get(metric), res.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            regression = -change if higher_better else change
+            ret.append('%-16s %-18s %10.2f -> %10.2f (%+.1f%%)%s' % (
+                name, metric, old, new, change * 100,
+                '  REGRESSION' if regression > REGRESSION_THRESHOLD else '',
+            ))
+    return ret
+
+
+def print_results(results):
+    print('%-16s %8s %10s %9s %9s %10s %8s' % (
+        'scenario', 'count', 'msgs/sec', 'p50 ms', 'p99 ms', 'api/msg', 'tme/msg',
+    ))
+    for name, res in results['scenarios'].items():
+        print('%-16s %8d %10.1f %9.2f %9.2f %10.2f %8.2f' % (
+            name, res['count'], res['msgs_per_sec'], res['p50_ms'],
+            res['p99_ms'], res['api_calls_per_msg'], res['tme_fetches_per_msg'],
+        ))
+
+
+def main():
+    parser = ArgumentParser(description='Replay benchmark of message handlers')
+    parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, could be repeated; all by default')
+    parser.add_argument('-n', '--count', type=int, default=500,
+                        help='number of updates in each scenario')
+    parser.add_argument('--corpus', help='JSONL file with recorded updates')
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--api-latency', type=float, default=0,
+                        help='latency of fake Bot API in seconds')
+    parser.add_argument('--tme-latency', type=float, default=0,
+                        help='latency of fake t.me in seconds')
+    parser.add_argument('--log-chat-rate', type=int, default=1000,
+                        help='log channel messages per minute')
+    parser.add_argument('--join-action-rate', type=int, default=1000,
+                        help='kicks and deletions per second during join waves')
+    parser.add_argument('-o', '--output', help='file to save results to')
+    parser.add_argument('--compare', help='results file of previous run')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='display log messages of the bot')
+    opts = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if opts.verbose else logging.CRITICAL)
+
+    api = FakeBotApi(latency=opts.api_latency)
+    tme = FakeTme(latency=opts.tme_latency)
+    apihelper.API_URL = api.api_url
+    tmp_dir = tempfile.mkdtemp()
+    config = {
+        'workers': opts.workers,
+        'tme_url': tme.url,
+        'event_flush_interval': 0.1,
+        'event_spill_path': os.path.join(tmp_dir, 'event_spill.jsonl'),
+        'log_chat_rate': opts.log_chat_rate,
+        'join_wave_action_rate': opts.join_action_rate,
+    }
+
+    scenarios = []
+    for name in opts.scenario or sorted(SCENARIOS):
+        scenarios.append((name, build_updates(name, opts.count)))
+    if opts.corpus:
+        scenarios.append(('corpus', load_corpus(opts.corpus)))
+
+    results = {
+        'version': get_version(),
+        'date': datetime.utcnow().isoformat(),
+        'options': vars(opts),
+        'scenarios': {},
+    }
+    try:
+        for name, updates in scenarios:
+            results['scenarios'][name] = run_scenario(updates, api, tme, config)
+    finally:
+        api.stop()
+        tme.stop()
+    print_results(results)
+
+    output = opts.output or os.path.join(
+        'var', 'bench', 'bench-%s.json' % datetime.utcnow().strftime('%Y%m%d-%H%M%S'),
+    )
+    if os.path.dirname(output) and not os.path.exists(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+    print('Results saved to %s' % output)
+
+    if opts.compare:
+        with open(opts.compare) as inp:
+            previous = json.load(inp)
+        print('\nChanges against %s (%s):' % (opts.compare, previous.get('version')))
+        for line in compare(results, previous):
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
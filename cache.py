@@ -0,0 +1,228 @@
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Lock
+
+from metrics import timed
+
+
+class TTLCache(object):
+    """
+    Size-bounded LRU mapping whose entries expire ``ttl`` seconds after
+    they were stored. Safe to share between threads.
+    """
+
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            try:
+                expires, val = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return val
+
+    def set(self, key, val, ttl=None):
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires, val)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def snapshot(self):
+        """
+        Return list of (key, value, expiration unix time) of live entries,
+        least recently used first.
+        """
+        now = time.monotonic()
+        wall_now = time.time()
+        with self._lock:
+            return [
+                (key, val, wall_now + expires - now)
+                for key, (expires, val) in self._data.items()
+                if expires > now
+            ]
+
+    def restore(self, items):
+        now = time.time()
+        count = 0
+        for key, val, expires in items:
+            if expires > now:
+                self.set(key, val, ttl=min(self.ttl, expires - now))
+                count += 1
+        return count
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits / total) if total else 0.0,
+        }
+
+
+class AdminCache(object):
+    """
+    Per-chat cache of administrator ids backed by
+    ``bot.get_chat_administrators``.
+    """
+
+    def __init__(self, bot, ttl=300, maxsize=10000):
+        self.bot = bot
+        self.cache = TTLCache(ttl=ttl, maxsize=maxsize)
+
+    def get_admin_ids(self, chat_id):
+        admin_ids = self.cache.get(chat_id)
+        if admin_ids is None:
+            admin_ids = self.refresh(chat_id)
+        return admin_ids
+
+    def refresh(self, chat_id):
+        with timed('get_chat_administrators'):
+            admins = self.bot.get_chat_administrators(chat_id)
+        admin_ids = frozenset(x.user.id for x in admins)
+        self.cache.set(chat_id, admin_ids)
+        return admin_ids
+
+    def invalidate(self, chat_id):
+        self.cache.delete(chat_id)
+
+    def snapshot(self):
+        return [(key, sorted(val), expires) for key, val, expires in self.cache.snapshot()]
+
+    def restore(self, items):
+        return self.cache.restore((key, frozenset(val), expires) for key, val, expires in items)
+
+    def is_admin(self, chat_id, user_id, recheck=False):
+        # With `recheck` a negative answer from the cache is verified
+        # against the API, so that freshly promoted admins are not denied
+        # until the entry expires
+        admin_ids = self.cache.get(chat_id)
+        if admin_ids is None:
+            return user_id in self.refresh(chat_id)
+        if user_id in admin_ids:
+            return True
+        if recheck:
+            return user_id in self.refresh(chat_id)
+        return False
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class SingleFlight(object):
+    """
+    Collapses concurrent calls with the same key into one call: callers
+    arriving while the call is running wait for its result.
+
+    `start` and `run` split `do`, so that the caller could find out which
+    calls it owns before running them, e.g. in a thread pool, and wait
+    for the others itself.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self.shared = 0
+
+    def start(self, key):
+        """
+        Return Future of the call and True if the caller owns the call
+        and has to `run` it.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared += 1
+                return call, False
+            call = self._calls[key] = Future()
+            return call, True
+
+    def run(self, key, call, func, *args):
+        try:
+            call.set_result(func(*args))
+        except Exception as ex:
+            call.set_exception(ex)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return call.result()
+
+    def do(self, key, func, *args):
+        call, owner = self.start(key)
+        if owner:
+            return self.run(key, call, func, *args)
+        return call.result()
+
+
+def save_snapshot(path, components):
+    """
+    Write entries of `components` (mapping name to object with
+    `snapshot` method) to JSON file, so that the next run starts with
+    warm caches.
+    """
+    data = dict((name, x.snapshot()) for name, x in components.items())
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    tmp_path = '%s.tmp' % path
+    with open(tmp_path, 'w') as out:
+        json.dump(data, out)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path, components):
+    """
+    Restore entries saved by `save_snapshot`, return number of restored
+    entries. The file is removed, so that it is not loaded again after
+    a crash.
+    """
+    try:
+        with open(path) as inp:
+            data = json.load(inp)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError):
+        logging.exception('Failed to load cache snapshot %s' % path)
+        return 0
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+    count = 0
+    for name, component in components.items():
+        count += component.restore(data.get(name) or ())
+    return count
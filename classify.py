@@ -0,0 +1,136 @@
+import re
+from collections import namedtuple
+
+from util import RE_USERNAME, RE_SIMPLE_LINK
+
+Verdict = namedtuple('Verdict', ['action', 'reason', 'span', 'source'])
+KEEP = Verdict('keep', None, None, None)
+
+# Group settings used by classifier and their default values
+CLASSIFY_SETTINGS = {
+    'links': True,
+    'emails': True,
+    'groups': True,
+    'channels': True,
+    'forwarded': True,
+}
+# Mention with space after "@" sign, used to bypass entity detection
+RE_SPACED_MENTION = re.compile(r'(?:^|\W)\@\s([a-zA-Z]+)(?:$|\W)')
+# Usernames and links of caption found in one pass. Username is matched by
+# zero-width lookahead, so links are found exactly as with separate
+# RE_SIMPLE_LINK.findall() call
+RE_CAPTION = re.compile(
+    r'(?=(?P<username>%s))|(?P<link>%s)' % (RE_USERNAME.pattern, RE_SIMPLE_LINK.pattern),
+    re.X | re.I | re.U
+)
+TYPE_REASONS = {
+    'group': ('groups', '@-link to group'),
+    'channel': ('channels', '@-link to channel'),
+}
+
+
+def scan_caption(caption):
+    """
+    Return list of (username, span) items and span of first link in
+    `caption`.
+    """
+    usernames = []
+    link_span = None
+    for match in RE_CAPTION.finditer(caption):
+        if match.group('username'):
+            usernames.append((match.group('username'), match.span('username')))
+        else:
+            if link_span is None:
+                link_span = match.span()
+            if '@' in match.group():
+                # Usernames inside the link
+                offset = match.start()
+                for item in RE_USERNAME.finditer(match.group()):
+                    usernames.append((item.group(), (
+                        offset + item.start(), offset + item.end()
+                    )))
+    return usernames, link_span
+
+
+class Classifier(object):
+    """
+    Decides if message has to be deleted.
+
+    `classify` does not talk to Telegram: group settings are passed as dict
+    (see CLASSIFY_SETTINGS) and usernames are resolved with
+    `resolve_types(usernames)` callable which returns dict mapping
+    lower-cased username to its type. It is called at most once per
+    message, with all usernames of the message. Domains allowed in the
+    group are passed as compiled `extra_domains`.
+    """
+
+    def __init__(self, links_matcher, username_exceptions=()):
+        self.links_matcher = links_matcher
+        self.username_exceptions = frozenset(x.lower() for x in username_exceptions)
+
+    def classify(self, msg, settings, resolve_types, extra_domains=None):
+        text = msg.text or ''
+        caption = msg.caption or ''
+        entities = msg.entities or ()
+        spaced_mention = RE_SPACED_MENTION.search(text) if '@' in text else None
+        if '@' in caption or '.' in caption:
+            caption_usernames, caption_link = scan_caption(caption)
+        else:
+            caption_usernames, caption_link = [], None
+        exceptions = self.username_exceptions
+        user_types = None
+
+        def check_username(username, span, source, prefix=''):
+            nonlocal user_types
+            if username.lower() in exceptions:
+                return None
+            if user_types is None:
+                usernames = [
+                    text[x.offset:x.offset + x.length].lstrip('@')
+                    for x in entities if x.type == 'mention'
+                ]
+                if spaced_mention:
+                    usernames.append(spaced_mention.group(1))
+                usernames.extend(x[0].lstrip('@') for x in caption_usernames)
+                user_types = resolve_types([
+                    x for x in usernames if x.lower() not in exceptions
+                ])
+            key, reason = TYPE_REASONS.get(user_types.get(username.lower()), (None, None))
+            if key and settings.get(key, True):
+                return Verdict('delete', prefix + reason, span, source)
+            return None
+
+        for ent in entities:
+            span = (ent.offset, ent.offset + ent.length)
+            if ent.type in ('url', 'text_link') and settings.get('links', True):
+                if ent.type == 'text_link':
+                    url = ent.url
+                else:
+                    url = text[ent.offset:ent.offset + ent.length]
+                if self.links_matcher.match_url(url, extra_domains):
+                    continue
+                return Verdict('delete', 'external link', span, 'text')
+            if ent.type == 'email' and settings.get('emails', True):
+                return Verdict('delete', 'email', span, 'text')
+            if ent.type == 'mention':
+                username = text[ent.offset:ent.offset + ent.length].lstrip('@')
+                verdict = check_username(username, span, 'text')
+                if verdict:
+                    return verdict
+
+        if (msg.forward_from or msg.forward_from_chat) and settings.get('forwarded', True):
+            return Verdict('delete', 'forwarded', None, 'forward')
+        if spaced_mention:
+            verdict = check_username(
+                spaced_mention.group(1), spaced_mention.span(1), 'text',
+            )
+            if verdict:
+                return verdict
+
+        for username, span in caption_usernames:
+            verdict = check_username(username.lstrip('@'), span, 'caption', 'caption ')
+            if verdict:
+                return verdict
+        if caption_link and settings.get('links', True):
+            return Verdict('delete', 'caption external link', caption_link, 'caption')
+        return KEEP
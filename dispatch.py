@@ -0,0 +1,155 @@
+import logging
+import zlib
+from collections import deque
+from queue import Queue, Full
+from threading import Thread, Lock
+
+from telebot.types import Update
+
+UPDATE_CHAT_FIELDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'chat_member', 'my_chat_member',
+)
+_STOP = object()
+
+
+def get_update_chat_id(update):
+    for field in UPDATE_CHAT_FIELDS:
+        obj = getattr(update, field, None)
+        if obj is not None and getattr(obj, 'chat', None) is not None:
+            return obj.chat.id
+    return None
+
+
+def get_raw_chat_id(data):
+    """
+    Same as `get_update_chat_id` for update not parsed yet.
+    """
+    for field in UPDATE_CHAT_FIELDS:
+        chat = (data.get(field) or {}).get('chat')
+        if chat:
+            return chat['id']
+    return None
+
+
+def shard_index(chat_id, count):
+    if chat_id is None:
+        return 0
+    # Python's hash() of small ints is the int itself, crc32 spreads
+    # sequential ids more evenly between workers
+    return zlib.crc32(str(chat_id).encode()) % count
+
+
+class ChatDispatcher(object):
+    """
+    Runs ``handler(update)`` on a pool of worker threads.
+
+    Every chat is pinned to one worker by its id, so updates of the same chat
+    are processed in the order they were submitted while different chats
+    run in parallel. Each worker has a bounded queue: ``submit`` blocks when
+    the queue of the target worker is full, which slows down the producer
+    (polling loop) instead of buffering without limit.
+    """
+
+    def __init__(self, handler, workers=4, queue_size=100, put_timeout=None):
+        self.handler = handler
+        self.put_timeout = put_timeout
+        self.queues = [Queue(maxsize=queue_size) for _ in range(workers)]
+        self.dropped = 0
+        self.processed = [0] * workers
+        # Ids of queued and running updates of every worker
+        self.pending = [deque() for _ in range(workers)]
+        self._lock = Lock()
+        self.threads = []
+        for idx, queue in enumerate(self.queues):
+            th = Thread(
+                target=self._worker, args=(idx, queue),
+                name='dispatch-%d' % idx, daemon=True,
+            )
+            th.start()
+            self.threads.append(th)
+
+    def worker_index(self, chat_id):
+        return shard_index(chat_id, len(self.queues))
+
+    def submit(self, update):
+        idx = self.worker_index(get_update_chat_id(update))
+        with self._lock:
+            self.pending[idx].append(update.update_id)
+        try:
+            self.queues[idx].put(update, timeout=self.put_timeout)
+        except Full:
+            with self._lock:
+                self.pending[idx].remove(update.update_id)
+            self.dropped += 1
+            logging.error('Dispatch queue is full, update %s dropped' % update.update_id)
+            return False
+        return True
+
+    def submit_json(self, data):
+        return self.submit(Update.de_json(data))
+
+    def queue_depth(self):
+        return [x.qsize() for x in self.queues]
+
+    def unfinished(self):
+        """
+        Return the lowest id of updates not handled yet.
+        """
+        with self._lock:
+            heads = [x[0] for x in self.pending if x]
+        return min(heads) if heads else None
+
+    def stats(self):
+        return {
+            'workers': len(self.queues),
+            'queue_depth': self.queue_depth(),
+            'processed': list(self.processed),
+            'dropped': self.dropped,
+        }
+
+    def _worker(self, idx, queue):
+        while True:
+            update = queue.get()
+            try:
+                if update is _STOP:
+                    return
+                self.handler(update)
+                self.processed[idx] += 1
+            except Exception:
+                logging.exception('Failed to process update')
+            finally:
+                if update is not _STOP:
+                    with self._lock:
+                        self.pending[idx].popleft()
+                queue.task_done()
+
+    def join(self):
+        for queue in self.queues:
+            queue.join()
+
+    def stop(self):
+        # Queued updates are processed before the workers exit
+        for queue in self.queues:
+            queue.put(_STOP)
+        for th in self.threads:
+            th.join()
+
+
+def install_dispatcher(bot, workers, queue_size=100, put_timeout=None):
+    """
+    Route updates fetched by ``bot`` through a ChatDispatcher.
+    """
+    process_new_updates = bot.process_new_updates
+    dispatcher = ChatDispatcher(
+        lambda update: process_new_updates([update]),
+        workers=workers, queue_size=queue_size, put_timeout=put_timeout,
+    )
+
+    def dispatch_updates(updates):
+        for update in updates:
+            dispatcher.submit(update)
+
+    bot.process_new_updates = dispatch_updates
+    bot.dispatcher = dispatcher
+    return dispatcher
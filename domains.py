@@ -0,0 +1,141 @@
+import logging
+import os
+import time
+from threading import Lock
+from urllib.parse import urlparse
+
+# Lists are loaded on import of graphenebot, logging to the root logger
+# then would configure it before setup_logging
+logger = logging.getLogger(__name__)
+
+
+def normalize_domain(domain):
+    """
+    Convert domain or host[:port] to lower-cased ASCII (punycode) form
+    without port and trailing dot.
+    """
+    domain = domain.strip().lower()
+    if '://' in domain or domain.startswith('//'):
+        domain = urlparse(domain).netloc
+    domain = domain.rpartition('@')[2]
+    if domain.startswith('['):
+        # IPv6 literal
+        return domain.partition(']')[0] + ']'
+    domain = domain.partition(':')[0].rstrip('.')
+    try:
+        return domain.encode('idna').decode('ascii')
+    except UnicodeError:
+        return domain
+
+
+def url_host(url):
+    if not url.startswith('//') and '://' not in url:
+        url = '//' + url
+    return normalize_domain(urlparse(url).netloc)
+
+
+def compile_domains(domains):
+    """
+    Set of normalized domains, `*.example.com` entries are kept with the
+    `*.` prefix.
+    """
+    ret = set()
+    for domain in domains:
+        domain = domain.split('#', 1)[0].strip()
+        if domain.startswith('*.'):
+            domain = normalize_domain(domain[2:])
+            if domain:
+                ret.add('*.' + domain)
+        elif domain:
+            ret.add(normalize_domain(domain))
+    return frozenset(ret)
+
+
+def match_domain(host, domains):
+    """
+    Check if `host` is in `domains` set, or it or any of its parent
+    domains is listed as `*.domain`.
+    """
+    if host in domains:
+        return True
+    while host:
+        if '*.' + host in domains:
+            return True
+        host = host.partition('.')[2]
+    return False
+
+
+class DomainMatcher(object):
+    """
+    Allow-list of domains loaded from files. Domains are matched exactly,
+    subdomains are allowed only for `*.example.com` entries (which allow
+    example.com too): hosting sites like github.io serve anybody's pages
+    on subdomains.
+
+    Files are checked for modification at most once per `check_interval`
+    seconds, the new list replaces the old one at once. Additional
+    compiled list of domains (e.g. allowed in the group) could be passed
+    as `extra`.
+    """
+
+    def __init__(self, filenames, check_interval=10):
+        self.filenames = filenames
+        self.check_interval = check_interval
+        self.domains = frozenset()
+        # Incremented on every reload
+        self.version = 0
+        self._mtimes = None
+        self._next_check = 0
+        self._lock = Lock()
+        self.reload()
+
+    def _get_mtimes(self):
+        ret = []
+        for filename in self.filenames:
+            try:
+                ret.append(os.stat(filename).st_mtime_ns)
+            except OSError:
+                ret.append(None)
+        return ret
+
+    def reload(self):
+        mtimes = self._get_mtimes()
+        domains = []
+        for filename in self.filenames:
+            try:
+                with open(filename) as inp:
+                    domains.extend(inp.read().splitlines())
+            except OSError:
+                # Keep the current list, e.g. file is being replaced
+                logger.exception('Failed to load domains from %s' % filename)
+                return
+        self.domains = compile_domains(domains)
+        self._mtimes = mtimes
+        self.version += 1
+        logger.debug('Loaded %d allowed domains' % len(self.domains))
+
+    def check_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+            if self._get_mtimes() != self._mtimes:
+                self.reload()
+
+    def _match(self, host, extra):
+        self.check_reload()
+        if match_domain(host, self.domains):
+            return True
+        return bool(extra) and match_domain(host, extra)
+
+    def match(self, host, extra=None):
+        return self._match(normalize_domain(host), extra)
+
+    def match_url(self, url, extra=None):
+        return self._match(url_host(url), extra)
+
+    def __contains__(self, host):
+        return self.match(host)
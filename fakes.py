@@ -0,0 +1,463 @@
+import copy
+import json
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, Condition
+from types import SimpleNamespace
+from urllib.parse import urlparse, parse_qsl
+
+from bson import ObjectId
+from pymongo.errors import OperationFailure, DuplicateKeyError
+
+BOT_USER = {'id': 1000, 'is_bot': True, 'first_name': 'Graphene Bot', 'username': 'graphenebot'}
+ADMIN_USER = {'id': 1, 'is_bot': False, 'first_name': 'Admin'}
+ADMIN_RIGHTS = (
+    'can_be_edited', 'is_anonymous', 'can_manage_chat', 'can_delete_messages',
+    'can_manage_video_chats', 'can_restrict_members', 'can_promote_members',
+    'can_change_info', 'can_invite_users', 'can_post_stories',
+    'can_edit_stories', 'can_delete_stories',
+)
+TME_MARKERS = {
+    'group': '>View Group<',
+    'user': '>Send Message<',
+    'channel': '>View Channel<',
+}
+
+
+def get_field(doc, key):
+    for part in key.split('.'):
+        if not isinstance(doc, dict) or part not in doc:
+            return None
+        doc = doc[part]
+    return doc
+
+
+def set_field(doc, key, val):
+    parts = key.split('.')
+    for part in parts[:-1]:
+        doc = doc.setdefault(part, {})
+    doc[parts[-1]] = val
+
+
+def eval_expr(doc, expr):
+    """
+    Value of aggregation expression, only field paths, $ifNull and
+    $dateToString are supported.
+    """
+    if isinstance(expr, str) and expr.startswith('$'):
+        return get_field(doc, expr[1:])
+    if isinstance(expr, dict):
+        if '$ifNull' in expr:
+            for arg in expr['$ifNull']:
+                val = eval_expr(doc, arg)
+                if val is not None:
+                    return val
+            return None
+        if '$dateToString' in expr:
+            args = expr['$dateToString']
+            return eval_expr(doc, args['date']).strftime(args['format'])
+        return dict((key, eval_expr(doc, val)) for key, val in expr.items())
+    return expr
+
+
+def group_docs(docs, spec):
+    groups = {}
+    for doc in docs:
+        key = eval_expr(doc, spec['_id'])
+        group = groups.setdefault(json.dumps(key, sort_keys=True, default=str), {'_id': key})
+        for field, acc in spec.items():
+            if field == '_id':
+                continue
+            (op, arg), = acc.items()
+            val = eval_expr(doc, arg)
+            if op == '$sum':
+                group[field] = group.get(field, 0) + val
+            elif op == '$last':
+                group[field] = val
+            elif op == '$first':
+                group.setdefault(field, val)
+    return list(groups.values())
+
+
+def match_query(doc, query):
+    for key, cond in query.items():
+        if key == '$and':
+            if not all(match_query(doc, x) for x in cond):
+                return False
+            continue
+        if key == '$or':
+            if not any(match_query(doc, x) for x in cond):
+                return False
+            continue
+        val = get_field(doc, key)
+        if isinstance(cond, dict) and any(x.startswith('$') for x in cond):
+            for op, arg in cond.items():
+                if op == '$in' and val not in arg:
+                    return False
+                if op == '$gte' and (val is None or val < arg):
+                    return False
+                if op == '$lt' and (val is None or val >= arg):
+                    return False
+                if op == '$lte' and (val is None or val > arg):
+                    return False
+                if op == '$exists' and (val is not None) != arg:
+                    return False
+        elif val != cond:
+            return False
+    return True
+
+
+class FakeCollection(object):
+    """
+    Small subset of pymongo Collection API working on list of dicts.
+    """
+
+    def __init__(self):
+        self.docs = []
+        self.counters = Counter()
+        # Key pattern -> options
+        self.indexes = {}
+        self._lock = Lock()
+
+    def create_index(self, keys, **kwargs):
+        self.counters['create_index'] += 1
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        pattern = tuple(keys)
+        options = self.indexes.setdefault(pattern, kwargs)
+        if options != kwargs:
+            raise OperationFailure('Index with name: %s already exists with different options' % (
+                '_'.join('%s_%s' % x for x in pattern),
+            ), 85)
+
+    def drop_index(self, keys):
+        self.counters['drop_index'] += 1
+        if self.indexes.pop(tuple(keys), None) is None:
+            raise OperationFailure('index not found with name [%s]' % keys, 27)
+
+    def find(self, query=None, *args, **kwargs):
+        self.counters['find'] += 1
+        with self._lock:
+            return [copy.deepcopy(x) for x in self.docs if match_query(x, query or {})]
+
+    def find_one(self, query=None, *args, sort=None, **kwargs):
+        self.counters['find_one'] += 1
+        with self._lock:
+            docs = [x for x in self.docs if match_query(x, query or {})]
+        for key, direction in reversed(sort or []):
+            docs.sort(key=lambda x: get_field(x, key), reverse=direction < 0)
+        return copy.deepcopy(docs[0]) if docs else None
+
+    def aggregate(self, pipeline, **kwargs):
+        self.counters['aggregate'] += 1
+        with self._lock:
+            docs = copy.deepcopy(self.docs)
+        # Only $match, $sort and $group stages are supported
+        for stage in pipeline:
+            if '$match' in stage:
+                docs = [x for x in docs if match_query(x, stage['$match'])]
+            elif '$sort' in stage:
+                for key, direction in reversed(list(stage['$sort'].items())):
+                    docs.sort(key=lambda x: get_field(x, key), reverse=direction < 0)
+            elif '$group' in stage:
+                docs = group_docs(docs, stage['$group'])
+        return iter(docs)
+
+    def count_documents(self, query):
+        return len(self.find(query))
+
+    def _update(self, query, update, upsert):
+        for doc in self.docs:
+            if match_query(doc, query):
+                break
+        else:
+            if not upsert:
+                return None
+            if '_id' in query and any(x['_id'] == query['_id'] for x in self.docs):
+                raise DuplicateKeyError('E11000 duplicate key error', 11000)
+            doc = {'_id': ObjectId()}
+            for key, val in query.items():
+                if not key.startswith('$') and not isinstance(val, dict):
+                    set_field(doc, key, val)
+            self.docs.append(doc)
+        for key, val in update.get('$set', {}).items():
+            set_field(doc, key, val)
+        for key, val in update.get('$inc', {}).items():
+            set_field(doc, key, (get_field(doc, key) or 0) + val)
+        return doc
+
+    def find_one_and_update(self, query, update, upsert=False, **kwargs):
+        self.counters['find_one_and_update'] += 1
+        with self._lock:
+            return copy.deepcopy(self._update(query, update, upsert))
+
+    def update_many(self, query, update):
+        self.counters['update_many'] += 1
+        with self._lock:
+            modified = 0
+            for idx, doc in enumerate(self.docs):
+                if not match_query(doc, query):
+                    continue
+                # Only $project/$set stages of pipeline updates are supported
+                for stage in (update if isinstance(update, list) else [update]):
+                    if '$project' in stage:
+                        doc = dict(
+                            (key, val) for key, val in doc.items()
+                            if key == '_id' or stage['$project'].get(key)
+                        )
+                    for key, val in stage.get('$set', {}).items():
+                        set_field(doc, key, val)
+                self.docs[idx] = doc
+                modified += 1
+            return SimpleNamespace(modified_count=modified)
+
+    def update_one(self, query, update, upsert=False):
+        self.counters['update_one'] += 1
+        with self._lock:
+            self._update(query, update, upsert)
+
+    def replace_one(self, query, doc, upsert=False):
+        self.counters['replace_one'] += 1
+        with self._lock:
+            self.docs = [x for x in self.docs if not match_query(x, query)]
+            self.docs.append(dict(copy.deepcopy(doc), _id=ObjectId()))
+
+    def insert_one(self, doc):
+        self.insert_many([doc])
+
+    def insert_many(self, docs, ordered=True):
+        self.counters['insert_many'] += 1
+        with self._lock:
+            for doc in docs:
+                doc.setdefault('_id', ObjectId())
+                self.docs.append(copy.deepcopy(doc))
+
+    def bulk_write(self, ops, ordered=True):
+        self.counters['bulk_write'] += 1
+        with self._lock:
+            for op in ops:
+                # pymongo.UpdateOne keeps its arguments in private fields
+                self._update(op._filter, op._doc, op._upsert)
+
+    def watch(self, *args, **kwargs):
+        # Like standalone mongod
+        raise OperationFailure(
+            'The $changeStream stage is only supported on replica sets', 40573,
+        )
+
+    def delete_many(self, query):
+        self.counters['delete_many'] += 1
+        with self._lock:
+            self.docs = [x for x in self.docs if not match_query(x, query)]
+
+
+class FakeDatabase(object):
+    def __init__(self):
+        self._collections = {}
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return self[name]
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection()
+        return self._collections[name]
+
+    def command(self, name, value, **kwargs):
+        if name != 'collMod':
+            raise OperationFailure('no such command: %s' % name, 59)
+        index = kwargs['index']
+        pattern = tuple(index['keyPattern'].items())
+        self[value].indexes[pattern]['expireAfterSeconds'] = index['expireAfterSeconds']
+        return {'ok': 1}
+
+    def operation_counts(self):
+        ret = Counter()
+        for coll in self._collections.values():
+            ret.update(coll.counters)
+        return ret
+
+
+class FakeServer(object):
+    handler_class = None
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.calls = Counter()
+        self._lock = Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server.server_port
+
+    def count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeBotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def handle_api(self):
+        fake = self.server.fake
+        url = urlparse(self.path)
+        method = url.path.rsplit('/', 1)[-1]
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            params.update(parse_qsl(self.rfile.read(length).decode('utf-8')))
+        fake.count(method)
+        if fake.latency:
+            time.sleep(fake.latency)
+        error = fake.pop_error()
+        if error:
+            code = error['error_code']
+            body = dict(error, ok=False)
+        else:
+            code = 200
+            body = {'ok': True, 'result': fake.api_result(method, params)}
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = handle_api
+    do_POST = handle_api
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeBotApi(FakeServer):
+    """
+    Bot API server answering every method with a plausible result.
+    Set `telebot.apihelper.API_URL` to `api_url` to use it.
+    """
+    handler_class = FakeBotApiHandler
+
+    def __init__(self, latency=0):
+        super(FakeBotApi, self).__init__(latency)
+        self.message_id = 0
+        # Updates not confirmed by getUpdates offset yet
+        self.updates = []
+        self.errors = []
+        # Parameters of sendMessage calls
+        self.sent = []
+        # Administrators besides the creator and the bot
+        self.admins = []
+        self._updates_cond = Condition(self._lock)
+
+    def add_updates(self, updates):
+        with self._updates_cond:
+            self.updates.extend(updates)
+            self._updates_cond.notify_all()
+
+    def fail(self, count, error_code=429, description='Too Many Requests', retry_after=None):
+        error = {'error_code': error_code, 'description': description}
+        if retry_after is not None:
+            error['parameters'] = {'retry_after': retry_after}
+        with self._lock:
+            self.errors.extend([error] * count)
+
+    def pop_error(self):
+        with self._lock:
+            return self.errors.pop(0) if self.errors else None
+
+    def get_updates(self, params):
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', 100))
+        deadline = time.monotonic() + float(params.get('timeout', 0))
+        with self._updates_cond:
+            self.updates = [x for x in self.updates if x['update_id'] >= offset]
+            while not self.updates and time.monotonic() < deadline:
+                self._updates_cond.wait(deadline - time.monotonic())
+            return self.updates[:limit]
+
+    @property
+    def api_url(self):
+        return self.url + '/bot{0}/{1}'
+
+    def api_result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'getUpdates':
+            return self.get_updates(params)
+        if method == 'getChatAdministrators':
+            rights = dict((key, False) for key in ADMIN_RIGHTS)
+            return [{'user': ADMIN_USER, 'status': 'creator', 'is_anonymous': False}] + [
+                dict(rights, user=user, status='administrator') for user in self.admins
+            ] + [
+                dict(rights, user=BOT_USER, status='administrator', can_delete_messages=True),
+            ]
+        if method in ('sendMessage', 'forwardMessage'):
+            with self._lock:
+                if method == 'sendMessage':
+                    self.sent.append(params)
+                self.message_id += 1
+                message_id = self.message_id
+            return {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'chat': {'id': int(params.get('chat_id', 0)), 'type': 'supergroup'},
+                'from': BOT_USER,
+                'text': params.get('text', ''),
+            }
+        return True
+
+
+class FakeTmeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        fake = self.server.fake
+        username = self.path.lstrip('/').lower()
+        fake.count(username)
+        fake.clients.add(self.client_address)
+        if fake.latency:
+            time.sleep(fake.latency)
+        user_type = fake.get_type(username)
+        body = ('<html>' + 'x' * 8000 + TME_MARKERS.get(user_type, '') + 'x' * 2000)
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeTme(FakeServer):
+    """
+    t.me stand-in: type of username is taken from its prefix (group_,
+    channel_, user_), other usernames are unknown.
+    """
+    handler_class = FakeTmeHandler
+
+    def __init__(self, latency=0):
+        # Addresses of client connections
+        self.clients = set()
+        super(FakeTme, self).__init__(latency)
+
+    def get_type(self, username):
+        prefix = username.split('_', 1)[0]
+        return prefix if prefix in TME_MARKERS else None
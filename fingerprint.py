@@ -0,0 +1,139 @@
+import hashlib
+import time
+from threading import Lock
+
+from cache import TTLCache
+
+# Entities which affect classification of the message
+FINGERPRINT_ENTITIES = ('url', 'text_link', 'email', 'mention')
+MEDIA_FIELDS = ('video', 'audio', 'document', 'sticker')
+
+
+def normalize_text(text):
+    return ' '.join(text.lower().split())
+
+
+def get_media_id(msg):
+    photo = getattr(msg, 'photo', None)
+    if photo:
+        return photo[-1].file_unique_id
+    for field in MEDIA_FIELDS:
+        media = getattr(msg, field, None)
+        if media is not None:
+            return media.file_unique_id
+    return None
+
+
+def get_fingerprint(msg, normalize=False):
+    """
+    Return digest of message content which classification depends on:
+    text and caption, links and mentions, media and forwarding. Plain
+    text without entities and "@" sign is cheaper to classify than to
+    cache, None is returned for it.
+
+    The digest of exact content is the key of cached verdicts: the
+    classifier is sensitive to spacing (e.g. RE_SPACED_MENTION). With
+    `normalize` case and spacing are ignored, which is used to detect
+    copies of the same spam in different chats.
+    """
+    text = msg.text or ''
+    entities = [x for x in msg.entities or () if x.type in FINGERPRINT_ENTITIES]
+    media_id = get_media_id(msg)
+    forwarded = bool(msg.forward_from or msg.forward_from_chat)
+    if not (entities or media_id or forwarded or msg.caption or '@' in text):
+        return None
+    if normalize:
+        parts = [normalize_text(text), normalize_text(msg.caption or ''), media_id or '']
+        for ent in entities:
+            if ent.type == 'text_link':
+                parts.append('%s %s' % (ent.type, ent.url))
+            else:
+                parts.append('%s %s' % (
+                    ent.type, text[ent.offset:ent.offset + ent.length].lower(),
+                ))
+    else:
+        parts = [text, msg.caption or '', media_id or '']
+        for ent in entities:
+            parts.append('%s %d %d %s' % (ent.type, ent.offset, ent.length, ent.url or ''))
+    if forwarded:
+        parts.append('forwarded')
+    return hashlib.blake2b('\n'.join(parts).encode('utf-8'), digest_size=16).digest()
+
+
+class Burst(object):
+    __slots__ = ('started', 'chats', 'reported')
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.chats = {}
+        self.reported = False
+
+
+class FingerprintCache(object):
+    """
+    Recent verdicts by message fingerprint, so that copies of the same
+    spam are not classified again, and detector of raids: the same
+    content deleted in `raid_threshold` chats within `raid_window`
+    seconds.
+
+    Verdict depends on group settings too, they are part of the key.
+    Verdicts are dropped when allowed domains of `links_matcher` are
+    reloaded.
+    """
+
+    def __init__(self, ttl=300, maxsize=50000, raid_threshold=5, raid_window=600,
+                 links_matcher=None):
+        self.verdicts = TTLCache(ttl=ttl, maxsize=maxsize)
+        self.links_matcher = links_matcher
+        self.links_version = links_matcher.version if links_matcher else None
+        self.bursts = TTLCache(ttl=raid_window, maxsize=maxsize)
+        self.raid_threshold = raid_threshold
+        self.raids = 0
+        self._lock = Lock()
+
+    def get(self, fingerprint, settings, extra_domains):
+        if fingerprint is None:
+            return None
+        if self.links_matcher is not None:
+            self.links_matcher.check_reload()
+            if self.links_matcher.version != self.links_version:
+                self.verdicts.clear()
+                self.links_version = self.links_matcher.version
+        return self.verdicts.get(
+            (fingerprint, tuple(sorted(settings.items())), extra_domains),
+        )
+
+    def set(self, fingerprint, settings, extra_domains, verdict):
+        if fingerprint is not None:
+            self.verdicts.set(
+                (fingerprint, tuple(sorted(settings.items())), extra_domains), verdict,
+            )
+
+    def observe(self, fingerprint, chat_id, message_id):
+        """
+        Record deletion of the content in the chat. Return the Burst
+        (its `chats` map chat id to message id) once the content is found
+        to be a raid.
+        """
+        if fingerprint is None:
+            return None
+        with self._lock:
+            burst = self.bursts.get(fingerprint)
+            if burst is None:
+                burst = Burst()
+                # Burst expires `raid_window` after its first message
+                self.bursts.set(fingerprint, burst)
+            if burst.reported or chat_id in burst.chats:
+                return None
+            burst.chats[chat_id] = message_id
+            if len(burst.chats) < self.raid_threshold:
+                return None
+            burst.reported = True
+            self.raids += 1
+            return burst
+
+    def stats(self):
+        ret = self.verdicts.stats()
+        ret['bursts'] = len(self.bursts)
+        ret['raids'] = self.raids
+        return ret
@@ -3,28 +3,56 @@ from pprint import pprint
 import re
 import sys
 import os.path
-from collections import Counter
+import time
 import jsondate
 import json
 import logging
+import secrets
+import signal
+from threading import Thread
 import telebot
+from telebot.types import Update
 from argparse import ArgumentParser
 from pymongo import MongoClient
 from datetime import datetime, timedelta
 import html
 from requests.exceptions import ReadTimeout
-from urllib.parse import urlparse
 
-from util import find_username_links, find_external_links, fetch_user_type
+from util import TmeClient
+from cache import AdminCache, save_snapshot, load_snapshot
+from dispatch import install_dispatcher
+from resolver import UserTypeResolver
+from domains import DomainMatcher, compile_domains
+import stats
+from journal import EventJournal
+from logchannel import LogDelivery, LogEntry
+from webhook import WebhookServer
+from classify import Classifier, CLASSIFY_SETTINGS
+from groupconfig import GroupConfigStore
+from shard import ShardCoordinator, serve_shard
+import throttle
+from throttle import NotifyThrottle
+from fingerprint import FingerprintCache, get_fingerprint
+from joinwave import JoinWaveGuard
+from transport import ApiTransport
+from serialize import dump_message
+import retention
+from retention import EventCompactor
+from poller import UpdatePoller
+from metrics import (
+    timed, add_stats_gauges, start_metrics_server, start_log_summary, StartupTimer,
+    UPDATE_LAG_SECONDS, DELETIONS, RAIDS,
+)
 
 
 USERNAME_EXCEPTIONS = ['blockchainschool', 'preico', 'tnam0rken_chanel']
 EXCEPTION_FILES = ['nongraphenelist', 'whitelist']
 
-LINKS_EXCEPTIONS = []
-for filename in EXCEPTION_FILES:
-    with open(os.path.join(os.path.dirname(os.path.realpath(__file__)), filename)) as f:
-        LINKS_EXCEPTIONS.extend(f.read().splitlines())
+# Files are re-read automatically when they are modified
+LINKS_EXCEPTIONS = DomainMatcher([
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), filename)
+    for filename in EXCEPTION_FILES
+])
 
 
 HELP = """*Graphene Bot Help*
@@ -46,9 +74,11 @@ This bot does not ban anybody, it only deletes messages by the rules listed abov
 *Commands*
 
 `/help` - display this help message
-`/stat` - display simple statistics about number of deleted messages
+`/stat [<days>d] [reasons]` - display simple statistics about number of deleted messages, e.g. `/stat 30d reasons`
 `/graphene_set [publog|channels|groups|links|forwarded|emails|kick]=[yes|no]` - enable/disable messages to group or manage messages that will be deleted
 `/graphene_get [publog|channels|groups|links|forwarded|emails|kick]` - get value of setting
+`/graphene_allow [domain ...]` - do not delete links to these domains in the group, `*.example.com` allows subdomains too, without arguments displays the list
+`/graphene_disallow domain [domain ...]` - remove domains from the group list
 
 *How to log deleted messages to private channel*
 Add bot to the channel as admin. Write `/setlog` to the channel. Forward message to the group.
@@ -66,106 +96,134 @@ text of message (or caption text of photo/video)
 
 The source code is available at [github.com/PreICO/graphenebot](https://github.com/PreICO/graphenebot)
 """
-# List of keys allowed to use in set_setting/get_setting
-GROUP_SETTING_KEYS = ('publog', 'log_channel_id', 'logformat', 'channels', 'groups', 'links', 'forwarded', 'emails', 'kick')
 # Default time to reject link and forwarded posts from new user
-
-
-def dump_telegram_object(msg):
-    ret = {}
-    for key, val in msg.__dict__.items():
-        if isinstance(val, (int, str, dict)):
-            pass
-        elif val is None:
-            pass
-        elif isinstance(val, (tuple, list)):
-            val = [dump_telegram_object(x) for x in val]
-        else:
-            val = dump_telegram_object(val)
-        if val is not None:
-            ret[key] = val
-    return ret
-
-
-def save_event(db, event_type, msg, **kwargs):
-    event = dump_telegram_object(msg)
+# Update types requested from Telegram, chat_member is required to track
+# admin list changes
+ALLOWED_UPDATES = ['message', 'edited_message', 'channel_post', 'chat_member']
+ADMIN_STATUSES = ('creator', 'administrator')
+# Caches saved on shutdown and loaded on start
+SNAPSHOT_COMPONENTS = ('admin_cache', 'resolver')
+CACHE_SNAPSHOT_PATH = 'var/run/cache_snapshot.json'
+EVENT_SPILL_PATH = 'var/run/event_spill.jsonl'
+RE_CMD_SET = re.compile(r'^/graphene_set (publog|channels|groups|links|forwarded|emails|kick)=(.+)$')
+RE_CMD_GET = re.compile(r'^/graphene_get (publog|channels|groups|links|forwarded|emails|kick)()$')
+RE_CMD_STAT = re.compile(r'^/stat(?:@\w+)?(?:\s+([1-9]\d*)d)?(?:\s+(reasons))?\s*$')
+
+
+def save_event(journal, event_type, msg_dump, **kwargs):
+    # `msg_dump` is shared with log formats, so it is copied
+    event = dict(msg_dump)
     event.update({
         'date': datetime.utcnow(),
         'type': event_type,
     })
     event.update(**kwargs)
-    db.event.save(event)
+    journal.add(event)
 
 
-def load_group_config(db):
-    ret = {}
-    for item in db.config.find():
-        key = (
-            item['group_id'],
-            item['key'],
-        )
-        ret[key] = item['value']
-    return ret
-
-
-def set_setting(db, group_config, group_id, key, val):
-    assert key in GROUP_SETTING_KEYS
-    db.config.find_one_and_update(
-        {
-            'group_id': group_id,
-            'key': key,
-        },
-        {'$set': {'value': val}},
-        upsert=True,
+def create_bot(api_token, db, config=None):
+    config = config or {}
+    bot = telebot.TeleBot(api_token, threaded=False)
+    transport = ApiTransport(
+        pool_size=config.get('api_pool_size', 20),
+        workers=config.get('api_workers', 8),
+        max_inflight=config.get('api_max_inflight', 1000),
     )
-    group_config[(group_id, key)] = val
-
-
-def get_setting(group_config, group_id, key, default=None):
-    assert key in GROUP_SETTING_KEYS
-    try:
-        return group_config[(group_id, key)]
-    except KeyError:
-        return default
-
-
-def process_user_type(db, username):
-    username = username.lower()
-    logging.debug('Querying %s type from db' % username)
-    user = db.user.find_one({'username': username})
-    if user:
-        logging.debug('Record found, type is: %s' % user['type'])
-        return user['type']
-    else:
-        logging.debug('Doing network request for type of %s' % username)
-        user_type = fetch_user_type(username)
-        logging.debug('Result is: %s' % user_type)
-        if user_type:
-            db.user.find_one_and_update(
-                {'username': username},
-                {'$set': {
-                    'username': username,
-                    'type': user_type,
-                    'added': datetime.utcnow(),
-                }},
-                upsert=True
-            )
-        return user_type
-
+    transport.install()
+    bot.transport = transport
+    group_config = GroupConfigStore(
+        db,
+        maxsize=config.get('group_config_cache_size', 10000),
+        ttl=config.get('group_config_ttl', 3600),
+        poll_interval=config.get('group_config_poll_interval', 5),
+        watch=config.get('group_config_watch', True),
+    )
+    bot.group_config = group_config
+    notify_throttle = NotifyThrottle(
+        db,
+        window=config.get('notify_window', 3600),
+        buckets=config.get('notify_buckets', 6),
+    )
+    bot.notify_throttle = notify_throttle
+    fingerprints = FingerprintCache(
+        ttl=config.get('fingerprint_ttl', 300),
+        maxsize=config.get('fingerprint_cache_size', 50000),
+        raid_threshold=config.get('raid_threshold', 5),
+        raid_window=config.get('raid_window', 600),
+        links_matcher=LINKS_EXCEPTIONS,
+    )
+    bot.fingerprints = fingerprints
+    # Save whole messages as received instead of compact form
+    full_events = config.get('full_events', False)
+    admin_cache = AdminCache(
+        bot,
+        ttl=config.get('admin_cache_ttl', 300),
+        maxsize=config.get('admin_cache_size', 10000),
+    )
+    bot.admin_cache = admin_cache
+    tme = TmeClient(
+        base_url=config.get('tme_url', 'https://t.me'),
+        timeout=config.get('tme_timeout', 2),
+        pool_size=config.get('tme_pool_size', 10),
+    )
+    resolver = UserTypeResolver(
+        db,
+        fetch=tme.fetch_user_type,
+        fetch_workers=config.get('tme_workers', 8),
+        maxsize=config.get('user_cache_size', 50000),
+        ttl=config.get('user_cache_ttl', 3600),
+        negative_ttl=config.get('user_negative_ttl', 600),
+        max_age=timedelta(days=config.get('user_type_max_age_days', 30)),
+    )
+    bot.resolver = resolver
+    journal = EventJournal(
+        db,
+        batch_size=config.get('event_batch_size', 100),
+        flush_interval=config.get('event_flush_interval', 1.0),
+        queue_size=config.get('event_queue_size', 10000),
+        spill_path=config.get('event_spill_path', EVENT_SPILL_PATH),
+    )
+    bot.journal = journal
+    log_delivery = LogDelivery(
+        bot,
+        chat_rate=(config.get('log_chat_rate', 20), 60),
+        global_rate=(config.get('log_global_rate', 30), 1),
+        digest_threshold=config.get('log_digest_threshold', 5),
+        digest_size=config.get('log_digest_size', 50),
+    )
+    bot.log_delivery = log_delivery
+    join_guard = JoinWaveGuard(
+        bot, journal,
+        threshold=config.get('join_wave_threshold', 20),
+        window=config.get('join_wave_window', 60),
+        exit_threshold=config.get('join_wave_exit_threshold', 5),
+        action_rate=(config.get('join_wave_action_rate', 20), 1),
+        delete_joins=config.get('join_wave_delete', True),
+    )
+    bot.join_guard = join_guard
+    classifier = Classifier(LINKS_EXCEPTIONS, USERNAME_EXCEPTIONS)
+    bot.classifier = classifier
 
-def create_bot(api_token, db):
-    bot = telebot.TeleBot(api_token, threaded=False)
-    group_config = load_group_config(db)
-    delete_events = {}
+    @bot.chat_member_handler()
+    def handle_chat_member(update):
+        statuses = (update.old_chat_member.status, update.new_chat_member.status)
+        if any(x in ADMIN_STATUSES for x in statuses) and statuses[0] != statuses[1]:
+            admin_cache.refresh(update.chat.id)
 
     @bot.message_handler(content_types=['new_chat_members'])
     def handle_new_chat_member(msg):
-        if msg.from_user.id in [x.user.id for x in bot.get_chat_administrators(msg.chat.id)]:
+        if admin_cache.is_admin(msg.chat.id, msg.from_user.id):
             return
 
-        for user in msg.new_chat_members:
-            if user.is_bot and user.username != 'graphenebot':
-                bot.kick_chat_member(chat_id=msg.chat.id, user_id=user.id)
+        bot_ids = [
+            user.id for user in msg.new_chat_members
+            if user.is_bot and user.username != 'graphenebot'
+        ]
+        if join_guard.observe(msg.chat, msg.message_id, len(msg.new_chat_members), bot_ids):
+            return
+        for user_id in bot_ids:
+            with timed('kick_chat_member'):
+                bot.kick_chat_member(chat_id=msg.chat.id, user_id=user_id)
 
     @bot.message_handler(commands=['start', 'help'])
     def handle_start_help(msg):
@@ -182,64 +240,23 @@ def create_bot(api_token, db):
     def handle_stat(msg):
         if msg.chat.type != 'private':
             return
-        days = []
-        top_today = Counter()
-        top_ystd = Counter()
-        top_week = Counter()
-        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        for x in range(7):
-            day = today - timedelta(days=x)
-            query = {'$and': [
-                {'type': 'delete_msg'},
-                {'date': {'$gte': day}},
-                {'date': {'$lt': day + timedelta(days=1)}},
-            ]}
-            num = 0
-            for event in db.event.find(query):
-                num += 1
-                if isinstance(event.get('chat'), dict):
-                    key  = (
-                        '@%s' % event['chat']['username'] if event['chat'].get('username')
-                        else '#%d' % event['chat']['id']
-                    )
-                else:
-                    # OLD event format
-                    key  = (
-                        '@%s' % event['chat_username'] if event['chat_username']
-                        else '#%d' % event['chat_id']
-                    )
-                if day == today:
-                    top_today[key] += 1
-                if day == (today - timedelta(days=1)):
-                    top_ystd[key] += 1
-                top_week[key] += 1
-            days.insert(0, num)
-        today_count = len(top_today)
-        ystd_count = len(top_ystd)
-        ret = 'Recent 7 days: %s' % ' | '.join([str(x) for x in days])
-        ret += '\n\nTop today: (%s)\n%s' % (
-            today_count,
-            '\n'.join('  %s (%d)' % x for x in top_today.most_common(15))
-        )
-        ret += '\n\nTop yesterday: (%s)\n%s' % (
-            ystd_count,
-            '\n'.join('  %s (%d)' % x for x in top_ystd.most_common(15))
-        )
-        ret += '\n\nTop 10 week:\n%s' % '\n'.join('  %s (%d)' % x for x in top_week.most_common(10))
-        bot.reply_to(msg, ret)
+        match = RE_CMD_STAT.match(msg.text)
+        if not match:
+            bot.reply_to(msg, 'Usage: /stat [<days>d] [reasons]')
+            return
+        days = min(int(match.group(1) or 7), 365)
+        bot.reply_to(msg, stats.build_report(db, days=days, reasons=bool(match.group(2))))
 
     @bot.message_handler(commands=['graphene_set', 'graphene_get'])
     def handle_set_get(msg):
         if not msg.chat.type in ('group', 'supergroup'):
             bot.reply_to(msg, 'This command have to be called from the group')
             return
-        re_cmd_set = re.compile(r'^/graphene_set (publog|channels|groups|links|forwarded|emails|kick)=(.+)$')
-        re_cmd_get = re.compile(r'^/graphene_get (publog|channels|groups|links|forwarded|emails|kick)()$')
         if msg.text.startswith('/graphene_set'):
-            match = re_cmd_set.match(msg.text)
+            match = RE_CMD_SET.match(msg.text)
             action = 'SET'
         else:
-            match = re_cmd_get.match(msg.text)
+            match = RE_CMD_GET.match(msg.text)
             action = 'GET'
         if not match:
             bot.reply_to(msg, 'Invalid arguments') 
@@ -247,18 +264,16 @@ def create_bot(api_token, db):
 
         key, val = match.groups()
 
-        admins = bot.get_chat_administrators(msg.chat.id)
-        admin_ids = set([x.user.id for x in admins])
-        if msg.from_user.id not in admin_ids:
+        if not admin_cache.is_admin(msg.chat.id, msg.from_user.id, recheck=True):
             bot.reply_to(msg, 'Access denied')
             return
 
         if action == 'GET':
-            bot.reply_to(msg, str(get_setting(group_config, msg.chat.id, key)))
+            bot.reply_to(msg, str(group_config.get(msg.chat.id).get(key)))
         else:
             if val in ('yes', 'no'):
                 val_bool = (val == 'yes')
-                set_setting(db, group_config, msg.chat.id, key, val_bool)
+                group_config.set(msg.chat.id, key, val_bool)
                 bot.reply_to(msg, 'Set %s to %s for group %s' % (
                     key, val_bool,
                     '@%s' % msg.chat.username if msg.chat.username else '#%d' % msg.chat.id,
@@ -266,6 +281,28 @@ def create_bot(api_token, db):
             else:
                 bot.reply_to(msg, 'Invalid value of %s. Should be: yes or no' % key)
 
+    @bot.message_handler(commands=['graphene_allow', 'graphene_disallow'])
+    def handle_allow(msg):
+        if not msg.chat.type in ('group', 'supergroup'):
+            bot.reply_to(msg, 'This command have to be called from the group')
+            return
+        if not admin_cache.is_admin(msg.chat.id, msg.from_user.id, recheck=True):
+            bot.reply_to(msg, 'Access denied')
+            return
+
+        args = msg.text.split()
+        domains = set(group_config.get(msg.chat.id).get('allowed_domains') or [])
+        changes = compile_domains(args[1:])
+        if args[0].startswith('/graphene_allow'):
+            domains |= changes
+        else:
+            domains -= changes
+        if changes:
+            group_config.set(msg.chat.id, 'allowed_domains', sorted(domains))
+        bot.reply_to(msg, 'Allowed domains in this group: %s' % (
+            ', '.join(sorted(domains)) or 'none'
+        ))
+
     @bot.channel_post_handler(commands=['setlogformat'])
     def handle_setlogformat(msg):
         # Possible options:
@@ -273,8 +310,7 @@ def create_bot(api_token, db):
         if not msg.chat.type == 'channel':
             bot.reply_to(msg, 'This command have to be called from the channel')
             return
-        channel_admin_ids = [x.user.id for x in bot.get_chat_administrators(msg.chat.id)]
-        if msg.from_user.id not in channel_admin_ids:
+        if not admin_cache.is_admin(msg.chat.id, msg.from_user.id, recheck=True):
             bot.reply_to(msg, 'Access denied')
             return
         valid_formats = ('json', 'forward', 'simple')
@@ -282,7 +318,7 @@ def create_bot(api_token, db):
         if any(x not in valid_formats for x in formats):
             bot.reply_to(msg, 'Invalid arguments. Valid choices: %s' % (', '.join(valid_formats),))
             return
-        set_setting(db, group_config, msg.chat.id, 'logformat', formats)
+        group_config.set(msg.chat.id, 'logformat', formats)
         bot.reply_to(msg, 'Set logformat for this channel')
 
 
@@ -296,18 +332,15 @@ def create_bot(api_token, db):
             return
         channel = msg.forward_from_chat
 
-        channel_admin_ids = [x.user.id for x in bot.get_chat_administrators(channel.id)]
-        if bot.get_me().id not in channel_admin_ids:
+        if not admin_cache.is_admin(channel.id, bot.get_me().id, recheck=True):
             bot.reply_to(msg, 'I need to be an admin in log channel')
             return
 
-        admins = bot.get_chat_administrators(msg.chat.id)
-        admin_ids = set([x.user.id for x in admins])
-        if msg.from_user.id not in admin_ids:
+        if not admin_cache.is_admin(msg.chat.id, msg.from_user.id, recheck=True):
             bot.reply_to(msg, 'Access denied')
             return
 
-        set_setting(db, group_config, msg.chat.id, 'log_channel_id', channel.id)
+        group_config.set(msg.chat.id, 'log_channel_id', channel.id)
         tgid = '@%s' % msg.chat.username if msg.chat.username else '#%d' % msg.chat.id
         bot.reply_to(msg, 'Set log channel for group %s' % tgid)
 
@@ -317,13 +350,11 @@ def create_bot(api_token, db):
             bot.reply_to(msg, 'This command have to be called from the group')
             return
 
-        admins = bot.get_chat_administrators(msg.chat.id)
-        admin_ids = set([x.user.id for x in admins])
-        if msg.from_user.id not in admin_ids:
+        if not admin_cache.is_admin(msg.chat.id, msg.from_user.id, recheck=True):
             bot.reply_to(msg, 'Access denied')
             return
 
-        set_setting(db, group_config, msg.chat.id, 'log_channel_id', None)
+        group_config.set(msg.chat.id, 'log_channel_id', None)
         tgid = '@%s' % msg.chat.username if msg.chat.username else '#%d' % msg.chat.id
         bot.reply_to(msg, 'Unset log channel for group %s' % tgid)
 
@@ -334,6 +365,27 @@ def create_bot(api_token, db):
     #def handle_foo(msg):
     #    import pdb; pdb.set_trace()
 
+    def report_raid(msg, msg_dump, reason, burst):
+        RAIDS.inc()
+        logging.warning('Raid: same message (%s) deleted in %d chats: %s' % (
+            reason, len(burst.chats), ', '.join(str(x) for x in burst.chats),
+        ))
+        save_event(journal, 'raid', msg_dump, reason=reason, raid_chats=list(burst.chats))
+        channel_ids = set()
+        for chat_id in burst.chats:
+            channel_id = group_config.get(chat_id).get('log_channel_id')
+            if channel_id:
+                channel_ids.add(channel_id)
+        text = msg.text or msg.caption or ''
+        for channel_id in channel_ids:
+            log_delivery.add(LogEntry(
+                channel_id, 'raid', '#%d' % msg.from_user.id, 'raid', text,
+                ['Raid: the same message was deleted in %d chats within %ds\nReason: %s\nContent:\n<pre>%s</pre>' % (
+                    len(burst.chats), time.monotonic() - burst.started,
+                    reason, html.escape(text),
+                )],
+            ))
+
     @bot.edited_message_handler(
         func=lambda x: True,
         content_types=['text', 'photo', 'video', 'audio', 'sticker', 'document']
@@ -343,172 +395,384 @@ def create_bot(api_token, db):
         content_types=['text', 'photo', 'video', 'audio', 'sticker', 'document']
     )
     def handle_any_msg(msg):
-        to_delete = False
-        for ent in (msg.entities or []):
-            if ent.type in ('url', 'text_link') and get_setting(group_config, msg.chat.id, 'links', True):
-                url = msg.text[ent.offset:ent.offset + ent.length]
-                if not url.startswith('//') and not url.startswith('http'):
-                    url = '//' + url
-                if urlparse(url).netloc.lower() in LINKS_EXCEPTIONS:
-                    continue
-                to_delete = True
-                reason = 'external link'
-                break
-            if ent.type in ('email',) and get_setting(group_config, msg.chat.id, 'emails', True):
-                to_delete = True
-                reason = 'email'
-                break
-            if ent.type == 'mention':
-                username = msg.text[ent.offset:ent.offset + ent.length].lstrip('@')
-                if username.lower() in USERNAME_EXCEPTIONS:
-                    continue
-                user_type = process_user_type(db, username)
-                if user_type == 'group' and get_setting(group_config, msg.chat.id, 'groups', True):
-                    reason = '@-link to group'
-                    to_delete = True
-                    break
-                elif user_type == 'channel' and get_setting(group_config, msg.chat.id, 'channels', True):
-                    reason = '@-link to channel'
-                    to_delete = True
-                    break
-        if not to_delete:
-            mention = re.search(r'(?:^|\W)\@\s([a-zA-Z]+)(?:$|\W)', msg.text)
-            if mention:
-                username = mention.group(1)
-                if username.lower() not in USERNAME_EXCEPTIONS:
-                    user_type = process_user_type(db, username)
-                    if user_type == 'group' and get_setting(group_config, msg.chat.id, 'groups', True):
-                        reason = '@-link to group'
-                        to_delete = True
-                    if user_type == 'channel' and get_setting(group_config, msg.chat.id, 'channels', True):
-                        reason = '@-link to channel'
-                        to_delete = True
-            if (msg.forward_from or msg.forward_from_chat) and get_setting(group_config, msg.chat.id, 'forwarded', True):
-                reason = 'forwarded'
-                to_delete = True
-        if not to_delete:
-            usernames = find_username_links(msg.caption or '')
-            for username in usernames:
-                username = username.lstrip('@')
-                user_type = process_user_type(db, username)
-                if user_type == 'group' and get_setting(group_config, msg.chat.id, 'groups', True):
-                    reason = 'caption @-link to group'
-                    to_delete = True
-                    break
-                elif user_type == 'channel' and get_setting(group_config, msg.chat.id, 'channels', True):
-                    reason = 'caption @-link to channel'
-                    to_delete = True
-                    break
-        if not to_delete:
-            if find_external_links(msg.caption or '') and get_setting(group_config, msg.chat.id, 'links', True):
-                reason = 'caption external link'
-                to_delete = True
-        if to_delete:
-            if msg.from_user.id in [x.user.id for x in bot.get_chat_administrators(msg.chat.id)]:
-                return
-
-            try:
-                save_event(db, 'delete_msg', msg, reason=reason)
-                if msg.from_user.first_name and msg.from_user.last_name:
-                    from_user = '%s %s' % (
-                        msg.from_user.first_name,
-                        msg.from_user.last_name,
+        group = group_config.get(msg.chat.id)
+        settings = group.get_many(CLASSIFY_SETTINGS)
+        UPDATE_LAG_SECONDS.observe(time.time() - (msg.edit_date or msg.date))
+        fingerprint = get_fingerprint(msg)
+        verdict = fingerprints.get(fingerprint, settings, group.allowed_domains)
+        if verdict is None:
+            with timed('classify'):
+                verdict = classifier.classify(msg, settings, resolver.get_types, group.allowed_domains)
+            fingerprints.set(fingerprint, settings, group.allowed_domains, verdict)
+        if verdict.action != 'delete':
+            return
+        if admin_cache.is_admin(msg.chat.id, msg.from_user.id):
+            return
+
+        reason = verdict.reason
+        DELETIONS.inc(reason)
+        try:
+            msg_dump = dump_message(msg, full=full_events)
+            save_event(journal, 'delete_msg', msg_dump, reason=reason)
+            burst = fingerprints.observe(
+                get_fingerprint(msg, normalize=True), msg.chat.id, msg.message_id,
+            )
+            if burst:
+                report_raid(msg, msg_dump, reason, burst)
+            if msg.from_user.first_name and msg.from_user.last_name:
+                from_user = '%s %s' % (
+                    msg.from_user.first_name,
+                    msg.from_user.last_name,
+                )
+            elif msg.from_user.first_name:
+                from_user = msg.from_user.first_name
+            elif msg.from_user.username:
+                from_user = msg.from_user.username
+            else:
+                from_user = '#%d' % msg.from_user.id
+            if group.get('publog', True):
+                # Notify about spam from same user only one time per hour
+                if notify_throttle.allow(msg.chat.id, msg.from_user.id):
+                    ret = 'Removed msg from %s. Reason: %s\nMessages containing links to these websites will not be deleted: steemit.com, golos.io and whaleshares.io' % (
+                        html.escape(from_user), reason,
                     )
-                elif msg.from_user.first_name:
-                    from_user = msg.from_user.first_name
-                elif msg.from_user.username:
-                    from_user = msg.from_user.first_name
-                else:
-                    from_user = '#%d' % msg.from_user.id
-                event_key = (msg.chat.id, msg.from_user.id)
-                if get_setting(group_config, msg.chat.id, 'publog', True):
-                    # Notify about spam from same user only one time per hour
-                    if (
-                            event_key not in delete_events
-                            or delete_events[event_key] < datetime.utcnow() - timedelta(hours=1)
-                        ):
-                        ret = 'Removed msg from %s. Reason: %s\nMessages containing links to these websites will not be deleted: steemit.com, golos.io and whaleshares.io'
-                        bot.send_message(msg.chat.id, ret, parse_mode='HTML')
-                delete_events[event_key] = datetime.utcnow()
-
-                ids = set()
-                channel_id = get_setting(group_config, msg.chat.id, 'log_channel_id')
-                if channel_id:
-                    ids.add(channel_id)
-                for chid in ids:
-                    formats = get_setting(group_config, chid, 'logformat', default=['simple'])
-                    from_chatname = (
-                        '@%s' % msg.chat.username if msg.chat.username
-                        else '#%d' % msg.chat.id
+                    transport.submit(
+                        'notify', msg.chat.id, bot.send_message,
+                        msg.chat.id, ret, parse_mode='HTML',
                     )
-                    if msg.from_user.username:
-                        from_username = '@%s [%s]' % (
-                            msg.from_user.username,
-                            msg.from_user.first_name
-                        )
-                    else:
-                        from_username = msg.from_user.first_name
-                    from_info = (
-                        'Chat: %s\nUser: <a href="tg://user?id=%d">%s</a>'
-                        % (from_chatname, msg.from_user.id, from_username)
+
+            ids = set()
+            channel_id = group.get('log_channel_id')
+            if channel_id:
+                ids.add(channel_id)
+            for chid in ids:
+                formats = group_config.get(chid).get('logformat', ['simple'])
+                from_chatname = (
+                    '@%s' % msg.chat.username if msg.chat.username
+                    else '#%d' % msg.chat.id
+                )
+                if msg.from_user.username:
+                    from_username = '@%s [%s]' % (
+                        msg.from_user.username,
+                        msg.from_user.first_name
                     )
-                    try:
-                        if 'forward' in formats:
-                            bot.forward_message(chid, msg.chat.id, msg.message_id)
-                        if 'json' in formats:
-                            msg_dump = dump_telegram_object(msg)
-                            msg_dump['meta'] = {
-                                'reason': reason,
-                                'date': datetime.utcnow(),
-                            }
-                            dump = jsondate.dumps(msg_dump, indent=4, ensure_ascii=False)
-                            dump = html.escape(dump)
-                            content = (
-                                '%s\n<pre>%s</pre>' % (from_info, dump),
-                            )
-                            bot.send_message(chid, content, parse_mode='HTML')
-                        if 'simple' in formats:
-                            text = html.escape(msg.text or msg.caption)
-                            content = (
-                                '%s\nReason: %s\nContent:\n<pre>%s</pre>'
-                                % (from_info, reason, text)
-                            )
-                            bot.send_message(chid, content, parse_mode='HTML')
-                    except Exception as ex:
-                        logging.error(
-                            'Failed to send notification to channel [%d]' % chid,
-                            exc_info=ex
-                        )
-            finally:
-                bot.delete_message(msg.chat.id, msg.message_id)
+                else:
+                    from_username = msg.from_user.first_name
+                from_info = (
+                    'Chat: %s\nUser: <a href="tg://user?id=%d">%s</a>'
+                    % (from_chatname, msg.from_user.id, html.escape(from_username or ''))
+                )
+                text = msg.text or msg.caption or ''
+                messages = []
+                if 'forward' in formats:
+                    if not log_delivery.forward_now(chid, msg.chat.id, msg.message_id):
+                        # Channel is throttled, fall back to text log
+                        formats = set(formats) | {'simple'}
+                if 'json' in formats:
+                    dump = dict(msg_dump, meta={
+                        'reason': reason,
+                        'date': datetime.utcnow(),
+                    })
+                    dump = jsondate.dumps(dump, indent=4, ensure_ascii=False)
+                    dump = html.escape(dump)
+                    messages.append('%s\n<pre>%s</pre>' % (from_info, dump))
+                if 'simple' in formats:
+                    messages.append(
+                        '%s\nReason: %s\nContent:\n<pre>%s</pre>'
+                        % (from_info, reason, html.escape(text))
+                    )
+                if messages:
+                    log_delivery.add(LogEntry(
+                        chid, from_chatname,
+                        '@%s' % msg.from_user.username if msg.from_user.username
+                        else '#%d' % msg.from_user.id,
+                        reason, text, messages,
+                    ))
+        finally:
+            # Forwarding to log channel above is done synchronously
+            transport.submit(
+                'delete_message', msg.chat.id, bot.delete_message,
+                msg.chat.id, msg.message_id,
+            )
+
+    # With workers=0 updates are handled one by one in the polling thread
+    if config.get('workers', 0):
+        install_dispatcher(
+            bot, config['workers'],
+            queue_size=config.get('queue_size', 100),
+            put_timeout=config.get('queue_put_timeout'),
+        )
+    components = {
+        'admin_cache': admin_cache,
+        'resolver': resolver,
+        'journal': journal,
+        'log_delivery': log_delivery,
+        'group_config': group_config,
+        'notify_throttle': notify_throttle,
+        'fingerprints': fingerprints,
+        'join_guard': join_guard,
+        'transport': transport,
+    }
+    if getattr(bot, 'dispatcher', None):
+        components['dispatcher'] = bot.dispatcher
+    add_stats_gauges('graphenebot_component_stat', components)
     return bot
 
 
-def poll(bot):
-    while True:
+def poll(bot, db, config):
+    poller = UpdatePoller(
+        bot, db,
+        timeout=config.get('poll_timeout', 20),
+        limit=config.get('poll_limit', 100),
+        backoff=config.get('poll_backoff', 1),
+        max_backoff=config.get('poll_max_backoff', 60),
+        allowed_updates=ALLOWED_UPDATES,
+    )
+    poller.install_signal_handlers()
+    try:
+        poller.run()
+    finally:
+        # Queued updates are handled before exit
+        shutdown(bot)
+        poller.save_offset()
+
+
+def shutdown(bot):
+    if getattr(bot, 'dispatcher', None):
+        bot.dispatcher.stop()
+    # Ingest bot of sharded mode has no pipeline components
+    for name in ('join_guard', 'log_delivery', 'transport', 'journal', 'group_config'):
+        component = getattr(bot, name, None)
+        if component is not None:
+            component.close()
+    if getattr(bot, 'snapshot_path', None):
+        try:
+            save_snapshot(bot.snapshot_path, get_snapshot_components(bot))
+        except OSError:
+            logging.exception('Failed to save cache snapshot')
+
+
+def get_snapshot_components(bot):
+    return dict((name, getattr(bot, name)) for name in SNAPSHOT_COMPONENTS)
+
+
+def load_caches(bot, path):
+    """
+    Warm caches from snapshot saved by previous run, the snapshot is
+    written to `path` again on shutdown.
+    """
+    bot.snapshot_path = path
+    count = load_snapshot(path, get_snapshot_components(bot))
+    if count:
+        logging.info('Loaded %d cache entries from %s' % (count, path))
+
+
+def run_shard_worker(idx, queue, counters, token, config):
+    # Coordinator stops workers itself after Ctrl-C or SIGTERM, restarts
+    # them on HUP
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGHUP):
+        signal.signal(signum, signal.SIG_IGN)
+    setup_logging(config)
+    if config.get('metrics_port'):
+        start_metrics_server(
+            config.get('metrics_host', '127.0.0.1'), config['metrics_port'] + 1 + idx,
+        )
+    # Each worker spills and replays its own events
+    spill_path = config.get('event_spill_path', EVENT_SPILL_PATH)
+    bot = create_bot(token, MongoClient()['graphene'], dict(
+        config, event_spill_path='%s.%d' % (spill_path, idx),
+    ))
+    snapshot_path = config.get('cache_snapshot_path', CACHE_SNAPSHOT_PATH)
+    if snapshot_path:
+        load_caches(bot, '%s.%d' % (snapshot_path, idx))
+    try:
+        serve_shard(
+            queue, counters,
+            lambda data: bot.process_new_updates([Update.de_json(data)]),
+        )
+    finally:
+        shutdown(bot)
+
+
+def run_sharded(token, db, config, mode, timer=None):
+    """
+    Receive updates in this process and handle them in `processes`
+    worker processes, each chat always in the same one.
+    """
+    coordinator = ShardCoordinator(
+        run_shard_worker, args=(token, config),
+        processes=config['processes'],
+        queue_size=config.get('shard_queue_size', 1000),
+        put_timeout=config.get('queue_put_timeout', 5 if mode == 'webhook' else None),
+        report_interval=config.get('shard_report_interval', 60),
+    )
+    add_stats_gauges('graphenebot_component_stat', {'shards': coordinator})
+
+    def handle_hup(signum, frame):
+        logging.info('Restarting shard workers')
+        Thread(
+            target=coordinator.restart, args=((token, load_config()),), daemon=True,
+        ).start()
+
+    signal.signal(signal.SIGHUP, handle_hup)
+    bot = telebot.TeleBot(token, threaded=False)
+    bot.dispatcher = coordinator
+    if timer:
+        # Updates are queued while workers start
+        timer.mark_ready(config.get('startup_budget', 5))
+    if mode == 'webhook':
+        serve_webhook(bot, config)
+    else:
+        poll(bot, db, config)
+
+
+def get_webhook_secret(config):
+    """
+    Secret token Telegram sends with webhook requests. Generated on every
+    start if the bot sets its webhook itself (`webhook_url`).
+    """
+    if config.get('webhook_secret'):
+        return config['webhook_secret']
+    if config.get('webhook_url'):
+        return secrets.token_urlsafe(32)
+    raise ValueError('webhook_secret or webhook_url has to be configured in webhook mode')
+
+
+def serve_webhook(bot, config):
+    secret = get_webhook_secret(config)
+    if not getattr(bot, 'dispatcher', None):
+        # Updates have to be queued to answer webhook requests at once
+        install_dispatcher(
+            bot, 1,
+            queue_size=config.get('queue_size', 100),
+            put_timeout=config.get('queue_put_timeout', 5),
+        )
+    server = WebhookServer(
+        bot,
+        host=config.get('webhook_host', '127.0.0.1'),
+        port=config.get('webhook_port', 8443),
+        path=config.get('webhook_path', '/webhook'),
+        secret=secret,
+    )
+    if config.get('webhook_url'):
+        bot.set_webhook(
+            url=config['webhook_url'],
+            secret_token=secret,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+
+    def handle_term(signum, frame):
+        raise KeyboardInterrupt()
+
+    # Stop accepting requests and handle queued updates, Telegram delivers
+    # updates posted meanwhile again
+    signal.signal(signal.SIGTERM, handle_term)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        shutdown(bot)
+
+
+def load_config():
+    with open('var/config.json') as inp:
+        return json.load(inp)
+
+
+def setup_logging(config):
+    # Anything logged before (e.g. on import) sets up the root logger with
+    # default level, which has to be replaced
+    logging.basicConfig(
+        level=getattr(logging, config.get('log_level', 'INFO').upper()),
+        format='%(asctime)s %(processName)s %(levelname)s %(message)s',
+        force=True,
+    )
+    if config.get('metrics_log_interval'):
+        start_log_summary(config['metrics_log_interval'])
+
+
+def ensure_indexes(db, config):
+    db.user.create_index('username', unique=True)
+    db.config.create_index([('group_id', 1), ('key', 1)])
+    db.config_version.create_index('date')
+    stats.ensure_indexes(db)
+    throttle.ensure_indexes(db, config.get('notify_window', 3600))
+    retention.ensure_indexes(db, config.get('event_retention_days', 365))
+
+
+def start_index_build(db, config, timer):
+    """
+    Create indexes in background thread: they exist after the first
+    run, and building new ones could take long.
+    """
+    def build():
         try:
-            bot.polling()
-        except KeyboardInterrupt:
-            break
-        except:
-            poll(bot)
+            with timer.phase('indexes'):
+                ensure_indexes(db, config)
+        except Exception:
+            logging.exception('Failed to create indexes')
+            return
+        logging.info('Indexes are ready in %.3fs' % timer.phases['indexes'])
+
+    Thread(target=build, name='indexes', daemon=True).start()
 
 
 def main():
+    timer = StartupTimer()
     parser = ArgumentParser()
-    parser.add_argument('--mode')
+    parser.add_argument('--mode', choices=['polling', 'webhook', 'test'],
+                        default='polling',
+                        help='"test" is polling with test_api_token')
+    parser.add_argument('--test-token', action='store_true',
+                        help='use test_api_token from config')
+    parser.add_argument('--backfill-stat', action='store_true',
+                        help='rebuild /stat counters from events and exit')
+    parser.add_argument('--maintenance', action='store_true',
+                        help='report size and index usage of collections and exit')
     opts = parser.parse_args()
-    logging.basicConfig(level=logging.DEBUG)
-    with open('var/config.json') as inp:
-        config = json.load(inp)
-    if opts.mode == 'test':
+    with timer.phase('config'):
+        config = load_config()
+        setup_logging(config)
+    if config.get('metrics_port'):
+        start_metrics_server(config.get('metrics_host', '127.0.0.1'), config['metrics_port'])
+    add_stats_gauges('graphenebot_startup_seconds', {'startup': timer})
+    if opts.mode == 'test' or opts.test_token:
         token = config['test_api_token']
     else:
         token = config['api_token']
+    # MongoClient connects in background, the first query waits for it
     db = MongoClient()['graphene']
-    db.user.create_index('username', unique=True)
-    bot = create_bot(token, db)
-    poll(bot)
+    if opts.backfill_stat or opts.maintenance:
+        ensure_indexes(db, config)
+        if opts.backfill_stat:
+            stats.backfill(db)
+        else:
+            for line in retention.maintenance_report(db):
+                print(line)
+        return
+    start_index_build(db, config, timer)
+    if config.get('event_full_days', 30):
+        compactor = EventCompactor(
+            db, full_days=config.get('event_full_days', 30),
+            interval=config.get('event_compaction_interval', 3600),
+        )
+        add_stats_gauges('graphenebot_maintenance_stat', {'compactor': compactor})
+    if config.get('processes'):
+        run_sharded(token, db, config, opts.mode, timer)
+        return
+    with timer.phase('create_bot'):
+        bot = create_bot(token, db, config)
+    snapshot_path = config.get('cache_snapshot_path', CACHE_SNAPSHOT_PATH)
+    if snapshot_path:
+        with timer.phase('load_caches'):
+            load_caches(bot, snapshot_path)
+    timer.mark_ready(config.get('startup_budget', 5))
+    if opts.mode == 'webhook':
+        serve_webhook(bot, config)
+    else:
+        poll(bot, db, config)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,158 @@
+import logging
+from collections import Counter
+from datetime import datetime, timedelta
+from threading import Thread, Event, Lock
+
+from pymongo.errors import PyMongoError
+
+from cache import TTLCache
+from domains import compile_domains
+from metrics import timed
+
+# List of keys allowed to use in GroupConfigStore.set/GroupConfig.get
+GROUP_SETTING_KEYS = ('publog', 'log_channel_id', 'logformat', 'channels', 'groups', 'links', 'forwarded', 'emails', 'kick', 'allowed_domains')
+# Extra seconds polled back in time to cover clock difference between hosts
+CLOCK_SKEW = 60
+
+
+class GroupConfig(object):
+    """
+    Settings of one group. `allowed_domains` is compiled once on load.
+    """
+    __slots__ = ('values', 'allowed_domains')
+
+    def __init__(self, values):
+        self.values = values
+        self.allowed_domains = compile_domains(values.get('allowed_domains') or ())
+
+    def get(self, key, default=None):
+        assert key in GROUP_SETTING_KEYS
+        return self.values.get(key, default)
+
+    def get_many(self, defaults):
+        return dict(
+            (key, self.get(key, default))
+            for key, default in defaults.items()
+        )
+
+
+class GroupConfigStore(object):
+    """
+    Per-group settings stored in `config` collection, loaded on first
+    access to the group. Up to `maxsize` recently used groups are kept in
+    memory for `ttl` seconds.
+
+    Every change bumps the group's document in `config_version`
+    collection. With `watch` enabled, background thread follows that
+    collection with change stream (or polls it every `poll_interval`
+    seconds if the server does not support change streams) and drops
+    groups changed by other processes.
+    """
+
+    def __init__(self, db, maxsize=10000, ttl=3600, poll_interval=5, watch=True):
+        self.db = db
+        self.cache = TTLCache(ttl=ttl, maxsize=maxsize)
+        self.poll_interval = poll_interval
+        self.counters = Counter()
+        self.mode = None
+        # Incremented on every invalidation, so that group loaded while
+        # being changed is not cached
+        self._epoch = 0
+        self._versions = {}
+        self._lock = Lock()
+        self._stop = Event()
+        self.thread = None
+        if watch:
+            self.thread = Thread(target=self._watch, name='groupconfig', daemon=True)
+            self.thread.start()
+
+    def get(self, group_id):
+        config = self.cache.get(group_id)
+        if config is None:
+            config = self._load(group_id)
+        return config
+
+    def _load(self, group_id):
+        epoch = self._epoch
+        with timed('mongo_read'):
+            values = dict(
+                (x['key'], x['value'])
+                for x in self.db.config.find({'group_id': group_id})
+            )
+        config = GroupConfig(values)
+        self.counters['loads'] += 1
+        if epoch == self._epoch:
+            self.cache.set(group_id, config)
+        return config
+
+    def set(self, group_id, key, val):
+        assert key in GROUP_SETTING_KEYS
+        with timed('mongo_write'):
+            self.db.config.find_one_and_update(
+                {
+                    'group_id': group_id,
+                    'key': key,
+                },
+                {'$set': {'value': val}},
+                upsert=True,
+            )
+            self.db.config_version.update_one(
+                {'_id': group_id},
+                {'$inc': {'version': 1}, '$set': {'date': datetime.utcnow()}},
+                upsert=True,
+            )
+        self.invalidate(group_id)
+
+    def invalidate(self, group_id):
+        with self._lock:
+            self._epoch += 1
+        self.cache.delete(group_id)
+        self.counters['invalidations'] += 1
+
+    def _watch(self):
+        try:
+            self._follow_changes()
+        except PyMongoError as ex:
+            logging.info('Polling config versions, change stream failed: %s' % ex)
+            # Changes could be missed while the stream was failing
+            self.cache.clear()
+        self.mode = 'poll'
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.poll()
+            except PyMongoError:
+                logging.exception('Failed to poll config versions')
+
+    def _follow_changes(self):
+        with self.db.config_version.watch(max_await_time_ms=1000) as stream:
+            self.mode = 'change_stream'
+            while not self._stop.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    self.invalidate(change['documentKey']['_id'])
+
+    def poll(self):
+        """
+        Drop groups whose version changed since previous poll.
+        """
+        since = datetime.utcnow() - timedelta(seconds=self.poll_interval + CLOCK_SKEW)
+        with timed('mongo_read'):
+            versions = dict(
+                (x['_id'], x['version'])
+                for x in self.db.config_version.find({'date': {'$gte': since}})
+            )
+        for group_id, version in versions.items():
+            if self._versions.get(group_id) != version:
+                self.invalidate(group_id)
+        self._versions = versions
+
+    def close(self):
+        self._stop.set()
+        if self.thread:
+            self.thread.join(timeout=self.poll_interval + 2)
+
+    def stats(self):
+        ret = self.cache.stats()
+        ret.update(self.counters)
+        ret['mode'] = self.mode
+        return ret
@@ -0,0 +1,261 @@
+import logging
+import time
+from collections import deque, Counter
+from datetime import datetime
+from threading import Thread, Condition
+
+from cache import TTLCache
+from metrics import timed, JOIN_WAVES
+from serialize import dump_value
+from util import RateLimiter, get_retry_after
+
+# Bot API accepts up to 100 ids in one deleteMessages call
+DELETE_BATCH = 100
+
+
+class JoinWave(object):
+    __slots__ = (
+        'chat', 'started', 'started_date', 'joins', 'kicks', 'deletes',
+        'kicked', 'deleted', 'failed', 'scheduled', 'busy', 'retries',
+    )
+
+    def __init__(self, chat):
+        self.chat = chat
+        self.started = time.monotonic()
+        self.started_date = datetime.utcnow()
+        self.joins = 0
+        # User ids to kick and ids of join messages to delete
+        self.kicks = deque()
+        self.deletes = deque()
+        self.kicked = 0
+        self.deleted = 0
+        self.failed = 0
+        self.scheduled = False
+        self.busy = False
+        # Rate limited attempts of the action being performed
+        self.retries = 0
+
+    def pending(self):
+        return len(self.kicks) + len(self.deletes)
+
+
+class JoinWaveGuard(object):
+    """
+    Detects join waves: `threshold` joins to the chat within `window`
+    seconds. During the wave joins are not handled one by one: kicks and
+    deletions of join messages are queued and performed by background
+    thread at `action_rate` calls per second in total, deletions are
+    batched. Chats with waves are served in turn, kicks go before
+    deletions. Rate limited action is repeated up to `max_attempts` times.
+
+    The wave ends when the chat gets fewer than `exit_threshold` joins
+    within `window` and its queue is done, then it is recorded as one
+    `join_wave` event.
+    """
+
+    def __init__(self, bot, journal, threshold=20, window=60, exit_threshold=5,
+                 action_rate=(20, 1), delete_joins=True, max_queue=10000,
+                 maxsize=10000, check_interval=1, max_attempts=3):
+        self.bot = bot
+        self.journal = journal
+        self.threshold = threshold
+        self.window = window
+        self.exit_threshold = exit_threshold
+        self.delete_joins = delete_joins
+        self.max_queue = max_queue
+        self.check_interval = check_interval
+        self.max_attempts = max_attempts
+        self.limiter = RateLimiter(*action_rate)
+        # Times of the last `threshold` joins of recently joined chats
+        self.joins = TTLCache(ttl=window, maxsize=maxsize)
+        self.waves = {}
+        self.counters = Counter()
+        self.running = True
+        # Time after which queued actions are dropped, set on close
+        self.deadline = None
+        self._ready = deque()
+        self._cond = Condition()
+        self.thread = Thread(target=self._worker, name='joinwave', daemon=True)
+        self.thread.start()
+
+    def observe(self, chat, message_id, joins, kick_ids):
+        """
+        Count `joins` to the chat. Return True if the chat has a wave,
+        then the guard kicks `kick_ids` and deletes the join message.
+        """
+        now = time.monotonic()
+        with self._cond:
+            times = self.joins.get(chat.id)
+            if times is None:
+                times = deque(maxlen=self.threshold)
+            times.extend([now] * joins)
+            self.joins.set(chat.id, times)
+            wave = self.waves.get(chat.id)
+            if wave is None:
+                if len(times) < self.threshold or now - times[0] > self.window:
+                    return False
+                wave = self.waves[chat.id] = JoinWave(chat)
+                self.counters['waves'] += 1
+                JOIN_WAVES.inc()
+                logging.warning('Join wave in chat %d: %d joins within %.0fs' % (
+                    chat.id, len(times), now - times[0],
+                ))
+            wave.joins += joins
+            wave.kicks.extend(kick_ids)
+            if self.delete_joins:
+                wave.deletes.append(message_id)
+            while wave.pending() > self.max_queue and wave.deletes:
+                wave.deletes.popleft()
+                self.counters['dropped'] += 1
+            self._schedule(wave)
+            self._cond.notify()
+        return True
+
+    def _schedule(self, wave):
+        if not wave.scheduled and not wave.busy and wave.pending():
+            wave.scheduled = True
+            self._ready.append(wave)
+
+    def _recent_joins(self, chat_id, now):
+        times = self.joins.get(chat_id) or ()
+        return sum(1 for x in times if now - x <= self.window)
+
+    def _end_waves(self, force=False):
+        now = time.monotonic()
+        for chat_id, wave in list(self.waves.items()):
+            if wave.busy or wave.pending():
+                continue
+            if not force and self._recent_joins(chat_id, now) >= self.exit_threshold:
+                continue
+            del self.waves[chat_id]
+            self._record(wave, now)
+
+    def _record(self, wave, now):
+        logging.warning(
+            'Join wave in chat %d ended: %d joins in %.0fs, %d kicked, %d deleted, %d failed' % (
+                wave.chat.id, wave.joins, now - wave.started, wave.kicked,
+                wave.deleted, wave.failed,
+            )
+        )
+        self.journal.add({
+            'type': 'join_wave',
+            'date': datetime.utcnow(),
+            'chat': dump_value(wave.chat),
+            'started': wave.started_date,
+            'duration': now - wave.started,
+            'joins': wave.joins,
+            'kicked': wave.kicked,
+            'deleted': wave.deleted,
+            'failed': wave.failed,
+        })
+
+    def _drop_pending(self):
+        for wave in self.waves.values():
+            self.counters['dropped'] += wave.pending()
+            wave.kicks.clear()
+            wave.deletes.clear()
+            wave.scheduled = False
+        self._ready.clear()
+
+    def _take(self):
+        """
+        Return the next (wave, method, arg) to call or None.
+        """
+        if not self._ready:
+            return None
+        wave = self._ready.popleft()
+        wave.scheduled = False
+        wave.busy = True
+        if wave.kicks:
+            return wave, 'kick', wave.kicks.popleft()
+        ids = []
+        while wave.deletes and len(ids) < DELETE_BATCH:
+            ids.append(wave.deletes.popleft())
+        return wave, 'delete', ids
+
+    def _call(self, wave, method, arg):
+        chat_id = wave.chat.id
+        try:
+            if method == 'kick':
+                with timed('kick_chat_member'):
+                    self.bot.kick_chat_member(chat_id=chat_id, user_id=arg)
+            else:
+                with timed('delete_messages'):
+                    self.bot.delete_messages(chat_id, arg)
+        except Exception as ex:
+            retry_after = get_retry_after(ex)
+            if retry_after:
+                self.limiter.pause(retry_after)
+                return False
+            logging.error('Failed to %s in chat %d: %s' % (method, chat_id, ex))
+            wave.failed += 1
+            self.counters['failed'] += 1
+        else:
+            if method == 'kick':
+                wave.kicked += 1
+                self.counters['kicked'] += 1
+            else:
+                wave.deleted += len(arg)
+                self.counters['deleted'] += len(arg)
+        return True
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                if self.deadline is not None and time.monotonic() >= self.deadline:
+                    self._drop_pending()
+                self._end_waves()
+                task = self._take()
+                if task is None:
+                    if not self.running:
+                        self._end_waves(force=True)
+                        return
+                    self._cond.wait(self.check_interval)
+                    continue
+            wave, method, arg = task
+            self.limiter.acquire()
+            done = self._call(wave, method, arg)
+            with self._cond:
+                if done:
+                    wave.retries = 0
+                elif wave.retries + 1 < self.max_attempts:
+                    # Rate limited, call again after the pause
+                    wave.retries += 1
+                    self.counters['retried'] += 1
+                    if method == 'kick':
+                        wave.kicks.appendleft(arg)
+                    else:
+                        wave.deletes.extendleft(reversed(arg))
+                else:
+                    logging.error('Failed to %s in chat %d: still rate limited' % (
+                        method, wave.chat.id,
+                    ))
+                    wave.retries = 0
+                    wave.failed += 1
+                    self.counters['failed'] += 1
+                wave.busy = False
+                self._schedule(wave)
+
+    def queue_depth(self):
+        return sum(x.pending() for x in list(self.waves.values()))
+
+    def close(self, timeout=10):
+        """
+        Perform queued actions and stop. Actions left after `timeout`
+        seconds are dropped.
+        """
+        with self._cond:
+            self.running = False
+            self.deadline = time.monotonic() + timeout
+            self._cond.notify()
+        self.thread.join(timeout + 1)
+        if self.thread.is_alive():
+            # Stuck in a call or waiting for the rate limit
+            with self._cond:
+                self._drop_pending()
+
+    def stats(self):
+        ret = dict(self.counters)
+        ret['active'] = len(self.waves)
+        ret['queue_depth'] = self.queue_depth()
+        return ret
@@ -0,0 +1,173 @@
+import logging
+import os
+import time
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+
+from bson import ObjectId, json_util
+from pymongo.errors import PyMongoError, BulkWriteError
+
+import stats
+from metrics import timed
+
+DUPLICATE_KEY_ERROR = 11000
+_STOP = object()
+
+
+class EventJournal(object):
+    """
+    Write-behind sink of `event` documents.
+
+    Events are queued in memory and saved by background thread with
+    `insert_many` once `batch_size` events are queued or `flush_interval`
+    seconds passed. Events which could not be saved to Mongo are appended
+    to `spill_path` file and inserted again on next start.
+
+    Every event gets its `_id` before it is queued, so events inserted
+    twice (e.g. partially saved batch replayed from spill file) are
+    detected and skipped.
+    """
+
+    def __init__(self, db, batch_size=100, flush_interval=1.0,
+                 queue_size=10000, spill_path='var/run/event_spill.jsonl'):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self.queue = Queue(maxsize=queue_size)
+        self.saved = 0
+        self.spilled = 0
+        self._spill_lock = Lock()
+        self.thread = Thread(target=self._worker, name='journal', daemon=True)
+        self.thread.start()
+
+    def add(self, event):
+        event.setdefault('_id', ObjectId())
+        try:
+            self.queue.put_nowait(event)
+        except Full:
+            logging.error('Event queue is full, spilling event to disk')
+            self.spill([event])
+
+    def _worker(self):
+        # Spilled events are saved in background, so that they do not
+        # delay startup
+        try:
+            self.replay()
+        except Exception:
+            logging.exception('Failed to replay spilled events')
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    event = self.queue.get(timeout=timeout)
+                except Empty:
+                    break
+                if event is _STOP:
+                    stopping = True
+                    break
+                batch.append(event)
+            if batch:
+                self.flush(batch)
+
+    def _insert(self, events):
+        """
+        Insert `events` ignoring ones already saved, return list of
+        actually inserted events.
+        """
+        try:
+            with timed('mongo_write'):
+                self.db.event.insert_many(events, ordered=False)
+        except BulkWriteError as ex:
+            errors = ex.details.get('writeErrors', [])
+            if any(x['code'] != DUPLICATE_KEY_ERROR for x in errors):
+                raise
+            failed = set(x['index'] for x in errors)
+            return [x for idx, x in enumerate(events) if idx not in failed]
+        return events
+
+    def flush(self, events):
+        try:
+            inserted = self._insert(events)
+        except PyMongoError:
+            logging.exception('Failed to save %d events' % len(events))
+            self.spill(events)
+            return False
+        self.saved += len(inserted)
+        try:
+            with timed('mongo_write'):
+                stats.record_events(self.db, inserted)
+        except PyMongoError:
+            logging.exception('Failed to update deletion counters')
+        return True
+
+    def spill(self, events):
+        with self._spill_lock:
+            dirname = os.path.dirname(self.spill_path)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(self.spill_path, 'a') as out:
+                for event in events:
+                    out.write(json_util.dumps(event) + '\n')
+                out.flush()
+                os.fsync(out.fileno())
+            self.spilled += len(events)
+
+    def replay(self):
+        """
+        Save events spilled to disk by previous runs.
+        """
+        with self._spill_lock:
+            if not os.path.exists(self.spill_path):
+                return 0
+            # Move file away first: events failing again are spilled
+            # into the new file
+            replay_path = '%s.replay' % self.spill_path
+            if not os.path.exists(replay_path):
+                os.rename(self.spill_path, replay_path)
+        count = 0
+        batch = []
+        with open(replay_path) as inp:
+            for line in inp:
+                if not line.strip():
+                    continue
+                batch.append(json_util.loads(line))
+                if len(batch) >= self.batch_size:
+                    self.flush(batch)
+                    count += len(batch)
+                    batch = []
+        if batch:
+            self.flush(batch)
+            count += len(batch)
+        os.unlink(replay_path)
+        logging.info('Replayed %d spilled events' % count)
+        return count
+
+    def close(self):
+        """
+        Save all queued events and stop background thread.
+        """
+        self.queue.put(_STOP)
+        self.thread.join()
+        rest = []
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except Empty:
+                break
+            if event is not _STOP:
+                rest.append(event)
+        if rest:
+            self.flush(rest)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'saved': self.saved,
+            'spilled': self.spilled,
+        }
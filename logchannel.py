@@ -0,0 +1,250 @@
+import html
+import logging
+import time
+from collections import deque, Counter
+from datetime import datetime
+from threading import Thread, Condition
+
+from metrics import timed
+from util import RateLimiter, get_retry_after
+
+# Telegram allows about 20 messages per minute to the same group/channel
+# and about 30 messages per second in total
+CHAT_RATE = (20, 60)
+GLOBAL_RATE = (30, 1)
+DIGEST_TEXT_LENGTH = 30
+MAX_SEND_ATTEMPTS = 3
+
+
+class LogEntry(object):
+    """
+    Record about one deleted message to be delivered to log channel.
+
+    `messages` is a list of HTML texts to send one by one, the short fields
+    are used to render the digest of many entries.
+    """
+
+    def __init__(self, channel_id, chat_label, user_label, reason, text,
+                 messages, date=None):
+        self.channel_id = channel_id
+        self.chat_label = chat_label
+        self.user_label = user_label
+        self.reason = reason
+        self.text = text
+        self.messages = list(messages)
+        self.date = date or datetime.utcnow()
+        self.attempts = 0
+
+
+def format_digest(entries, now=None):
+    now = now or datetime.utcnow()
+    span = max(1, int((now - min(x.date for x in entries)).total_seconds()))
+    chats = Counter(x.chat_label for x in entries)
+    lines = [
+        '%d messages removed from %s in last %ds' % (num, html.escape(label), span)
+        for label, num in chats.most_common()
+    ]
+    rows = []
+    for entry in entries:
+        text = ' '.join((entry.text or '').split())
+        if len(text) > DIGEST_TEXT_LENGTH:
+            text = text[:DIGEST_TEXT_LENGTH - 1] + '…'
+        rows.append('%s %s | %s | %s' % (
+            entry.date.strftime('%H:%M:%S'),
+            entry.user_label, entry.reason, text,
+        ))
+    return '%s\n<pre>%s</pre>' % ('\n'.join(lines), html.escape('\n'.join(rows)))
+
+
+class LogDelivery(object):
+    """
+    Delivers log entries to log channels from background thread.
+
+    Sending follows per-channel and global rate limits and waits for
+    `retry_after` seconds when Telegram responds with 429. When more than
+    `digest_threshold` entries are waiting for the channel, up to
+    `digest_size` of them are merged into one digest message.
+    """
+
+    def __init__(self, bot, chat_rate=CHAT_RATE, global_rate=GLOBAL_RATE,
+                 digest_threshold=5, digest_size=50, max_queue=10000):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.global_limiter = RateLimiter(*global_rate)
+        self.digest_threshold = digest_threshold
+        self.digest_size = digest_size
+        self.max_queue = max_queue
+        self.queues = {}
+        self.limiters = {}
+        self.counters = Counter()
+        self.running = True
+        self._cond = Condition()
+        self.thread = Thread(target=self._worker, name='logchannel', daemon=True)
+        self.thread.start()
+
+    def _get_limiter(self, channel_id):
+        if channel_id not in self.limiters:
+            self.limiters[channel_id] = RateLimiter(*self.chat_rate)
+        return self.limiters[channel_id]
+
+    def add(self, entry):
+        with self._cond:
+            queue = self.queues.setdefault(entry.channel_id, deque())
+            if len(queue) >= self.max_queue:
+                queue.popleft()
+                self.counters['dropped'] += 1
+            queue.append(entry)
+            self._cond.notify()
+
+    def forward_now(self, channel_id, chat_id, message_id):
+        """
+        Forward message synchronously (it is going to be deleted right
+        after), if rate limits of the channel allow it. Return False if
+        forwarding has been skipped or failed.
+        """
+        if self.queues.get(channel_id):
+            # Backlog is building up, the message goes into digest
+            self.counters['forward_skipped'] += 1
+            return False
+        limiter = self._get_limiter(channel_id)
+        if not limiter.try_acquire():
+            self.counters['forward_skipped'] += 1
+            return False
+        self.global_limiter.acquire()
+        try:
+            with timed('log_forward'):
+                self.bot.forward_message(channel_id, chat_id, message_id)
+        except Exception as ex:
+            retry_after = get_retry_after(ex)
+            if retry_after:
+                limiter.pause(retry_after)
+            logging.error(
+                'Failed to forward message to channel [%d]' % channel_id,
+                exc_info=ex
+            )
+            self.counters['failed'] += 1
+            return False
+        self.counters['forwarded'] += 1
+        return True
+
+    def queue_depth(self):
+        return sum(len(x) for x in self.queues.values())
+
+    def _next_channel(self):
+        """
+        Return channel which could be sent to now, or number of seconds
+        to wait.
+        """
+        wait = None
+        for channel_id, queue in self.queues.items():
+            if not queue:
+                continue
+            delay = self._get_limiter(channel_id).delay()
+            if delay <= 0:
+                return channel_id, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                channel_id, wait = self._next_channel()
+                while channel_id is None:
+                    if not self.running and wait is None:
+                        return
+                    self._cond.wait(wait)
+                    channel_id, wait = self._next_channel()
+                queue = self.queues[channel_id]
+                if len(queue) > self.digest_threshold:
+                    batch = [
+                        queue.popleft()
+                        for _ in range(min(len(queue), self.digest_size))
+                    ]
+                else:
+                    batch = [queue[0]]
+            if len(batch) > 1:
+                self._send_digest(channel_id, batch)
+            else:
+                self._send_entry(channel_id, batch[0])
+
+    def _send(self, channel_id, text):
+        """
+        Send message, return 'sent', 'retry' if sending should be retried
+        or 'failed'.
+        """
+        limiter = self._get_limiter(channel_id)
+        limiter.acquire()
+        self.global_limiter.acquire()
+        try:
+            with timed('log_send'):
+                self.bot.send_message(channel_id, text, parse_mode='HTML')
+        except Exception as ex:
+            retry_after = get_retry_after(ex)
+            if retry_after:
+                self.counters['throttled'] += 1
+                limiter.pause(retry_after)
+                return 'retry'
+            logging.error(
+                'Failed to send notification to channel [%d]' % channel_id,
+                exc_info=ex
+            )
+            self.counters['failed'] += 1
+            return 'failed'
+        return 'sent'
+
+    def _send_entry(self, channel_id, entry):
+        done = True
+        while entry.messages:
+            result = self._send(channel_id, entry.messages[0])
+            if result != 'retry':
+                # Failed message is not sent again, the next ones are
+                entry.messages.pop(0)
+                if result == 'sent':
+                    self.counters['sent'] += 1
+            else:
+                entry.attempts += 1
+                done = entry.attempts >= MAX_SEND_ATTEMPTS
+                if done:
+                    self.counters['dropped'] += 1
+                break
+        if done or not entry.messages:
+            with self._cond:
+                queue = self.queues[channel_id]
+                if queue and queue[0] is entry:
+                    queue.popleft()
+
+    def _send_digest(self, channel_id, entries):
+        result = self._send(channel_id, format_digest(entries))
+        if result == 'sent':
+            self.counters['digest'] += 1
+            self.counters['digested_entries'] += len(entries)
+            return
+        if result == 'retry':
+            for entry in entries:
+                entry.attempts += 1
+            retried = [x for x in entries if x.attempts < MAX_SEND_ATTEMPTS]
+        else:
+            retried = []
+        self.counters['dropped'] += len(entries) - len(retried)
+        with self._cond:
+            queue = self.queues[channel_id]
+            queue.extendleft(reversed(retried))
+
+    def close(self, timeout=10):
+        """
+        Stop accepting work and wait up to `timeout` seconds for the
+        queued entries to be delivered.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self.queue_depth() and time.monotonic() < deadline:
+                self._cond.wait(0.1)
+            self.running = False
+            self.queues.clear()
+            self._cond.notify()
+        self.thread.join(timeout=max(0, deadline - time.monotonic()) + 1)
+
+    def stats(self):
+        ret = dict(self.counters)
+        ret['queue_depth'] = self.queue_depth()
+        return ret
@@ -0,0 +1,295 @@
+import logging
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Lock, Event
+
+# Upper bounds of histogram buckets, seconds
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0,
+)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(val):
+    return str(val).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (x, escape_label(y)) for x, y in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter(object):
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}
+        self._lock = Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def expose(self):
+        yield '# HELP %s %s' % (self.name, self.doc)
+        yield '# TYPE %s counter' % self.name
+        for label_values, val in sorted(self.values.items()):
+            yield '%s%s %s' % (self.name, format_labels(self.labels, label_values), val)
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'label_values', 'started')
+
+    def __init__(self, histogram, label_values):
+        self.histogram = histogram
+        self.label_values = label_values
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.started, *self.label_values)
+
+
+class Histogram(object):
+    def __init__(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [bucket counts (last one is +Inf), sum]
+        self.series = {}
+        self._lock = Lock()
+
+    def observe(self, value, *label_values):
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][idx] += 1
+            series[1] += value
+
+    def time(self, *label_values):
+        return _Timer(self, label_values)
+
+    def quantile(self, share, *label_values):
+        """
+        Estimate quantile as upper bound of the bucket containing it.
+        """
+        counts = self.series[label_values][0]
+        target = share * sum(counts)
+        total = 0
+        for idx, num in enumerate(counts):
+            total += num
+            if total >= target and num:
+                return self.buckets[idx] if idx < len(self.buckets) else float('inf')
+        return 0.0
+
+    def expose(self):
+        yield '# HELP %s %s' % (self.name, self.doc)
+        yield '# TYPE %s histogram' % self.name
+        with self._lock:
+            series = [(x, list(y[0]), y[1]) for x, y in self.series.items()]
+        for label_values, counts, total in sorted(series):
+            cumulative = 0
+            for bound, num in zip(self.buckets + ('+Inf',), counts):
+                cumulative += num
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    format_labels(self.labels, label_values, ('le', bound)),
+                    cumulative,
+                )
+            labels = format_labels(self.labels, label_values)
+            yield '%s_sum%s %s' % (self.name, labels, total)
+            yield '%s_count%s %d' % (self.name, labels, cumulative)
+
+
+class Registry(object):
+    """
+    Set of metrics plus gauge callbacks evaluated only on scrape.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.gauges = []
+
+    def counter(self, name, doc, labels=()):
+        metric = Counter(name, doc, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, doc, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, doc, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def add_gauge(self, name, doc, func):
+        """
+        `func` returns a number or dict mapping label string
+        (e.g. 'cache="admin"') to a number. Gauge with the same name is
+        replaced.
+        """
+        self.gauges = [x for x in self.gauges if x[0] != name]
+        self.gauges.append((name, doc, func))
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        for name, doc, func in self.gauges:
+            try:
+                val = func()
+            except Exception:
+                logging.exception('Failed to collect %s' % name)
+                continue
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s gauge' % name)
+            if isinstance(val, dict):
+                for labels, num in sorted(val.items()):
+                    lines.append('%s{%s} %s' % (name, labels, num))
+            else:
+                lines.append('%s %s' % (name, val))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    'graphenebot_stage_seconds', 'Duration of processing stages', ('stage',),
+)
+UPDATE_LAG_SECONDS = REGISTRY.histogram(
+    'graphenebot_update_lag_seconds', 'Time between message date and its handling',
+    buckets=(0.5, 1, 2, 5, 10, 30, 60, 300, 3600),
+)
+DELETIONS = REGISTRY.counter(
+    'graphenebot_deletions_total', 'Deleted messages', ('reason',),
+)
+RAIDS = REGISTRY.counter(
+    'graphenebot_raids_total', 'Same content deleted in many chats',
+)
+JOIN_WAVES = REGISTRY.counter(
+    'graphenebot_join_waves_total', 'Mass joins to a chat',
+)
+
+
+def timed(stage):
+    return STAGE_SECONDS.time(stage)
+
+
+class StartupTimer(object):
+    """
+    Durations of startup phases. `ready` is time from the start until
+    updates are taken; phases running in background (e.g. index
+    creation) could finish later.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = OrderedDict()
+        self.ready = None
+
+    @contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    def mark_ready(self, budget=None):
+        self.ready = time.perf_counter() - self.started
+        msg = 'Started in %.3fs: %s' % (self.ready, ', '.join(
+            '%s %.3fs' % item for item in list(self.phases.items())
+        ))
+        if budget and self.ready > budget:
+            logging.warning('%s, over %.1fs budget' % (msg, budget))
+        else:
+            logging.info(msg)
+
+    def stats(self):
+        ret = dict(self.phases)
+        if self.ready is not None:
+            ret['ready'] = self.ready
+        return ret
+
+
+def add_stats_gauges(name, components):
+    """
+    Export numeric items of `component.stats()` dicts as gauges labelled
+    with component name.
+    """
+    def collect():
+        ret = {}
+        for component_name, component in components.items():
+            items = list(component.stats().items())
+            while items:
+                key, val = items.pop()
+                if isinstance(val, dict):
+                    items.extend(('%s_%s' % (key, x), y) for x, y in val.items())
+                elif isinstance(val, list):
+                    items.extend(('%s_%d' % (key, x), y) for x, y in enumerate(val))
+                elif isinstance(val, (int, float)) and not isinstance(val, bool):
+                    ret['component="%s",key="%s"' % (component_name, key)] = val
+        return ret
+    REGISTRY.add_gauge(name, 'Internal counters of bot components', collect)
+
+
+def log_summary(registry=REGISTRY):
+    for metric in registry.metrics:
+        if not isinstance(metric, Histogram):
+            continue
+        with metric._lock:
+            series = sorted((x, list(y[0]), y[1]) for x, y in metric.series.items())
+        for label_values, counts, total in series:
+            num = sum(counts)
+            if not num:
+                continue
+            logging.info('%s%s: count=%d avg=%.1fms p50<=%.1fms p99<=%.1fms' % (
+                metric.name, format_labels(metric.labels, label_values), num,
+                total / num * 1000,
+                metric.quantile(0.5, *label_values) * 1000,
+                metric.quantile(0.99, *label_values) * 1000,
+            ))
+
+
+def start_log_summary(interval, registry=REGISTRY):
+    stop = Event()
+
+    def worker():
+        while not stop.wait(interval):
+            log_summary(registry)
+
+    Thread(target=worker, name='metrics-log', daemon=True).start()
+    return stop
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(host, port, registry=REGISTRY):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
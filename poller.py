@@ -0,0 +1,176 @@
+import logging
+import random
+import signal
+from threading import Event
+
+from pymongo.errors import PyMongoError
+from telebot import apihelper
+from telebot.types import Update
+
+from metrics import timed
+from util import get_retry_after
+
+# Offsets of different bots are kept apart, followed by bot id
+OFFSET_ID = 'update_offset'
+
+
+class StopPolling(BaseException):
+    # Not an Exception, so that it is not caught inside HTTP client
+    pass
+
+
+def get_backoff(failures, base, max_delay):
+    """
+    Exponential delay with jitter: random value between half and full
+    delay, so that restarted instances do not retry in lockstep.
+    """
+    delay = min(max_delay, base * 2 ** (failures - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class UpdatePoller(object):
+    """
+    getUpdates loop passing updates to `bot.dispatcher` (or handling them
+    right away if bot has no dispatcher).
+
+    Offset of the first update not handled yet is saved to `maintenance`
+    collection after every batch, so after restart updates still kept by
+    Telegram are neither handled twice nor skipped. Saved offset is
+    dropped if Telegram returns older updates: it is not of this bot
+    (e.g. the bot was re-created). Failed requests are
+    retried with exponential backoff. Update rejected by the saturated
+    dispatcher is not confirmed: it is fetched again with the following
+    ones after `backoff` seconds. `stop` (called on SIGTERM) ends the
+    loop; the caller is expected to stop the dispatcher, which handles
+    queued updates, and call `save_offset` once more.
+    """
+
+    def __init__(self, bot, db, timeout=20, limit=100, backoff=1, max_backoff=60,
+                 allowed_updates=None):
+        self.bot = bot
+        self.db = db
+        self.timeout = timeout
+        self.limit = limit
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.allowed_updates = allowed_updates
+        self.dispatcher = getattr(bot, 'dispatcher', None)
+        # Next update to fetch and id saved to the db
+        self.offset = None
+        self.saved_offset = None
+        self.failures = 0
+        self.received = 0
+        self.rejected = 0
+        self._polling = False
+        self._stop = Event()
+        self.offset_id = '%s:%s' % (OFFSET_ID, bot.token.partition(':')[0])
+
+    def load_offset(self):
+        try:
+            doc = self.db.maintenance.find_one({'_id': self.offset_id})
+        except PyMongoError:
+            logging.exception('Failed to load update offset')
+            doc = None
+        self.offset = self.saved_offset = doc['offset'] if doc else None
+
+    def save_offset(self):
+        offset = self.offset
+        if self.dispatcher is not None and offset is not None:
+            unfinished = self.dispatcher.unfinished()
+            if unfinished is not None:
+                offset = min(offset, unfinished)
+        if offset is None or offset == self.saved_offset:
+            return
+        try:
+            with timed('mongo_write'):
+                self.db.maintenance.update_one(
+                    {'_id': self.offset_id}, {'$set': {'offset': offset}}, upsert=True,
+                )
+        except PyMongoError:
+            logging.exception('Failed to save update offset')
+            return
+        self.saved_offset = offset
+
+    def fetch(self):
+        self._polling = True
+        try:
+            if self._stop.is_set():
+                raise StopPolling()
+            return apihelper.get_updates(
+                self.bot.token, offset=self.offset, limit=self.limit,
+                timeout=self.timeout, allowed_updates=self.allowed_updates,
+                long_polling_timeout=self.timeout,
+            )
+        finally:
+            self._polling = False
+
+    def handle(self, data):
+        """
+        Return False if the dispatcher could not take the update.
+        """
+        if self.dispatcher is not None:
+            return self.dispatcher.submit_json(data)
+        try:
+            self.bot.process_new_updates([Update.de_json(data)])
+        except Exception:
+            logging.exception('Failed to process update')
+        return True
+
+    def run(self):
+        self.load_offset()
+        while not self._stop.is_set():
+            try:
+                updates = self.fetch()
+            except StopPolling:
+                break
+            except Exception as ex:
+                self.failures += 1
+                delay = max(
+                    get_backoff(self.failures, self.backoff, self.max_backoff),
+                    get_retry_after(ex) or 0,
+                )
+                logging.error('Failed to get updates, retrying in %.1fs: %s' % (delay, ex))
+                self._stop.wait(delay)
+                continue
+            self.failures = 0
+            if self.offset is not None and updates and updates[0]['update_id'] < self.offset:
+                logging.warning('Got update %d below saved offset %d, offset is reset' % (
+                    updates[0]['update_id'], self.offset,
+                ))
+                self.offset = None
+            rejected = False
+            for data in updates:
+                if not self.handle(data):
+                    rejected = True
+                    break
+                self.received += 1
+                self.offset = data['update_id'] + 1
+            self.save_offset()
+            if rejected:
+                self.rejected += 1
+                logging.warning('Dispatcher is saturated, update %d is fetched again' % (
+                    data['update_id'],
+                ))
+                self._stop.wait(self.backoff)
+
+    def stop(self):
+        self._stop.set()
+
+    def handle_signal(self, signum, frame):
+        self.stop()
+        # Abort long poll request, its updates are fetched again on start
+        if self._polling:
+            raise StopPolling()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+
+    def stats(self):
+        return {
+            'offset': self.offset or 0,
+            'saved_offset': self.saved_offset or 0,
+            'received': self.received,
+            'rejected': self.rejected,
+            'failures': self.failures,
+        }
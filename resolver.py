@@ -0,0 +1,223 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from threading import Lock
+
+from cache import TTLCache, SingleFlight
+from metrics import timed
+from util import fetch_user_type
+
+_MISSING = object()
+# Every lookup ends with exactly one of these counters incremented
+LOOKUP_OUTCOMES = (
+    'memory_hit', 'memory_negative_hit', 'db_hit', 'db_negative_hit',
+    'db_expired', 'db_miss',
+)
+
+
+class UserTypeResolver(object):
+    """
+    Resolves @username to its type (user, group, channel) looking through
+    in-process LRU, then the `user` collection, then t.me.
+
+    Failed lookups are cached too, with the shorter `negative_ttl`. Records
+    of `user` collection older than `max_age` are re-fetched from t.me
+    because usernames could be re-registered.
+    """
+
+    def __init__(self, db, fetch=fetch_user_type, maxsize=50000,
+                 ttl=3600, negative_ttl=600, max_age=timedelta(days=30),
+                 fetch_workers=8):
+        self.db = db
+        self.fetch = fetch
+        self.inflight = SingleFlight()
+        if fetch is not None and fetch_workers > 1:
+            self.executor = ThreadPoolExecutor(
+                max_workers=fetch_workers, thread_name_prefix='tme',
+            )
+        else:
+            self.executor = None
+        self.cache = TTLCache(ttl=ttl, maxsize=maxsize)
+        self.negative_ttl = negative_ttl
+        self.max_age = max_age
+        self.counters = {
+            'memory_hit': 0,
+            'memory_negative_hit': 0,
+            'db_hit': 0,
+            'db_negative_hit': 0,
+            'db_expired': 0,
+            'db_miss': 0,
+            'fetch': 0,
+            'fetch_failed': 0,
+        }
+        self._lock = Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.counters[key] += 1
+
+    def _from_memory(self, username):
+        user_type = self.cache.get(username, _MISSING)
+        if user_type is not _MISSING:
+            self._count('memory_hit' if user_type else 'memory_negative_hit')
+        return user_type
+
+    def _from_record(self, username, user):
+        """
+        Check the record of `user` collection, return _MISSING if it is
+        absent or expired.
+        """
+        if not user:
+            self._count('db_miss')
+            return _MISSING
+        age = datetime.utcnow() - (user.get('added') or datetime.min)
+        if user.get('type'):
+            if age < self.max_age:
+                self._count('db_hit')
+                self.cache.set(username, user['type'])
+                return user['type']
+        elif age < timedelta(seconds=self.negative_ttl):
+            self._count('db_negative_hit')
+            self.cache.set(username, None, ttl=self.negative_ttl)
+            return None
+        self._count('db_expired')
+        return _MISSING
+
+    def _resolve(self, username, user):
+        # Concurrent lookups of the same username share one network request
+        return self.inflight.do(username, self._fetch, username, user)
+
+    def _fetch(self, username, user):
+        # The previous call could have finished after this lookup missed
+        # the memory cache
+        user_type = self.cache.get(username, _MISSING)
+        if user_type is not _MISSING:
+            return user_type
+        if self.fetch is None:
+            # Offline mode: trust whatever has been stored
+            user_type = user.get('type') if user else None
+            self.cache.set(username, user_type)
+            return user_type
+        return self.store(username, self.fetch(username), user)
+
+    def get_type(self, username):
+        username = username.lower()
+        user_type = self._from_memory(username)
+        if user_type is not _MISSING:
+            return user_type
+        with timed('mongo_read'):
+            user = self.db.user.find_one({'username': username})
+        user_type = self._from_record(username, user)
+        if user_type is not _MISSING:
+            return user_type
+        return self._resolve(username, user)
+
+    def get_types(self, usernames):
+        """
+        Resolve all `usernames` at once: one db query for names missing in
+        memory, network lookups run in parallel.
+
+        Returns dict mapping lower-cased username to its type.
+        """
+        ret = {}
+        missing = []
+        for username in usernames:
+            username = username.lower()
+            if username in ret or username in missing:
+                continue
+            user_type = self._from_memory(username)
+            if user_type is _MISSING:
+                missing.append(username)
+            else:
+                ret[username] = user_type
+        if not missing:
+            return ret
+
+        records = {}
+        with timed('mongo_read'):
+            if len(missing) == 1:
+                user = self.db.user.find_one({'username': missing[0]})
+                if user:
+                    records[missing[0]] = user
+            else:
+                for user in self.db.user.find({'username': {'$in': missing}}):
+                    records[user['username']] = user
+        pending = []
+        for username in missing:
+            user = records.get(username)
+            user_type = self._from_record(username, user)
+            if user_type is _MISSING:
+                pending.append((username, user))
+            else:
+                ret[username] = user_type
+
+        # Only lookups owned by this call go to the executor, lookups
+        # already running in other threads are waited for here, so pool
+        # threads are never blocked by each other
+        owned = []
+        calls = []
+        for username, user in pending:
+            call, owner = self.inflight.start(username)
+            calls.append((username, call))
+            if owner:
+                owned.append((username, call, user))
+        if len(owned) > 1 and self.executor:
+            for username, call, user in owned:
+                self.executor.submit(self.inflight.run, username, call, self._fetch, username, user)
+        else:
+            for username, call, user in owned:
+                self.inflight.run(username, call, self._fetch, username, user)
+        for username, call in calls:
+            ret[username] = call.result()
+        return ret
+
+    def store(self, username, user_type, user=None):
+        """
+        Save result of network lookup for `username`. `user` is the record
+        found in the `user` collection, if any.
+        """
+        logging.debug('Fetched type of %s: %s', username, user_type)
+        if user_type:
+            self._count('fetch')
+        else:
+            self._count('fetch_failed')
+            if user and user.get('type'):
+                # Keep stale type if t.me is not able to tell the new one,
+                # next attempt happens after negative_ttl
+                self.cache.set(username, user['type'], ttl=self.negative_ttl)
+                return user['type']
+        with timed('mongo_write'):
+            self.db.user.find_one_and_update(
+                {'username': username},
+                {'$set': {
+                    'username': username,
+                    'type': user_type,
+                    'added': datetime.utcnow(),
+                }},
+                upsert=True
+            )
+        if user_type:
+            self.cache.set(username, user_type)
+        else:
+            self.cache.set(username, None, ttl=self.negative_ttl)
+        return user_type
+
+    def snapshot(self):
+        return self.cache.snapshot()
+
+    def restore(self, items):
+        return self.cache.restore(items)
+
+    def stats(self):
+        ret = dict(self.counters)
+        lookups = sum(ret[x] for x in LOOKUP_OUTCOMES)
+        ret['memory'] = self.cache.stats()
+        ret['shared_fetch'] = self.inflight.shared
+        if lookups:
+            ret['memory_hit_rate'] = (
+                (ret['memory_hit'] + ret['memory_negative_hit']) / lookups
+            )
+            ret['db_hit_rate'] = (
+                (ret['db_hit'] + ret['db_negative_hit']) / lookups
+            )
+        return ret
@@ -0,0 +1,159 @@
+"""
+Retention of `event` documents.
+
+Events keep all fields for `full_days`, then the compaction job strips
+them to a summary (SUMMARY_FIELDS), and TTL index removes them after
+`retention_days` (365 by default, 0 keeps events forever). Enabling
+retention on a database with older events deletes all events older than
+`retention_days` at once.
+"""
+import logging
+from datetime import datetime, timedelta
+from threading import Thread, Event
+
+from pymongo.errors import PyMongoError, OperationFailure
+
+from metrics import timed
+
+# Fields kept in compacted events: enough for /stat backfill and audit.
+# Full events (see `full_events` option) have sender in "from" field.
+SUMMARY_FIELDS = (
+    'type', 'date', 'reason', 'chat', 'from_user', 'from', 'message_id',
+    'raid_chats',
+)
+INDEX_OPTIONS_CONFLICT = 85
+MAINTENANCE_COLLECTIONS = (
+    'event', 'stat_daily', 'user', 'config', 'config_version', 'notify_throttle',
+)
+COMPACTION_STEP = timedelta(days=1)
+
+
+def ensure_indexes(db, retention_days=None):
+    db.event.create_index([('type', 1), ('date', 1)])
+    db.event.create_index([('chat.id', 1), ('date', 1)])
+    if not retention_days:
+        try:
+            db.event.create_index('date')
+        except OperationFailure as ex:
+            if ex.code != INDEX_OPTIONS_CONFLICT:
+                raise
+            # Retention was turned off, TTL can not be removed by collMod
+            db.event.drop_index([('date', 1)])
+            db.event.create_index('date')
+        return
+    seconds = int(retention_days * 86400)
+    try:
+        db.event.create_index('date', expireAfterSeconds=seconds)
+    except OperationFailure as ex:
+        if ex.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        # Retention changed since the index was created
+        db.command('collMod', 'event', index={
+            'keyPattern': {'date': 1}, 'expireAfterSeconds': seconds,
+        })
+
+
+def compact_events(db, full_days, now=None):
+    """
+    Strip events older than `full_days` to summary fields. Progress is
+    saved in `maintenance` collection, so every run only touches events
+    which became old since the previous one. Return number of compacted
+    events.
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(days=full_days)
+    state = db.maintenance.find_one({'_id': 'event_compaction'}) or {}
+    since = state.get('until')
+    if since is None:
+        oldest = db.event.find_one({}, sort=[('date', 1)])
+        if oldest is None:
+            return 0
+        since = oldest['date']
+    # Update with pipeline (MongoDB 4.2+) replaces document with listed
+    # fields only
+    pipeline = [
+        {'$project': dict((x, 1) for x in SUMMARY_FIELDS)},
+        {'$set': {'compact': True}},
+    ]
+    count = 0
+    while since < cutoff:
+        until = min(since + COMPACTION_STEP, cutoff)
+        with timed('mongo_write'):
+            res = db.event.update_many(
+                {'date': {'$gte': since, '$lt': until}, 'compact': {'$exists': False}},
+                pipeline,
+            )
+            db.maintenance.update_one(
+                {'_id': 'event_compaction'}, {'$set': {'until': until}}, upsert=True,
+            )
+        count += res.modified_count
+        since = until
+    return count
+
+
+class EventCompactor(object):
+    """
+    Runs `compact_events` every `interval` seconds in background thread.
+    """
+
+    def __init__(self, db, full_days=30, interval=3600):
+        self.db = db
+        self.full_days = full_days
+        self.interval = interval
+        self.compacted = 0
+        self._stop = Event()
+        self.thread = Thread(target=self._worker, name='compaction', daemon=True)
+        self.thread.start()
+
+    def _worker(self):
+        while True:
+            try:
+                count = compact_events(self.db, self.full_days)
+                if count:
+                    logging.info('Compacted %d events' % count)
+                self.compacted += count
+            except PyMongoError:
+                logging.exception('Failed to compact events')
+            if self._stop.wait(self.interval):
+                return
+
+    def close(self):
+        self._stop.set()
+        self.thread.join()
+
+    def stats(self):
+        return {'compacted': self.compacted}
+
+
+def format_size(num):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if num < 1024:
+            return '%.1f%s' % (num, unit)
+        num /= 1024
+    return '%.1fTB' % num
+
+
+def maintenance_report(db):
+    """
+    Return lines describing size of collections and usage of their
+    indexes.
+    """
+    lines = []
+    for name in MAINTENANCE_COLLECTIONS:
+        try:
+            coll_stats = db.command('collStats', name)
+        except OperationFailure:
+            continue
+        lines.append('%s: %d docs, data %s (avg %s), storage %s, indexes %s' % (
+            name, coll_stats.get('count', 0),
+            format_size(coll_stats.get('size', 0)),
+            format_size(coll_stats.get('avgObjSize', 0)),
+            format_size(coll_stats.get('storageSize', 0)),
+            format_size(coll_stats.get('totalIndexSize', 0)),
+        ))
+        index_sizes = coll_stats.get('indexSizes', {})
+        for item in db[name].aggregate([{'$indexStats': {}}]):
+            lines.append('  %-24s %10s %10d ops since %s' % (
+                item['name'], format_size(index_sizes.get(item['name'], 0)),
+                item['accesses']['ops'], item['accesses']['since'].strftime('%Y-%m-%d %H:%M'),
+            ))
+    return lines
@@ -0,0 +1,90 @@
+"""
+Serialization of Telegram objects into event documents.
+
+Compact form keeps only the fields listed in SCHEMAS, under the
+attribute names of the library (e.g. `from_user`), which is enough for
+/stat, auditing, log formats and reclassification of saved events. Full
+form is the message as received from Bot API.
+"""
+from telebot import types
+
+MEDIA_FIELDS = ('file_unique_id', 'file_size', 'mime_type', 'file_name')
+SCHEMAS = {
+    types.Message: (
+        'message_id', 'date', 'edit_date', 'content_type', 'chat', 'from_user',
+        'sender_chat', 'forward_origin', 'text', 'caption', 'entities',
+        'caption_entities', 'photo', 'video', 'audio', 'document', 'sticker',
+        'new_chat_members',
+    ),
+    types.User: ('id', 'is_bot', 'first_name', 'last_name', 'username'),
+    types.Chat: ('id', 'type', 'title', 'username'),
+    types.MessageEntity: ('type', 'offset', 'length', 'url'),
+    types.MessageOrigin: (
+        'type', 'date', 'sender_user', 'sender_user_name', 'sender_chat',
+        'chat', 'message_id',
+    ),
+    types.PhotoSize: ('file_unique_id', 'width', 'height'),
+    types.Video: MEDIA_FIELDS,
+    types.Audio: MEDIA_FIELDS,
+    types.Document: MEDIA_FIELDS,
+    types.Sticker: ('file_unique_id', 'emoji', 'set_name'),
+}
+SCALARS = (str, int, float, bool)
+_serializers = {}
+
+
+def get_serializer(cls):
+    """
+    Return function converting instance of `cls` to dict, built once per
+    class from its schema.
+    """
+    func = _serializers.get(cls)
+    if func is not None:
+        return func
+    fields = None
+    for base in cls.__mro__:
+        if base in SCHEMAS:
+            fields = SCHEMAS[base]
+            break
+
+    if fields is None:
+        # Type without schema is dumped with all its attributes
+        def func(obj):
+            return dump_fields(obj, [x for x in vars(obj) if not x.startswith('_')])
+    else:
+        def func(obj):
+            return dump_fields(obj, fields)
+    _serializers[cls] = func
+    return func
+
+
+def dump_fields(obj, fields):
+    ret = {}
+    for name in fields:
+        val = getattr(obj, name, None)
+        if val is None:
+            continue
+        if not isinstance(val, SCALARS):
+            val = dump_value(val)
+        ret[name] = val
+    return ret
+
+
+def dump_value(val):
+    if isinstance(val, SCALARS) or val is None:
+        return val
+    if isinstance(val, dict):
+        return val
+    if isinstance(val, (list, tuple)):
+        return [dump_value(x) for x in val]
+    return get_serializer(type(val))(val)
+
+
+def dump_message(msg, full=False):
+    """
+    Return event form of `msg`: compact by default, or the original Bot
+    API message with `full`.
+    """
+    if full and isinstance(getattr(msg, 'json', None), dict):
+        return dict(msg.json)
+    return get_serializer(type(msg))(msg)
@@ -0,0 +1,197 @@
+import logging
+import multiprocessing
+import time
+from collections import deque
+from queue import Full
+from threading import Thread, Event, Lock
+
+from dispatch import get_raw_chat_id, shard_index
+
+# Indexes in shared counters array of a worker
+PROCESSED, FAILED, BUSY = range(3)
+_STOP = None
+
+
+def serve_shard(queue, counters, handler):
+    """
+    Worker process loop: call `handler(data)` for every raw update from
+    `queue` until the coordinator asks to stop.
+    """
+    while True:
+        data = queue.get()
+        if data is _STOP:
+            return
+        started = time.perf_counter()
+        try:
+            handler(data)
+            counters[PROCESSED] += 1
+        except Exception:
+            logging.exception('Failed to process update %s' % data.get('update_id'))
+            counters[FAILED] += 1
+        counters[BUSY] += time.perf_counter() - started
+
+
+class ShardCoordinator(object):
+    """
+    Routes raw updates to worker processes by chat id.
+
+    Worker process `idx` runs `target(idx, queue, counters, *args)` which
+    is expected to call `serve_shard`. Queues and counters belong to the
+    coordinator, so a restarted worker continues with updates queued for
+    its predecessor. Workers which died are started again by supervisor
+    thread; `restart` replaces them one by one after they processed
+    their queues.
+
+    Has the same `submit_json`/`stats`/`stop` interface as ChatDispatcher.
+    """
+
+    def __init__(self, target, args=(), processes=2, queue_size=1000,
+                 put_timeout=None, check_interval=1, report_interval=60):
+        self._ctx = multiprocessing.get_context('spawn')
+        self.target = target
+        self.args = tuple(args)
+        self.put_timeout = put_timeout
+        self.check_interval = check_interval
+        self.report_interval = report_interval
+        self.queues = [self._ctx.Queue(maxsize=queue_size) for _ in range(processes)]
+        self.counters = [self._ctx.Array('d', 3, lock=False) for _ in range(processes)]
+        self.processes = [None] * processes
+        self.restarts = [0] * processes
+        # Number of updates sent to every worker and (number, update id)
+        # of updates it has not finished yet
+        self.sent = [0] * processes
+        self.pending = [deque() for _ in range(processes)]
+        self._submit_lock = Lock()
+        self.load = [0.0] * processes
+        self.submitted = 0
+        self.dropped = 0
+        self._lock = Lock()
+        self._stopping = Event()
+        for idx in range(processes):
+            self._start(idx)
+        self.thread = Thread(target=self._supervise, name='shards', daemon=True)
+        self.thread.start()
+
+    def _start(self, idx):
+        proc = self._ctx.Process(
+            target=self.target,
+            args=(idx, self.queues[idx], self.counters[idx]) + self.args,
+            name='shard-%d' % idx,
+            daemon=True,
+        )
+        proc.start()
+        self.processes[idx] = proc
+
+    def submit_json(self, data):
+        if not isinstance(data, dict) or 'update_id' not in data:
+            raise ValueError('Invalid update')
+        idx = shard_index(get_raw_chat_id(data), len(self.queues))
+        try:
+            self.queues[idx].put(data, timeout=self.put_timeout)
+        except Full:
+            self.dropped += 1
+            logging.error('Shard queue is full, update %s dropped' % data['update_id'])
+            return False
+        with self._submit_lock:
+            self.sent[idx] += 1
+            self.pending[idx].append((self.sent[idx], data['update_id']))
+            self.submitted += 1
+        return True
+
+    def _done(self, idx):
+        return int(self.counters[idx][PROCESSED] + self.counters[idx][FAILED])
+
+    def unfinished(self):
+        """
+        Return the lowest id of updates not handled yet.
+        """
+        heads = []
+        with self._submit_lock:
+            for idx, pending in enumerate(self.pending):
+                done = self._done(idx)
+                while pending and pending[0][0] <= done:
+                    pending.popleft()
+                if pending:
+                    heads.append(pending[0][1])
+        return min(heads) if heads else None
+
+    def _supervise(self):
+        last_report = time.monotonic()
+        last_busy = [x[BUSY] for x in self.counters]
+        while not self._stopping.wait(self.check_interval):
+            with self._lock:
+                for idx, proc in enumerate(self.processes):
+                    if not proc.is_alive() and not self._stopping.is_set():
+                        logging.error('Shard worker %d exited with code %s, restarting' % (
+                            idx, proc.exitcode,
+                        ))
+                        with self._submit_lock:
+                            # Update taken from the queue by the dead worker
+                            lost = self.sent[idx] - self._done(idx) - self.queues[idx].qsize()
+                            if lost > 0:
+                                logging.error('Shard worker %d lost %d updates' % (idx, lost))
+                                self.counters[idx][FAILED] += lost
+                        self._start(idx)
+                        self.restarts[idx] += 1
+            now = time.monotonic()
+            if now - last_report >= self.report_interval:
+                busy = [x[BUSY] for x in self.counters]
+                self.load = [(x - y) / (now - last_report) for x, y in zip(busy, last_busy)]
+                logging.info('Shard load: %s, queues: %s' % (
+                    ' '.join('%.0f%%' % (x * 100) for x in self.load),
+                    ' '.join(str(x) for x in self.queue_depth()),
+                ))
+                last_report, last_busy = now, busy
+
+    def restart(self, args=None):
+        """
+        Replace workers one by one, e.g. to load new code or `args`.
+        Updates arriving meanwhile wait in the queue of the worker.
+        """
+        if args is not None:
+            self.args = tuple(args)
+        for idx in range(len(self.processes)):
+            with self._lock:
+                if self._stopping.is_set():
+                    return
+                self.queues[idx].put(_STOP)
+                self.processes[idx].join()
+                self._start(idx)
+                self.restarts[idx] += 1
+            logging.info('Shard worker %d restarted' % idx)
+
+    def queue_depth(self):
+        return [x.qsize() for x in self.queues]
+
+    def stats(self):
+        return {
+            'workers': len(self.processes),
+            'queue_depth': self.queue_depth(),
+            'processed': [int(x[PROCESSED]) for x in self.counters],
+            'failed': [int(x[FAILED]) for x in self.counters],
+            'busy_seconds': [x[BUSY] for x in self.counters],
+            'load': list(self.load),
+            'restarts': list(self.restarts),
+            'dropped': self.dropped,
+        }
+
+    def join(self):
+        """
+        Wait until all submitted updates are handled.
+        """
+        while sum(x[PROCESSED] + x[FAILED] for x in self.counters) < self.submitted:
+            time.sleep(0.01)
+
+    def stop(self, timeout=30):
+        # Queued updates are processed before the workers exit
+        with self._lock:
+            self._stopping.set()
+        for queue in self.queues:
+            queue.put(_STOP)
+        deadline = time.monotonic() + timeout
+        for proc in self.processes:
+            proc.join(max(0, deadline - time.monotonic()))
+            if proc.is_alive():
+                logging.error('Shard worker %s did not stop, terminating' % proc.name)
+                proc.terminate()
+        self.thread.join()
@@ -0,0 +1,142 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import logging
+
+from pymongo import UpdateOne
+
+
+def get_day(date):
+    return date.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def reason_key(reason):
+    # Mongo does not allow dots and leading "$" in field names
+    return reason.replace('.', '_').lstrip('$')
+
+
+def get_chat_label(chat_id, chat_username):
+    return '@%s' % chat_username if chat_username else '#%d' % chat_id
+
+
+def ensure_indexes(db):
+    db.stat_daily.create_index([('date', 1), ('chat_id', 1)], unique=True)
+
+
+def record_events(db, events):
+    """
+    Increment daily counters for `delete_msg` items of `events`, /stat is
+    built from these counters.
+    """
+    rollups = {}
+    for event in events:
+        if event.get('type') != 'delete_msg':
+            continue
+        chat = event.get('chat') or {}
+        key = (get_day(event['date']), chat.get('id'))
+        rollup = rollups.setdefault(key, {
+            'chat_username': chat.get('username'),
+            'reasons': Counter(),
+        })
+        rollup['reasons'][reason_key(event.get('reason') or 'unknown')] += 1
+    if not rollups:
+        return
+    ops = []
+    for (day, chat_id), rollup in rollups.items():
+        inc = dict(
+            ('reasons.%s' % reason, num)
+            for reason, num in rollup['reasons'].items()
+        )
+        inc['count'] = sum(rollup['reasons'].values())
+        ops.append(UpdateOne(
+            {'date': day, 'chat_id': chat_id},
+            {'$set': {'chat_username': rollup['chat_username']}, '$inc': inc},
+            upsert=True,
+        ))
+    db.stat_daily.bulk_write(ops, ordered=False)
+
+
+def backfill(db, since=None, now=None):
+    """
+    Rebuild counters from `delete_msg` events. Counters of days found in
+    events are overwritten. Today's counters are left to `record_events`:
+    events recorded while the rebuild runs would be lost.
+    """
+    match = {'type': 'delete_msg', 'date': {'$lt': get_day(now or datetime.utcnow())}}
+    if since:
+        match['date']['$gte'] = get_day(since)
+    pipeline = [
+        {'$match': match},
+        # Chat username of the last event is kept
+        {'$sort': {'date': 1}},
+        {'$group': {
+            '_id': {
+                'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$date'}},
+                # Old events store chat in chat_id/chat_username fields
+                'chat_id': {'$ifNull': ['$chat.id', '$chat_id']},
+                'reason': {'$ifNull': ['$reason', 'unknown']},
+            },
+            'chat_username': {'$last': {'$ifNull': ['$chat.username', '$chat_username']}},
+            'last_date': {'$last': '$date'},
+            'count': {'$sum': 1},
+        }},
+    ]
+    rollups = {}
+    last_dates = {}
+    for item in db.event.aggregate(pipeline, allowDiskUse=True):
+        key = (
+            datetime.strptime(item['_id']['day'], '%Y-%m-%d'),
+            item['_id']['chat_id'],
+        )
+        rollup = rollups.setdefault(key, {
+            'chat_username': item['chat_username'],
+            'count': 0,
+            'reasons': {},
+        })
+        if item['last_date'] >= last_dates.get(key, item['last_date']):
+            rollup['chat_username'] = item['chat_username']
+            last_dates[key] = item['last_date']
+        rollup['count'] += item['count']
+        reason = reason_key(item['_id']['reason'])
+        rollup['reasons'][reason] = rollup['reasons'].get(reason, 0) + item['count']
+    for (day, chat_id), rollup in rollups.items():
+        db.stat_daily.replace_one(
+            {'date': day, 'chat_id': chat_id},
+            dict(rollup, date=day, chat_id=chat_id),
+            upsert=True,
+        )
+    logging.debug('Backfilled %d daily counters' % len(rollups))
+    return len(rollups)
+
+
+def format_top(counter, limit):
+    return '\n'.join('  %s (%d)' % x for x in counter.most_common(limit))
+
+
+def build_report(db, days=7, reasons=False, now=None):
+    today = get_day(now or datetime.utcnow())
+    first_day = today - timedelta(days=days - 1)
+    totals = [0] * days
+    top_today = Counter()
+    top_ystd = Counter()
+    top_period = Counter()
+    top_reasons = Counter()
+    for item in db.stat_daily.find({'date': {'$gte': first_day}}):
+        key = get_chat_label(item['chat_id'], item.get('chat_username'))
+        idx = (item['date'] - first_day).days
+        if not 0 <= idx < days:
+            continue
+        totals[idx] += item['count']
+        if item['date'] == today:
+            top_today[key] += item['count']
+        if item['date'] == today - timedelta(days=1):
+            top_ystd[key] += item['count']
+        top_period[key] += item['count']
+        if reasons:
+            top_reasons.update(item.get('reasons', {}))
+    ret = 'Recent %d days: %s' % (days, ' | '.join(str(x) for x in totals))
+    ret += '\n\nTop today: (%s)\n%s' % (len(top_today), format_top(top_today, 15))
+    ret += '\n\nTop yesterday: (%s)\n%s' % (len(top_ystd), format_top(top_ystd, 15))
+    ret += '\n\nTop 10 of %d days:\n%s' % (days, format_top(top_period, 10))
+    if reasons:
+        ret += '\n\nReasons:\n%s' % format_top(top_reasons, 20)
+    return ret
@@ -1,4 +1,49 @@
-from util import find_username_links, find_external_links, fetch_user_type
+from collections import Counter
+from contextlib import contextmanager
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+from threading import Thread
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+
+from pymongo.errors import PyMongoError
+import telebot
+from telebot import apihelper
+from telebot.types import Update
+
+from util import (
+    find_username_links, find_external_links, fetch_user_type, TmeClient,
+)
+from cache import TTLCache, AdminCache, save_snapshot, load_snapshot
+from dispatch import ChatDispatcher
+from resolver import UserTypeResolver
+from domains import DomainMatcher, compile_domains
+from journal import EventJournal
+from logchannel import LogDelivery, LogEntry
+from webhook import WebhookServer, SECRET_HEADER
+from classify import Classifier, CLASSIFY_SETTINGS
+from metrics import Registry, StartupTimer
+from groupconfig import GroupConfigStore
+from fakes import FakeDatabase, FakeBotApi, FakeTme, ADMIN_USER, ADMIN_RIGHTS
+from shard import ShardCoordinator, serve_shard
+from throttle import ExpiringSet, NotifyThrottle
+from fingerprint import FingerprintCache, get_fingerprint
+from serialize import dump_message
+from retention import compact_events
+from poller import UpdatePoller, get_backoff
+from backtest import run_backtest, format_report
+from joinwave import JoinWaveGuard
+from transport import ApiTransport
+from graphenebot import (
+    create_bot, shutdown, ensure_indexes, setup_logging, start_index_build, get_webhook_secret,
+)
+import stats
 
 
 def test_link_finders():
@@ -25,8 +70,1228 @@ def test_fetch_user_type():
         assert  ret == type_
 
 
+def test_ttl_cache():
+    cache = TTLCache(ttl=60, maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    # "b" is the least recently used entry
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    cache.set('d', 4, ttl=-1)
+    assert cache.get('d') is None
+    stats = cache.stats()
+    assert stats['hits'] == 2
+    assert stats['misses'] == 2
+    assert stats['evictions'] == 2
+
+
+def test_dispatcher_keeps_chat_order():
+    handled = []
+    dispatcher = ChatDispatcher(handled.append, workers=4, queue_size=10)
+    for idx in range(100):
+        dispatcher.submit(SimpleNamespace(
+            update_id=idx,
+            message=SimpleNamespace(chat=SimpleNamespace(id=idx % 7)),
+        ))
+    dispatcher.stop()
+    assert len(handled) == 100
+    for chat_id in range(7):
+        ids = [x.update_id for x in handled if x.message.chat.id == chat_id]
+        assert ids == sorted(ids)
+
+
+class FakeUserCollection(object):
+    def __init__(self):
+        self.items = {}
+
+    def find_one(self, query):
+        return self.items.get(query['username'])
+
+    def find_one_and_update(self, query, update, upsert=False):
+        self.items.setdefault(query['username'], {}).update(update['$set'])
+
+
+def test_user_type_resolver():
+    fetched = []
+    types = {'somegroup': 'group', 'stale': 'channel'}
+
+    def fetch(username):
+        fetched.append(username)
+        return types.get(username)
+
+    db = SimpleNamespace(user=FakeUserCollection())
+    db.user.items['stale'] = {
+        'username': 'stale', 'type': 'user', 'added': datetime(2000, 1, 1),
+    }
+    resolver = UserTypeResolver(db, fetch=fetch)
+    assert resolver.get_type('SomeGroup') == 'group'
+    assert resolver.get_type('somegroup') == 'group'
+    assert resolver.get_type('typo') is None
+    assert resolver.get_type('typo') is None
+    assert resolver.get_type('stale') == 'channel'
+    assert fetched == ['somegroup', 'typo', 'stale']
+    assert db.user.items['typo']['type'] is None
+
+    # New process: memory is empty, db answers
+    resolver = UserTypeResolver(db, fetch=fetch)
+    assert resolver.get_type('somegroup') == 'group'
+    assert resolver.get_type('typo') is None
+    assert len(fetched) == 3
+    stats = resolver.stats()
+    assert stats['db_hit'] == 1
+    assert stats['db_negative_hit'] == 1
+
+
+# Type of FakeTme usernames is taken from the prefix
+TME_PAGES = {
+    'group_some': 'group',
+    'user_some': 'user',
+    'channel_some': 'channel',
+}
+
+
+def test_tme_client():
+    tme = FakeTme()
+    try:
+        client = TmeClient(tme.url)
+        for username, type_ in TME_PAGES.items():
+            assert client.fetch_user_type(username) == type_
+        assert client.fetch_user_type('unknown') is None
+        # All requests went through one keep-alive connection
+        assert len(tme.clients) == 1
+    finally:
+        tme.stop()
+
+
+def test_resolver_parallel_fetch():
+    tme = FakeTme(latency=0.3)
+    try:
+        client = TmeClient(tme.url)
+        db = SimpleNamespace(user=FakeUserCollection())
+        db.user.find = lambda query: []
+        resolver = UserTypeResolver(db, fetch=client.fetch_user_type)
+        started = time.time()
+        threads = [
+            Thread(target=resolver.get_types, args=(list(TME_PAGES),))
+            for _ in range(3)
+        ]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        assert time.time() - started < 0.9
+        assert tme.calls == Counter(TME_PAGES.keys())
+        assert resolver.get_types(['Group_Some', 'user_some']) == {
+            'group_some': 'group', 'user_some': 'user',
+        }
+        # Lookup which missed the memory cache just before another call
+        # stored the type does not fetch it again
+        resolver.cache.set('latecomer', 'channel')
+        assert resolver._resolve('latecomer', None) == 'channel'
+        assert 'latecomer' not in tme.calls
+    finally:
+        tme.stop()
+
+
+def test_domain_matcher():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'whitelist')
+        with open(path, 'w') as out:
+            out.write('*.github.com\n*.пример.рф\ngithub.io\n# comment\n\n')
+        matcher = DomainMatcher([path], check_interval=0)
+        assert matcher.match('github.com')
+        assert matcher.match('www.GitHub.com:443')
+        assert matcher.match_url('https://user@gist.github.com/foo')
+        assert matcher.match('xn--e1afmkfd.xn--p1ai')
+        assert matcher.match('www.пример.рф')
+        assert not matcher.match('evilgithub.com')
+        assert not matcher.match('github.com.evil.org')
+        assert not matcher.match('example.org')
+        # Subdomains of entries without "*." are not allowed
+        assert matcher.match('github.io')
+        assert not matcher.match('evil.github.io')
+        assert not matcher.match_url('https://evil.github.io/airdrop')
+
+        extra = compile_domains(['example.org', '*.Example.NET'])
+        assert extra == {'example.org', '*.example.net'}
+        assert matcher.match('example.org', extra)
+        assert not matcher.match('www.example.org', extra)
+        assert matcher.match('www.example.net', extra)
+        assert not matcher.match('www.example.net')
+
+        with open(path, 'w') as out:
+            out.write('example.org\n')
+        os.utime(path, ns=(0, 0))
+        assert matcher.match('example.org')
+        assert not matcher.match('github.com')
+
+
+class FakeEventCollection(object):
+    def __init__(self):
+        self.items = []
+        self.down = False
+
+    def insert_many(self, items, ordered=True):
+        if self.down:
+            raise PyMongoError('Server is not available')
+        self.items.extend(items)
+
+
+def test_event_journal_spill_and_replay():
+    db = SimpleNamespace(
+        event=FakeEventCollection(),
+        stat_daily=SimpleNamespace(bulk_write=lambda ops, ordered: None),
+    )
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        spill_path = os.path.join(tmp_dir, 'spill.jsonl')
+        journal = EventJournal(db, batch_size=2, spill_path=spill_path)
+        for idx in range(3):
+            journal.add({'type': 'test', 'idx': idx, 'date': datetime.utcnow()})
+        journal.close()
+        assert len(db.event.items) == 3
+
+        db.event.down = True
+        journal = EventJournal(db, spill_path=spill_path)
+        journal.add({'type': 'test', 'idx': 3, 'date': datetime.utcnow()})
+        journal.close()
+        assert journal.spilled == 1
+        assert len(db.event.items) == 3
+
+        db.event.down = False
+        journal = EventJournal(db, spill_path=spill_path)
+        journal.close()
+        assert [x['idx'] for x in db.event.items] == [0, 1, 2, 3]
+        assert not os.listdir(tmp_dir)
+
+
+class FakeApiError(Exception):
+    def __init__(self, result_json):
+        super(FakeApiError, self).__init__(result_json['description'])
+        self.result_json = result_json
+
+
+class FakeLogBot(object):
+    def __init__(self, throttle=0, errors=0):
+        self.sent = []
+        self.throttle = throttle
+        self.errors = errors
+
+    def send_message(self, chat_id, text, parse_mode=None):
+        if self.errors:
+            self.errors -= 1
+            raise FakeApiError({'error_code': 400, 'description': 'Bad Request'})
+        if self.throttle:
+            self.throttle -= 1
+            raise FakeApiError({
+                'error_code': 429, 'description': 'Too Many Requests',
+                'parameters': {'retry_after': 0.2},
+            })
+        self.sent.append((chat_id, text))
+
+
+def test_log_delivery_digest():
+    bot = FakeLogBot(throttle=1)
+    delivery = LogDelivery(bot, chat_rate=(1, 0.1), digest_threshold=3)
+    for idx in range(20):
+        delivery.add(LogEntry(
+            -100, '@group', '@user%d' % idx, 'forwarded', 'spam text',
+            ['Removed message %d' % idx],
+        ))
+    delivery.close()
+    assert len(bot.sent) < 20
+    assert 'removed from @group' in bot.sent[0][1]
+    stats = delivery.stats()
+    assert stats['throttled'] == 1
+    assert stats['digested_entries'] + stats.get('sent', 0) == 20
+
+
+def test_log_delivery_failures():
+    bot = FakeLogBot(errors=1)
+    delivery = LogDelivery(bot, chat_rate=(100, 1))
+    delivery.add(LogEntry(-100, '@group', '@user', 'email', 'text', ['First', 'Second']))
+    delivery.close()
+    assert bot.sent == [(-100, 'Second')]
+    assert delivery.stats()['failed'] == 1 and delivery.stats()['sent'] == 1
+
+    # Digest is sent again after 429 up to MAX_SEND_ATTEMPTS times
+    bot = FakeLogBot(throttle=5)
+    delivery = LogDelivery(bot, chat_rate=(100, 1), digest_threshold=3)
+    with delivery._cond:
+        for idx in range(5):
+            delivery.add(LogEntry(-100, '@group', '@user', 'email', 'text', ['Removed %d' % idx]))
+    delivery.close()
+    stats = delivery.stats()
+    assert bot.sent == [] and bot.throttle == 2
+    assert stats['throttled'] == 3 and stats['dropped'] == 5 and stats['queue_depth'] == 0
+
+
+RECORDED_UPDATE = {
+    'update_id': 10001,
+    'message': {
+        'message_id': 7,
+        'date': 1514764800,
+        'chat': {'id': -1001, 'type': 'supergroup', 'username': 'somegroup'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'Spammer'},
+        'text': 'join @somechannel',
+        'entities': [{'type': 'mention', 'offset': 5, 'length': 12}],
+    },
+}
+
+
+def post_update(url, data, secret):
+    req = Request(url, data=json.dumps(data).encode(), headers={
+        'Content-Type': 'application/json', SECRET_HEADER: secret,
+    })
+    try:
+        with urlopen(req, timeout=5) as res:
+            return res.status
+    except HTTPError as ex:
+        return ex.code
+
+
+def test_webhook_server():
+    handled = []
+    bot = SimpleNamespace(
+        dispatcher=ChatDispatcher(handled.append, workers=2),
+    )
+    server = WebhookServer(bot, port=0, secret='s3cret')
+    server.start()
+    try:
+        url = 'http://127.0.0.1:%d' % server.port
+        assert post_update(url + '/webhook', RECORDED_UPDATE, 'wrong') == 403
+        assert post_update(url + '/webhook', {'foo': 1}, 's3cret') == 400
+        assert post_update(url + '/webhook', RECORDED_UPDATE, 's3cret') == 200
+        bot.dispatcher.join()
+        assert handled[0].message.chat.id == -1001
+        with urlopen(url + '/health', timeout=5) as res:
+            health = json.loads(res.read().decode())
+        assert health['status'] == 'ok'
+        assert health['queue_depth'] == 0
+        assert health['requests']['accepted'] == 1
+        assert post_update(url + '/webhook', RECORDED_UPDATE, '') == 403
+    finally:
+        server.stop()
+        bot.dispatcher.stop()
+
+
+def test_webhook_secret_required():
+    bot = SimpleNamespace(dispatcher=None)
+    for secret in (None, ''):
+        try:
+            WebhookServer(bot, port=0, secret=secret)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Webhook without secret'
+    assert get_webhook_secret({'webhook_secret': 's3cret'}) == 's3cret'
+    # Generated secret is passed to setWebhook
+    secret = get_webhook_secret({'webhook_url': 'https://example.org/webhook'})
+    assert len(secret) >= 32 and secret != get_webhook_secret({'webhook_url': 'x'})
+    try:
+        get_webhook_secret({})
+    except ValueError:
+        pass
+    else:
+        assert False, 'Webhook without secret'
+
+
+def make_msg(text=None, caption=None, entities=None, forward_from=None):
+    return SimpleNamespace(
+        text=text, caption=caption, forward_from=forward_from,
+        forward_from_chat=None,
+        entities=[
+            SimpleNamespace(type=type_, offset=offset, length=length, url=None)
+            for type_, offset, length in (entities or [])
+        ],
+    )
+
+
+def test_classifier():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'whitelist')
+        with open(path, 'w') as out:
+            out.write('*.github.com\n')
+        classifier = Classifier(DomainMatcher([path]), ['preico'])
+    calls = []
+
+    def resolve_types(usernames):
+        calls.append(usernames)
+        types = {'somegroup': 'group', 'somechannel': 'channel'}
+        return dict((x.lower(), types.get(x.lower())) for x in usernames)
+
+    settings = dict(CLASSIFY_SETTINGS)
+
+    def classify(msg, settings=settings):
+        return classifier.classify(msg, settings, resolve_types)
+
+    assert classify(make_msg('hello')).action == 'keep'
+    assert classify(make_msg(caption='photo')).action == 'keep'
+    assert classify(make_msg()).action == 'keep'
+    verdict = classify(make_msg('see www.github.com', entities=[('url', 4, 14)]))
+    assert verdict.action == 'keep'
+    verdict = classify(make_msg('see spam.com now', entities=[('url', 4, 8)]))
+    assert verdict == ('delete', 'external link', (4, 12), 'text')
+    verdict = classify(make_msg(
+        '@preico @SomeUser @SomeGroup',
+        entities=[('mention', 0, 7), ('mention', 8, 9), ('mention', 18, 10)],
+    ))
+    assert verdict.reason == '@-link to group'
+    assert calls[-1] == ['SomeUser', 'SomeGroup']
+    assert classify(make_msg('join @ somechannel now')).reason == '@-link to channel'
+    assert classify(make_msg('hi', forward_from=object())).reason == 'forwarded'
+    verdict = classify(make_msg(caption='join @somechannel'))
+    assert verdict == ('delete', 'caption @-link to channel', (5, 17), 'caption')
+    assert classify(make_msg(caption='go to spam.com')).reason == 'caption external link'
+    # Username inside link is found when links are allowed
+    settings_no_links = dict(settings, links=False)
+    verdict = classify(make_msg(caption='t.me/@somegroup'), settings_no_links)
+    assert verdict.reason == 'caption @-link to group'
+    assert len(calls) == 4
+
+
+def test_metrics_registry():
+    registry = Registry()
+    stage = registry.histogram('stage_seconds', 'Stages', ('stage',), buckets=(0.1, 1))
+    counter = registry.counter('deleted_total', 'Deleted', ('reason',))
+    stage.observe(0.05, 'classify')
+    stage.observe(0.5, 'classify')
+    counter.inc('link "x"')
+    counter.inc('link "x"', amount=2)
+    registry.add_gauge('depth', 'Queue depth', lambda: 3)
+    text = registry.expose()
+    assert 'stage_seconds_bucket{stage="classify",le="0.1"} 1' in text
+    assert 'stage_seconds_bucket{stage="classify",le="+Inf"} 2' in text
+    assert 'stage_seconds_count{stage="classify"} 2' in text
+    assert 'deleted_total{reason="link \\"x\\""} 3' in text
+    assert 'depth 3' in text
+    assert stage.quantile(0.5, 'classify') == 0.1
+
+
+def test_group_config_store():
+    db = FakeDatabase()
+    db.config.insert_one({'group_id': 1, 'key': 'links', 'value': False})
+    store = GroupConfigStore(db, maxsize=1, watch=False)
+    other = GroupConfigStore(db, watch=False)
+    assert store.get(1).get('links') is False
+    assert store.get(1).get('publog', True) is True
+    assert store.stats()['loads'] == 1
+    # Cold group is evicted
+    assert store.get(2).get('links') is None
+    assert store.stats()['evictions'] == 1
+
+    assert other.get(1).get('emails') is None
+    other.poll()
+    store.set(1, 'emails', False)
+    store.set(1, 'allowed_domains', ['example.org'])
+    assert store.get(1).get('emails') is False
+    assert store.get(1).allowed_domains == {'example.org'}
+    # Other process sees the change after polling config versions
+    assert other.get(1).get('emails') is None
+    other.poll()
+    assert other.get(1).get('emails') is False
+    loads = other.stats()['loads']
+    other.poll()
+    other.get(1)
+    assert other.stats()['loads'] == loads
+
+
+def echo_shard_worker(idx, queue, counters, results):
+    serve_shard(queue, counters, lambda data: results.put(
+        (idx, data['message']['chat']['id'], data['update_id'])
+    ))
+
+
+def test_shard_coordinator():
+    results = multiprocessing.get_context('spawn').Queue()
+    coordinator = ShardCoordinator(
+        echo_shard_worker, args=(results,), processes=3, check_interval=0.1,
+    )
+    update_id = 0
+
+    def submit(count):
+        nonlocal update_id
+        for _ in range(count):
+            update_id += 1
+            chat_id = update_id % 7
+            assert coordinator.submit_json({
+                'update_id': update_id, 'message': {'chat': {'id': chat_id}},
+            })
+        return [results.get(timeout=30) for _ in range(count)]
+
+    try:
+        handled = submit(70)
+        workers = {}
+        for idx, chat_id, _ in handled:
+            assert workers.setdefault(chat_id, idx) == idx
+        for chat_id in workers:
+            ids = [x[2] for x in handled if x[1] == chat_id]
+            assert ids == sorted(ids)
+        # Neither graceful restart nor crash loses queued updates
+        coordinator.restart()
+        coordinator.processes[0].kill()
+        assert sorted(x[2] for x in submit(30)) == list(range(71, 101))
+        coordinator.join()
+        stats = coordinator.stats()
+        assert sum(stats['processed']) == 100
+        assert sum(stats['restarts']) >= 4
+    finally:
+        coordinator.stop()
+
+
+def test_expiring_set():
+    now = [1000.0]
+    recent = ExpiringSet(60, buckets=6, clock=lambda: now[0])
+    recent.add('old', 925)
+    recent.add('a', 945)
+    recent.add('b')
+    assert 'a' in recent and 'b' in recent
+    assert 'old' not in recent and 'c' not in recent
+    now[0] = 1065
+    assert 'a' not in recent and 'b' in recent
+    # Adding into new bucket drops expired ones
+    recent.add('c')
+    assert len(recent) == 2
+
+
+def test_notify_throttle():
+    db = FakeDatabase()
+    throttle = NotifyThrottle(db, window=3600)
+    assert throttle.allow(1, 10)
+    assert not throttle.allow(1, 10)
+    assert throttle.allow(1, 11)
+    assert throttle.allow(2, 10)
+    # Restarted or other instance sees notifications saved to the db
+    other = NotifyThrottle(db, window=3600)
+    assert not other.allow(1, 10)
+    assert not other.allow(1, 10)
+    assert other.stats()['throttled'] == 2
+    db.notify_throttle.update_one(
+        {'_id': '1:11'}, {'$set': {'date': datetime.utcnow() - timedelta(hours=2)}},
+    )
+    assert other.allow(1, 11)
+
+
+def test_ensure_indexes_options_changed():
+    db = FakeDatabase()
+    ensure_indexes(db, {'notify_window': 3600, 'event_retention_days': 365})
+    # Changed TTL is applied to existing indexes instead of failing
+    ensure_indexes(db, {'notify_window': 600, 'event_retention_days': 30})
+    assert db.notify_throttle.indexes[(('date', 1),)] == {'expireAfterSeconds': 600}
+    assert db.event.indexes[(('date', 1),)] == {'expireAfterSeconds': 30 * 86400}
+    # Retention turned off
+    ensure_indexes(db, {'event_retention_days': 0})
+    assert db.event.indexes[(('date', 1),)] == {}
+    ensure_indexes(db, {'event_retention_days': 0})
+    assert db.event.counters['drop_index'] == 1
+
+
+def test_fingerprint_cache():
+    msg = make_msg('Join  @SomeChannel', entities=[('mention', 6, 12)])
+    copy = make_msg('join @somechannel ', entities=[('mention', 5, 12)])
+    fingerprint = get_fingerprint(msg)
+    # Verdicts are cached by exact content, raids are found by normalised
+    assert fingerprint != get_fingerprint(copy)
+    assert get_fingerprint(msg, normalize=True) == get_fingerprint(copy, normalize=True)
+    assert get_fingerprint(make_msg('join @ spam')) != get_fingerprint(make_msg('join @  spam'))
+    assert fingerprint != get_fingerprint(make_msg('join @somechannel'))
+    assert get_fingerprint(make_msg('hello')) is None
+
+    cache = FingerprintCache(raid_threshold=3)
+    settings = dict(CLASSIFY_SETTINGS)
+    verdict = ('delete', '@-link to channel', (6, 18), 'text')
+    cache.set(fingerprint, settings, frozenset(), verdict)
+    assert cache.get(fingerprint, settings, frozenset()) == verdict
+    assert cache.get(fingerprint, dict(settings, channels=False), frozenset()) is None
+    assert cache.get(None, settings, frozenset()) is None
+
+    assert cache.observe(fingerprint, 1, 10) is None
+    assert cache.observe(fingerprint, 1, 11) is None
+    assert cache.observe(fingerprint, 2, 10) is None
+    burst = cache.observe(fingerprint, 3, 10)
+    assert burst.chats == {1: 10, 2: 10, 3: 10}
+    # Raid is reported once
+    assert cache.observe(fingerprint, 4, 10) is None
+    assert cache.stats()['raids'] == 1
+
+    # Verdicts are dropped when allowed domains change
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'whitelist')
+        with open(path, 'w') as out:
+            out.write('github.com\n')
+        cache = FingerprintCache(links_matcher=DomainMatcher([path], check_interval=0))
+        cache.set(fingerprint, settings, frozenset(), verdict)
+        assert cache.get(fingerprint, settings, frozenset()) == verdict
+        with open(path, 'w') as out:
+            out.write('example.org\n')
+        os.utime(path, ns=(0, 0))
+        assert cache.get(fingerprint, settings, frozenset()) is None
+
+
+def make_message_update(update_id, text, chat_id=-1001, user_id=42, entities=None,
+                        chat_type='supergroup'):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'chat': {'id': chat_id, 'type': chat_type},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+        'entities': entities or [],
+    }}
+
+
+@contextmanager
+def running_bot(db):
+    """
+    Bot working with `db` and fake Bot API, yields (bot, api).
+    """
+    api = FakeBotApi()
+    api_url = apihelper.API_URL
+    apihelper.API_URL = api.api_url
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        bot = create_bot('123:abc', db, {
+            'group_config_watch': False,
+            'event_spill_path': os.path.join(tmp_dir, 'spill.jsonl'),
+            'tme_url': 'http://127.0.0.1:9',
+        })
+        try:
+            yield bot, api
+            bot.transport.join()
+        finally:
+            shutdown(bot)
+            apihelper.API_URL = api_url
+            api.stop()
+
+
+def run_bot_updates(db, updates):
+    """
+    Handle updates by the bot, return the stopped FakeBotApi.
+    """
+    with running_bot(db) as (bot, api):
+        bot.process_new_updates([Update.de_json(x) for x in updates])
+    return api
+
+
+def make_chat_member_update(update_id, user, old_status, new_status, chat_id=-1001):
+    def member(status):
+        ret = {'user': user, 'status': status}
+        if status == 'administrator':
+            ret.update((key, False) for key in ADMIN_RIGHTS)
+        return ret
+
+    return {'update_id': update_id, 'chat_member': {
+        'chat': {'id': chat_id, 'type': 'supergroup'},
+        'from': ADMIN_USER, 'date': int(time.time()),
+        'old_chat_member': member(old_status),
+        'new_chat_member': member(new_status),
+    }}
+
+
+def test_admin_cache_refresh():
+    user = {'id': 5, 'is_bot': False, 'first_name': 'User'}
+    other = {'id': 6, 'is_bot': False, 'first_name': 'Other'}
+    spam_bot = {'id': 77, 'is_bot': True, 'first_name': 'Spam', 'username': 'spambot'}
+    join = make_message_update(0, None, user_id=6)
+    join['message']['new_chat_members'] = [spam_bot]
+
+    def process(*updates):
+        bot.process_new_updates([Update.de_json(x) for x in updates])
+
+    with running_bot(FakeDatabase()) as (bot, api):
+        process(make_message_update(1, '/graphene_get kick', user_id=5))
+        assert api.calls['getChatAdministrators'] == 1
+        # Admin promoted since the list was cached is not denied
+        api.admins.append(user)
+        process(make_message_update(2, '/graphene_get kick', user_id=5))
+        assert api.calls['getChatAdministrators'] == 2
+        process(make_message_update(3, '/graphene_get kick', user_id=5))
+        assert api.calls['getChatAdministrators'] == 2
+        assert [x['text'] for x in api.sent] == ['Access denied', 'None', 'None']
+
+        # Joins are checked against the cached list only
+        process(dict(join, update_id=4))
+        assert api.calls['getChatAdministrators'] == 2
+        assert api.calls['banChatMember'] == 1
+        # Changes of admins refresh the list
+        api.admins.append(other)
+        process(make_chat_member_update(5, other, 'member', 'administrator'))
+        assert api.calls['getChatAdministrators'] == 3
+        assert bot.admin_cache.get_admin_ids(-1001) == {1, 5, 6, 1000}
+        process(dict(join, update_id=6))
+        assert api.calls['banChatMember'] == 1
+        api.admins.remove(user)
+        process(make_chat_member_update(7, user, 'administrator', 'member'))
+        assert bot.admin_cache.get_admin_ids(-1001) == {1, 6, 1000}
+        # Other changes of members do not
+        process(make_chat_member_update(8, user, 'member', 'left'))
+        assert api.calls['getChatAdministrators'] == 4
+
+
+def test_spaced_mention_verdicts_are_not_shared():
+    db = FakeDatabase()
+    for username in ('spamchan', 'otherchan'):
+        db.user.insert_one({'username': username, 'type': 'channel', 'added': datetime.utcnow()})
+    api = run_bot_updates(db, [
+        # Two spaces after "@" are not a mention, one space is
+        make_message_update(1, 'join @  spamchan'),
+        make_message_update(2, 'join @ spamchan'),
+        make_message_update(3, 'join @ otherchan'),
+        make_message_update(4, 'join @  otherchan'),
+    ])
+    assert api.calls['deleteMessage'] == 2
+    assert sorted(x['message_id'] for x in db.event.find({'type': 'delete_msg'})) == [2, 3]
+
+
+def make_delete_event(date, chat_id, reason, username=None):
+    return {
+        'type': 'delete_msg', 'date': date, 'reason': reason,
+        'chat': {'id': chat_id, 'username': username},
+    }
+
+
+def test_record_events():
+    db = FakeDatabase()
+    day = datetime(2018, 3, 1)
+    stats.record_events(db, [
+        make_delete_event(day + timedelta(hours=1), -1001, '@-link to group', 'group1'),
+        make_delete_event(day + timedelta(hours=2), -1001, 'link to spam.com', 'group1'),
+        make_delete_event(day + timedelta(days=1), -1001, 'email', 'group1'),
+        make_delete_event(day, -1002, 'email'),
+        {'type': 'join_wave', 'date': day, 'chat': {'id': -1001}},
+    ])
+    # Counters are incremented by next events
+    stats.record_events(db, [make_delete_event(day, -1001, 'email', 'renamed')])
+    counters = dict(
+        ((x['date'], x['chat_id']), x) for x in db.stat_daily.find()
+    )
+    assert len(counters) == 3
+    item = counters[(day, -1001)]
+    assert item['count'] == 3 and item['chat_username'] == 'renamed'
+    assert item['reasons'] == {'@-link to group': 1, 'link to spam_com': 1, 'email': 1}
+    assert counters[(day + timedelta(days=1), -1001)]['count'] == 1
+    assert counters[(day, -1002)]['reasons'] == {'email': 1}
+    stats.record_events(db, [{'type': 'join_wave', 'date': day}])
+    assert db.stat_daily.counters['bulk_write'] == 2
+
+
+def test_backfill():
+    db = FakeDatabase()
+    now = datetime(2018, 3, 3, 12)
+    yesterday = datetime(2018, 3, 2)
+    db.event.insert_many([
+        make_delete_event(yesterday + timedelta(hours=5), -1001, 'email', 'newname'),
+        make_delete_event(yesterday + timedelta(hours=1), -1001, 'email', 'oldname'),
+        # Old events keep chat in separate fields
+        {'type': 'delete_msg', 'date': yesterday, 'reason': 'link to spam.com',
+         'chat_id': -1001, 'chat_username': 'oldname'},
+        {'type': 'delete_msg', 'date': datetime(2018, 3, 1), 'chat_id': -1002},
+        make_delete_event(now, -1001, 'email', 'newname'),
+        {'type': 'join_wave', 'date': yesterday, 'chat': {'id': -1001}},
+    ])
+    # Wrong counter is overwritten, today's one is left to live updates
+    db.stat_daily.insert_many([
+        {'date': yesterday, 'chat_id': -1001, 'count': 10, 'reasons': {'email': 10}},
+        {'date': datetime(2018, 3, 3), 'chat_id': -1001, 'count': 5, 'reasons': {'email': 5}},
+    ])
+    assert stats.backfill(db, now=now) == 2
+    counters = dict(
+        ((x['date'], x['chat_id']), x) for x in db.stat_daily.find()
+    )
+    assert len(counters) == 3
+    item = counters[(yesterday, -1001)]
+    assert item['count'] == 3 and item['chat_username'] == 'newname'
+    assert item['reasons'] == {'email': 2, 'link to spam_com': 1}
+    assert counters[(datetime(2018, 3, 1), -1002)]['reasons'] == {'unknown': 1}
+    assert counters[(datetime(2018, 3, 3), -1001)]['count'] == 5
+    assert stats.backfill(db, since=yesterday, now=now) == 1
+
+
+def test_build_report():
+    db = FakeDatabase()
+    now = datetime(2018, 3, 3, 12)
+    stats.record_events(db, [
+        make_delete_event(now, -1001, 'email', 'group1'),
+        make_delete_event(now, -1002, 'email'),
+        make_delete_event(now, -1002, '@-link to group'),
+        make_delete_event(now - timedelta(days=1), -1001, 'email', 'group1'),
+        make_delete_event(now - timedelta(days=6), -1003, 'email'),
+        # Out of the period
+        make_delete_event(now - timedelta(days=7), -1003, 'email'),
+    ])
+    report = stats.build_report(db, days=7, now=now)
+    lines = report.split('\n')
+    assert lines[0] == 'Recent 7 days: 1 | 0 | 0 | 0 | 0 | 1 | 3'
+    assert lines[2:5] == ['Top today: (2)', '  #-1002 (2)', '  @group1 (1)']
+    assert lines[6:8] == ['Top yesterday: (1)', '  @group1 (1)']
+    assert lines[9:13] == ['Top 10 of 7 days:', '  @group1 (2)', '  #-1002 (2)', '  #-1003 (1)']
+    assert 'Reasons' not in report
+    report = stats.build_report(db, days=2, reasons=True, now=now)
+    assert report.startswith('Recent 2 days: 1 | 3\n')
+    assert report.endswith('Reasons:\n  email (3)\n  @-link to group (1)')
+
+
+def test_stat_command():
+    db = FakeDatabase()
+    stats.record_events(db, [
+        make_delete_event(datetime.utcnow() - timedelta(days=days), -1001, 'email')
+        for days in (0, 10, 40)
+    ])
+    commands = [
+        '/stat', '/stat 30d', '/stat@graphenebot 2d reasons', '/stat reasons',
+        '/stat 1000d', '/stat 0d', '/stat 7', '/stat reasons 2d',
+    ]
+    updates = [
+        make_message_update(idx, text, chat_id=42, chat_type='private')
+        for idx, text in enumerate(commands, 1)
+    ]
+    # Commands in groups are ignored
+    updates.append(make_message_update(100, '/stat', chat_id=-1001))
+    api = run_bot_updates(db, updates)
+    replies = [x['text'] for x in api.sent]
+    assert len(replies) == len(commands)
+    assert replies[0].startswith('Recent 7 days: 0 | 0 | 0 | 0 | 0 | 0 | 1\n')
+    assert replies[1].startswith('Recent 30 days: ') and 'Top 10 of 30 days:\n  #-1001 (2)' in replies[1]
+    assert replies[2].startswith('Recent 2 days: 0 | 1\n') and 'Reasons:\n  email (1)' in replies[2]
+    assert replies[3].startswith('Recent 7 days: ') and 'Reasons:' in replies[3]
+    assert replies[4].startswith('Recent 365 days: ') and '#-1001 (3)' in replies[4]
+    assert replies[5:] == ['Usage: /stat [<days>d] [reasons]'] * 3
+
+
+def test_dump_message():
+    data = json.loads(json.dumps(RECORDED_UPDATE))
+    data['message']['forward_origin'] = {
+        'type': 'channel', 'date': 1514764000, 'message_id': 3,
+        'chat': {'id': -1002, 'type': 'channel', 'title': 'News'},
+    }
+    msg = Update.de_json(data).message
+    assert dump_message(msg) == {
+        'message_id': 7,
+        'date': 1514764800,
+        'content_type': 'text',
+        'chat': {'id': -1001, 'type': 'supergroup', 'username': 'somegroup'},
+        'from_user': {'id': 42, 'is_bot': False, 'first_name': 'Spammer'},
+        'forward_origin': {
+            'type': 'channel', 'date': 1514764000, 'message_id': 3,
+            'chat': {'id': -1002, 'type': 'channel', 'title': 'News'},
+        },
+        'text': 'join @somechannel',
+        'entities': [{'type': 'mention', 'offset': 5, 'length': 12}],
+    }
+    assert dump_message(msg, full=True) == data['message']
+
+
+def test_compact_events():
+    db = FakeDatabase()
+    now = datetime(2018, 3, 1)
+    for days in (45, 31, 29, 1):
+        db.event.insert_one({
+            'type': 'delete_msg', 'date': now - timedelta(days=days), 'reason': 'email',
+            'chat': {'id': -1001}, 'from_user': {'id': 42}, 'message_id': days,
+            'text': 'spam', 'entities': [{'type': 'email', 'offset': 0, 'length': 4}],
+        })
+    assert compact_events(db, full_days=30, now=now) == 2
+    events = sorted(db.event.find(), key=lambda x: x['date'])
+    assert [x.get('compact') for x in events] == [True, True, None, None]
+    assert events[0]['reason'] == 'email' and events[0]['chat'] == {'id': -1001}
+    assert 'text' not in events[0] and 'entities' not in events[0]
+    assert events[2]['text'] == 'spam'
+    # Next run continues from saved position
+    updates = db.event.counters['update_many']
+    assert compact_events(db, full_days=30, now=now + timedelta(days=2)) == 1
+    assert db.event.counters['update_many'] - updates == 2
+
+
+def make_update(update_id, chat_id=-1001):
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'text': 'hello',
+        'chat': {'id': chat_id, 'type': 'supergroup'},
+    }}
+
+
+def test_update_poller():
+    for failures in range(1, 10):
+        delay = get_backoff(failures, 1, 60)
+        assert min(2 ** (failures - 1), 60) / 2 <= delay <= min(2 ** (failures - 1), 60)
+    api = FakeBotApi()
+    api_url = apihelper.API_URL
+    apihelper.API_URL = api.api_url
+    db = FakeDatabase()
+    try:
+        api.add_updates([make_update(x) for x in range(1, 6)])
+        handled = []
+
+        def process_new_updates(updates):
+            handled.extend(x.update_id for x in updates)
+            if updates[0].update_id == 5:
+                poller.stop()
+
+        bot = SimpleNamespace(token='123:abc', process_new_updates=process_new_updates)
+        poller = UpdatePoller(bot, db, timeout=1, backoff=0.01)
+        api.fail(2, retry_after=0)
+        poller.run()
+        assert handled == [1, 2, 3, 4, 5]
+        assert api.calls['getUpdates'] == 3
+        assert db.maintenance.find_one({'_id': 'update_offset:123'})['offset'] == 6
+        # Updates 1-5 were not confirmed to Telegram, they are skipped
+        # after restart by saved offset
+        api.add_updates([make_update(6)])
+        handled = []
+        poller = UpdatePoller(bot, db, timeout=1)
+        thread = Thread(target=poller.run)
+        thread.start()
+        for _ in range(100):
+            if handled:
+                break
+            time.sleep(0.05)
+        poller.stop()
+        thread.join()
+        assert handled == [6]
+        assert poller.stats()['saved_offset'] == 7
+        # Update rejected by full dispatcher is fetched again
+        api.add_updates([make_update(x) for x in range(7, 10)])
+        submitted = []
+
+        def submit_json(data):
+            if data['update_id'] == 8 and 8 not in submitted:
+                submitted.append(8)
+                return False
+            submitted.append(data['update_id'])
+            if data['update_id'] == 9:
+                poller.stop()
+            return True
+
+        bot.dispatcher = SimpleNamespace(submit_json=submit_json, unfinished=lambda: None)
+        poller = UpdatePoller(bot, db, timeout=1, backoff=0.01)
+        poller.run()
+        assert submitted == [7, 8, 8, 9]
+        assert poller.stats()['rejected'] == 1 and poller.stats()['received'] == 3
+        assert poller.stats()['saved_offset'] == 10
+
+        # Other bot does not use the offset
+        other_bot = SimpleNamespace(token='456:def', process_new_updates=process_new_updates)
+        poller = UpdatePoller(other_bot, db)
+        poller.load_offset()
+        assert poller.offset is None
+        # Offset saved before the bot was re-created is dropped
+        db.maintenance.insert_one({'_id': 'update_offset:456', 'offset': 100})
+        handled = []
+        poller = UpdatePoller(other_bot, db)
+        batches = [[make_update(10), make_update(11)]]
+
+        def fetch():
+            if not batches:
+                poller.stop()
+                return []
+            return batches.pop(0)
+
+        poller.fetch = fetch
+        poller.run()
+        assert handled == [10, 11]
+        assert db.maintenance.find_one({'_id': 'update_offset:456'})['offset'] == 12
+    finally:
+        apihelper.API_URL = api_url
+        api.stop()
+
+
+def make_backtest_db():
+    db = FakeDatabase()
+    db.user.insert_one({'username': 'spamgroup', 'type': 'group', 'added': datetime.utcnow()})
+    db.user.insert_one({'username': 'someone', 'type': 'user', 'added': datetime.utcnow()})
+    db.config.insert_one({'group_id': -1002, 'key': 'forwarded', 'value': False})
+    return db
+
+
+def test_backtest():
+    chat = {'id': -1001, 'type': 'supergroup', 'username': 'group1'}
+    other_chat = {'id': -1002, 'type': 'supergroup'}
+    sender = {'id': 42, 'is_bot': False, 'first_name': 'Spammer'}
+    events = [
+        # Compact event, verdict is the same
+        ('@-link to group', {
+            'type': 'delete_msg', 'reason': '@-link to group', 'message_id': 1,
+            'chat': chat, 'from_user': sender, 'text': 'join @spamgroup',
+            'entities': [{'type': 'mention', 'offset': 5, 'length': 10}],
+        }),
+        # Full event, the username turned out to be a user
+        ('@-link to group', {
+            'type': 'delete_msg', 'reason': '@-link to group', 'message_id': 2,
+            'chat': chat, 'from': sender, 'text': 'ask @someone',
+            'entities': [{'type': 'mention', 'offset': 4, 'length': 8}],
+        }),
+        # Forwarding is allowed in the group now
+        ('forwarded', {
+            'type': 'delete_msg', 'reason': 'forwarded', 'message_id': 3,
+            'chat': other_chat, 'from_user': sender, 'text': 'hi',
+            'forward_origin': {'type': 'hidden_user', 'date': 0, 'sender_user_name': 'X'},
+        }),
+        # Events of old versions: all attributes of the message, with or
+        # without the original message in "json"
+        ('forwarded', {
+            'type': 'delete_msg', 'reason': 'forwarded', 'message_id': 5,
+            'chat': chat, 'from_user': sender, 'text': 'news', 'content_type': 'text',
+            'forward_from_chat': {'id': -1005, 'type': 'channel', 'title': 'News'},
+            'forward_from_message_id': 10, 'forward_date': 0,
+        }),
+        ('forwarded', {
+            'type': 'delete_msg', 'reason': 'forwarded', 'message_id': 6,
+            'chat': chat, 'from_user': sender, 'text': 'news',
+            'forward_from': {'id': 7, 'is_bot': False, 'first_name': 'Author'},
+            'json': {
+                'message_id': 6, 'date': 0, 'chat': chat, 'from': sender, 'text': 'news',
+                'forward_from': {'id': 7, 'is_bot': False, 'first_name': 'Author'},
+            },
+        }),
+        # Kept message which is deleted now
+        (None, {'update_id': 1, 'message': {
+            'message_id': 4, 'date': 0, 'chat': chat, 'from': sender,
+            'text': 'mail me a@b.cd',
+            'entities': [{'type': 'email', 'offset': 8, 'length': 6}],
+        }}),
+    ]
+    result = run_backtest(iter(events), make_backtest_db, processes=0, chunk_size=3)
+    assert result.total == 6 and result.changed == 3
+    assert result.transitions == Counter({
+        ('@-link to group', '@-link to group'): 1,
+        ('forwarded', 'forwarded'): 2,
+        ('@-link to group', 'keep'): 1,
+        ('forwarded', 'keep'): 1,
+        ('keep', 'email'): 1,
+    })
+    assert result.chat_changes == Counter({-1001: 2, -1002: 1})
+    report = format_report(result)
+    assert '  @group1                             2 of 5' in report
+    # The same in worker processes
+    pooled = run_backtest(iter(events * 50), make_backtest_db, processes=2, chunk_size=7)
+    assert pooled.total == 300 and pooled.changed == 150
+    assert pooled.transitions[('keep', 'email')] == 50
+
+
+class RateLimitedError(Exception):
+    result_json = {'error_code': 429, 'parameters': {'retry_after': 0.1}}
+
+
+def test_join_wave_guard():
+    calls = []
+
+    def kick_chat_member(chat_id, user_id):
+        if not calls:
+            calls.append(('limited', user_id))
+            raise RateLimitedError()
+        calls.append(('kick', user_id))
+
+    bot = SimpleNamespace(
+        kick_chat_member=kick_chat_member,
+        delete_messages=lambda chat_id, ids: calls.append(('delete', list(ids))),
+    )
+    journal = SimpleNamespace(events=[])
+    journal.add = journal.events.append
+    guard = JoinWaveGuard(
+        bot, journal, threshold=5, window=0.5, exit_threshold=2,
+        action_rate=(1000, 1), check_interval=0.05,
+    )
+    chat = SimpleNamespace(id=-1001, type='supergroup', title='Group', username=None)
+    try:
+        waves = [guard.observe(chat, idx, 1, [idx] if idx % 2 else []) for idx in range(10)]
+        assert waves == [False] * 4 + [True] * 6
+        # Other chats are not affected
+        assert not guard.observe(SimpleNamespace(id=-1002), 1, 1, [])
+        for _ in range(100):
+            if journal.events:
+                break
+            time.sleep(0.05)
+        event = journal.events[0]
+        assert event['type'] == 'join_wave' and event['chat']['id'] == -1001
+        assert event['joins'] == 6 and event['kicked'] == 3 and event['deleted'] == 6
+        assert calls[0] == ('limited', 5)
+        assert [x for x in calls if x[0] == 'kick'] == [('kick', 5), ('kick', 7), ('kick', 9)]
+        deletes = [x[1] for x in calls if x[0] == 'delete']
+        assert sum(deletes, []) == [4, 5, 6, 7, 8, 9] and len(deletes) < 6
+        assert guard.stats()['retried'] == 1 and guard.stats()['active'] == 0
+    finally:
+        guard.close()
+
+
+def test_join_wave_guard_limits():
+    kicks = []
+
+    def kick_chat_member(chat_id, user_id):
+        kicks.append(user_id)
+        if user_id < 10:
+            raise RateLimitedError()
+
+    bot = SimpleNamespace(kick_chat_member=kick_chat_member, delete_messages=None)
+    journal = SimpleNamespace(events=[])
+    journal.add = journal.events.append
+    chat = SimpleNamespace(id=-1001, type='supergroup', title='Group', username=None)
+    # Rate limited kicks are given up after max_attempts
+    guard = JoinWaveGuard(
+        bot, journal, threshold=2, window=60, action_rate=(1000, 1),
+        delete_joins=False, max_attempts=3,
+    )
+    guard.observe(chat, 1, 1, [])
+    assert guard.observe(chat, 2, 2, [1, 2])
+    guard.close()
+    assert kicks == [1, 1, 1, 2, 2, 2]
+    assert journal.events[0]['failed'] == 2 and journal.events[0]['kicked'] == 0
+    assert guard.stats()['retried'] == 4
+
+    # Actions left on close are dropped after timeout
+    kicks = []
+    guard = JoinWaveGuard(
+        bot, journal, threshold=2, window=60, action_rate=(5, 1), delete_joins=False,
+    )
+    guard.observe(chat, 1, 1, [])
+    guard.observe(chat, 2, 100, list(range(10, 110)))
+    started = time.monotonic()
+    guard.close(timeout=0.5)
+    assert time.monotonic() - started < 2
+    stats = guard.stats()
+    assert stats['kicked'] == len(kicks) and stats['dropped'] == 100 - len(kicks)
+    assert stats['queue_depth'] == 0 and stats['active'] == 0
+
+
+def test_api_transport():
+    api = FakeBotApi(latency=0.05)
+    api_url = apihelper.API_URL
+    apihelper.API_URL = api.api_url
+    transport = ApiTransport(pool_size=10, workers=10, max_inflight=20)
+    transport.install()
+    try:
+        bot = telebot.TeleBot('123:abc', threaded=False)
+        assert bot.get_me().id == 1000
+        api.fail(1, retry_after=0.1)
+        started = time.monotonic()
+        futures = [
+            transport.submit('delete_message', -1001, bot.delete_message, -1001, idx)
+            for idx in range(50)
+        ]
+        transport.join()
+        elapsed = time.monotonic() - started
+        assert all(x.result() is True for x in futures)
+        # 51 serial requests would take 2.5s
+        assert elapsed < 1.5
+        assert api.calls['deleteMessage'] == 51
+        stats = transport.stats()
+        assert stats['done'] == 50 and stats['retried'] == 1 and stats['inflight'] == 0
+        assert 1 < stats['max_inflight'] <= 20
+    finally:
+        transport.close()
+        apihelper.API_URL = api_url
+        api.stop()
+    assert apihelper.CUSTOM_REQUEST_SENDER is None
+
+
+def test_cache_snapshot():
+    resolver = UserTypeResolver(FakeDatabase(), fetch=None)
+    resolver.cache.set('somegroup', 'group')
+    resolver.cache.set('nobody', None, ttl=600)
+    resolver.cache.set('expired', 'user', ttl=-1)
+    admin_cache = AdminCache(None)
+    admin_cache.cache.set(-1001, frozenset([1, 2]))
+    timer = StartupTimer()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'run', 'snapshot.json')
+        save_snapshot(path, {'resolver': resolver, 'admin_cache': admin_cache})
+        resolver = UserTypeResolver(FakeDatabase(), fetch=None, ttl=100)
+        admin_cache = AdminCache(None)
+        with timer.phase('load_caches'):
+            count = load_snapshot(path, {'resolver': resolver, 'admin_cache': admin_cache})
+        assert count == 3
+        assert not os.path.exists(path)
+        assert load_snapshot(path, {'resolver': resolver}) == 0
+    assert resolver.get_types(['SomeGroup', 'nobody']) == {'somegroup': 'group', 'nobody': None}
+    assert resolver.counters['memory_hit'] == 1 and resolver.counters['memory_negative_hit'] == 1
+    assert resolver.cache.snapshot()[0][2] <= time.time() + 100
+    assert admin_cache.is_admin(-1001, 2)
+    timer.mark_ready()
+    assert set(timer.stats()) == {'load_caches', 'ready'}
+
+
+@contextmanager
+def restored_logging():
+    handlers, level = logging.root.handlers[:], logging.root.level
+    try:
+        yield
+    finally:
+        logging.root.handlers[:] = handlers
+        logging.root.setLevel(level)
+
+
+def test_setup_logging():
+    with restored_logging():
+        # Importing graphenebot has already logged something
+        logging.warning('Root logger is configured')
+        setup_logging({'log_level': 'INFO'})
+        assert logging.root.level == logging.INFO
+        setup_logging({'log_level': 'debug'})
+        assert logging.root.level == logging.DEBUG
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_startup_timings_logged():
+    handler = ListHandler()
+    with restored_logging():
+        # Logging before setup, e.g. on import, must not hide INFO messages
+        logging.debug('Logged before setup_logging')
+        setup_logging({'log_level': 'INFO'})
+        logging.root.addHandler(handler)
+        timer = StartupTimer()
+        with timer.phase('config'):
+            pass
+        start_index_build(FakeDatabase(), {}, timer)
+        for _ in range(100):
+            if any(x.startswith('Indexes are ready') for x in handler.messages):
+                break
+            time.sleep(0.01)
+        timer.mark_ready(5)
+    assert any(x.startswith('Indexes are ready in ') for x in handler.messages)
+    assert any(x.startswith('Started in ') and 'config ' in x for x in handler.messages)
+
+
 def main():
     test_link_finders()
+    test_ttl_cache()
+    test_dispatcher_keeps_chat_order()
+    test_user_type_resolver()
+    test_tme_client()
+    test_resolver_parallel_fetch()
+    test_domain_matcher()
+    test_event_journal_spill_and_replay()
+    test_log_delivery_digest()
+    test_log_delivery_failures()
+    test_webhook_server()
+    test_webhook_secret_required()
+    test_classifier()
+    test_metrics_registry()
+    test_group_config_store()
+    test_shard_coordinator()
+    test_expiring_set()
+    test_notify_throttle()
+    test_ensure_indexes_options_changed()
+    test_fingerprint_cache()
+    test_admin_cache_refresh()
+    test_spaced_mention_verdicts_are_not_shared()
+    test_record_events()
+    test_backfill()
+    test_build_report()
+    test_stat_command()
+    test_dump_message()
+    test_compact_events()
+    test_update_poller()
+    test_backtest()
+    test_join_wave_guard()
+    test_join_wave_guard_limits()
+    test_api_transport()
+    test_cache_snapshot()
+    test_setup_logging()
+    test_startup_timings_logged()
     test_fetch_user_type()
 
 
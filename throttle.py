@@ -0,0 +1,126 @@
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+
+from pymongo.errors import PyMongoError, DuplicateKeyError, OperationFailure
+
+from metrics import timed
+from retention import INDEX_OPTIONS_CONFLICT
+
+
+class ExpiringSet(object):
+    """
+    Set of keys remembered for at least `window` seconds.
+
+    Keys are collected in a ring of sets, each covering `window / buckets`
+    seconds, and the oldest set is dropped as a whole, so checks and
+    inserts take constant time and memory is bounded by keys added during
+    the last window (plus one bucket).
+    """
+
+    def __init__(self, window, buckets=6, clock=time.time):
+        self.span = window / buckets
+        self.clock = clock
+        self.ring = [set() for _ in range(buckets + 1)]
+        # Bucket number (time // span) stored in every slot of the ring
+        self.numbers = [None] * len(self.ring)
+        self._lock = Lock()
+
+    def _oldest(self, now):
+        return int(now // self.span) - len(self.ring) + 1
+
+    def add(self, key, date=None):
+        """
+        Add `key` seen at `date` (timestamp, now by default).
+        """
+        now = self.clock()
+        num = int((now if date is None else date) // self.span)
+        oldest = self._oldest(now)
+        if num < oldest:
+            return
+        slot = num % len(self.ring)
+        with self._lock:
+            if self.numbers[slot] != num:
+                for idx, slot_num in enumerate(self.numbers):
+                    if slot_num is not None and slot_num < oldest:
+                        self.ring[idx] = set()
+                        self.numbers[idx] = None
+                self.ring[slot] = set()
+                self.numbers[slot] = num
+            self.ring[slot].add(key)
+
+    def __contains__(self, key):
+        oldest = self._oldest(self.clock())
+        with self._lock:
+            return any(
+                num is not None and num >= oldest and key in bucket
+                for num, bucket in zip(self.numbers, self.ring)
+            )
+
+    def __len__(self):
+        return sum(len(x) for x in self.ring)
+
+
+class NotifyThrottle(object):
+    """
+    Allows one notification per (chat, user) in `window` seconds.
+
+    Recent notifications are remembered in memory and in
+    `notify_throttle` collection (expired by TTL index, see
+    `ensure_indexes`), so the rule holds across restarts and instances.
+    Other instance's notification is detected by upsert conditioned on
+    the old date failing with duplicate key error.
+    """
+
+    def __init__(self, db, window=3600, buckets=6):
+        self.db = db
+        self.window = window
+        self.recent = ExpiringSet(window, buckets)
+        self.allowed = 0
+        self.throttled = 0
+
+    def allow(self, chat_id, user_id):
+        key = '%d:%d' % (chat_id, user_id)
+        if key in self.recent:
+            self.throttled += 1
+            return False
+        now = datetime.utcnow()
+        try:
+            with timed('mongo_write'):
+                self.db.notify_throttle.update_one(
+                    {'_id': key, 'date': {'$lt': now - timedelta(seconds=self.window)}},
+                    {'$set': {'date': now}},
+                    upsert=True,
+                )
+        except DuplicateKeyError:
+            with timed('mongo_read'):
+                doc = self.db.notify_throttle.find_one({'_id': key})
+            date = doc['date'] if doc else now
+            self.recent.add(key, date.replace(tzinfo=timezone.utc).timestamp())
+            self.throttled += 1
+            return False
+        except PyMongoError:
+            logging.exception('Failed to save notification date')
+        self.recent.add(key)
+        self.allowed += 1
+        return True
+
+    def stats(self):
+        return {
+            'size': len(self.recent),
+            'allowed': self.allowed,
+            'throttled': self.throttled,
+        }
+
+
+def ensure_indexes(db, window=3600):
+    try:
+        db.notify_throttle.create_index('date', expireAfterSeconds=window)
+    except OperationFailure as ex:
+        if ex.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        # Window changed since the index was created
+        db.command('collMod', 'notify_throttle', index={
+            'keyPattern': {'date': 1}, 'expireAfterSeconds': window,
+        })
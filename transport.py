@@ -0,0 +1,135 @@
+import logging
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Condition
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+
+from metrics import timed
+from util import get_retry_after
+
+
+class ApiTransport(object):
+    """
+    Bot API requests over one pool of up to `pool_size` keep-alive
+    connections shared by all threads (telebot keeps a session per thread
+    and drops it every 10 minutes), and background sending of calls whose
+    result is not needed, e.g. deletions.
+
+    Background calls run in `workers` threads. `submit` blocks while
+    `max_inflight` calls are not finished. After 429 answer calls with the
+    same key (chat id) wait for `retry_after` seconds and the call is
+    repeated, up to `max_attempts` times.
+    """
+
+    def __init__(self, pool_size=20, workers=8, max_inflight=1000, max_attempts=3):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.max_attempts = max_attempts
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='botapi')
+        self.inflight = 0
+        self.max_seen_inflight = 0
+        self.counters = Counter()
+        # Key -> monotonic time until which its calls are paused
+        self.paused = {}
+        self._slots = BoundedSemaphore(max_inflight)
+        self._cond = Condition()
+
+    def install(self):
+        """
+        Send all requests of telebot through the pool.
+        """
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+
+    def request(self, method, url, params=None, files=None, timeout=None, proxies=None):
+        return self.session.request(
+            method, url, params=params, files=files, timeout=timeout, proxies=proxies,
+        )
+
+    def submit(self, stage, key, func, *args, **kwargs):
+        """
+        Call `func(*args, **kwargs)` in background, return Future of its
+        result (None if the call failed).
+        """
+        self._slots.acquire()
+        with self._cond:
+            self.inflight += 1
+            self.max_seen_inflight = max(self.max_seen_inflight, self.inflight)
+            self.counters['submitted'] += 1
+        try:
+            return self.executor.submit(self._call, stage, key, func, args, kwargs)
+        except RuntimeError:
+            self._done()
+            raise
+
+    def _wait(self, key):
+        with self._cond:
+            until = self.paused.get(key)
+        if until is not None:
+            delay = until - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def _call(self, stage, key, func, args, kwargs):
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                self._wait(key)
+                try:
+                    with timed(stage):
+                        ret = func(*args, **kwargs)
+                except Exception as ex:
+                    retry_after = get_retry_after(ex)
+                    if retry_after and attempt < self.max_attempts:
+                        with self._cond:
+                            self.paused[key] = max(
+                                self.paused.get(key, 0), time.monotonic() + retry_after,
+                            )
+                            self.counters['retried'] += 1
+                        continue
+                    logging.error('Failed to %s (%s): %s' % (stage, key, ex))
+                    self._count('failed')
+                    return None
+                self._count('done')
+                return ret
+        finally:
+            self._done()
+
+    def _count(self, key):
+        with self._cond:
+            self.counters[key] += 1
+
+    def _done(self):
+        with self._cond:
+            self.inflight -= 1
+            if not self.inflight:
+                now = time.monotonic()
+                self.paused = dict(
+                    (key, until) for key, until in self.paused.items() if until > now
+                )
+                self._cond.notify_all()
+        self._slots.release()
+
+    def join(self):
+        """
+        Wait until all submitted calls are finished.
+        """
+        with self._cond:
+            while self.inflight:
+                self._cond.wait()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if apihelper.CUSTOM_REQUEST_SENDER == self.request:
+            apihelper.CUSTOM_REQUEST_SENDER = None
+        self.session.close()
+
+    def stats(self):
+        ret = dict(self.counters)
+        ret['inflight'] = self.inflight
+        ret['max_inflight'] = self.max_seen_inflight
+        return ret
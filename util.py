@@ -1,6 +1,13 @@
-from urllib.request import urlopen
 from urllib.parse import quote
+import logging
 import re
+import time
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import timed
 
 RE_USERNAME = re.compile(r'@[a-z][_a-z0-9]{4,30}', re.I)
 RE_SIMPLE_LINK = re.compile(
@@ -9,6 +16,13 @@ RE_SIMPLE_LINK = re.compile(
     r'(?:[^ ]+)?',
     re.X | re.I | re.U
 )
+# Markers of t.me page and corresponding user types
+USER_TYPE_MARKERS = (
+    (b'>View Group<', 'group'),
+    (b'>Send Message<', 'user'),
+    (b'>View Channel<', 'channel'),
+)
+MARKER_MAX_LENGTH = max(len(x[0]) for x in USER_TYPE_MARKERS)
 
 
 def find_username_links(text):
@@ -19,19 +33,133 @@ def find_external_links(text):
     return RE_SIMPLE_LINK.findall(text)
 
 
+def detect_user_type(data):
+    for marker, user_type in USER_TYPE_MARKERS:
+        if marker in data:
+            return user_type
+    return None
+
+
+class TmeClient(object):
+    """
+    Fetches t.me pages over a pool of keep-alive connections.
+
+    The page is scanned only up to the first marker of user type. The rest
+    of the body is drained without scanning when it is shorter than
+    `drain_limit`, so the connection goes back to the pool, otherwise the
+    connection is dropped.
+    """
+
+    def __init__(self, base_url='https://t.me', timeout=2, pool_size=10,
+                 chunk_size=4096, drain_limit=16384):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.drain_limit = drain_limit
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch_user_type(self, username):
+        url = '%s/%s' % (self.base_url, quote(username))
+        with timed('tme_fetch'):
+            return self._fetch(url)
+
+    def _fetch(self, url):
+        try:
+            with self.session.get(url, timeout=self.timeout, stream=True) as res:
+                tail = b''
+                chunks = res.iter_content(self.chunk_size)
+                for chunk in chunks:
+                    # Keep the end of previous chunk to find markers
+                    # split between chunks
+                    data = tail + chunk
+                    user_type = detect_user_type(data)
+                    if user_type:
+                        self._drain(chunks)
+                        return user_type
+                    tail = data[-MARKER_MAX_LENGTH:]
+        except requests.RequestException:
+            logging.exception('Failed to fetch URL: %s' % url)
+            return None
+        logging.error('Could not detect user type: %s' % url)
+        return None
+
+    def _drain(self, chunks):
+        drained = 0
+        for chunk in chunks:
+            drained += len(chunk)
+            if drained > self.drain_limit:
+                break
+
+
+_default_client = None
+
+
 def fetch_user_type(username):
-    url = 'https://t.me/%s' % quote(username)
-    try:
-        data = urlopen(url, timeout=2).read().decode('utf-8')
-    except OSError:
-        logging.exception('Failed to fetch URL: %s' % url)
+    global _default_client
+    if _default_client is None:
+        _default_client = TmeClient()
+    return _default_client.fetch_user_type(username)
+
+
+def get_retry_after(ex):
+    """
+    Return `retry_after` value of Bot API error response (HTTP 429), None
+    for other errors.
+    """
+    result_json = getattr(ex, 'result_json', None) or {}
+    if result_json.get('error_code') != 429:
         return None
-    else:
-        if '>View Group<' in data:
-            return 'group'
-        elif '>Send Message<' in data:
-            return 'user'
-        elif '>View Channel<' in data:
-            return 'channel'
-        else:
-            logging.error('Could not detect user type: %s' % url)
+    return (result_json.get('parameters') or {}).get('retry_after', 1)
+
+
+class RateLimiter(object):
+    """
+    Token bucket allowing `rate` actions per `period` seconds.
+    """
+
+    def __init__(self, rate, period=1.0):
+        self.rate = rate
+        self.period = period
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(
+            self.rate,
+            self.tokens + (now - self.updated) * self.rate / self.period,
+        )
+        self.updated = now
+
+    def delay(self, tokens=1):
+        """
+        Return number of seconds to wait until `tokens` are available.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._refill(now)
+            wait = max(0, self.paused_until - now)
+            if self.tokens < tokens:
+                wait = max(wait, (tokens - self.tokens) * self.period / self.rate)
+            return wait
+
+    def try_acquire(self, tokens=1):
+        now = time.monotonic()
+        with self._lock:
+            self._refill(now)
+            if now < self.paused_until or self.tokens < tokens:
+                return False
+            self.tokens -= tokens
+            return True
+
+    def acquire(self, tokens=1):
+        while not self.try_acquire(tokens):
+            time.sleep(self.delay(tokens))
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
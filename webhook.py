@@ -0,0 +1,121 @@
+import hmac
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import metrics
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, self.server.webhook.health())
+        elif self.path == '/metrics':
+            body = metrics.REGISTRY.expose().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', metrics.CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            self.send_json(404, {'error': 'not found'})
+            return
+        secret = self.headers.get(SECRET_HEADER, '')
+        if not hmac.compare_digest(secret, webhook.secret):
+            webhook.counters['denied'] += 1
+            self.send_json(403, {'error': 'invalid secret token'})
+            return
+        length = int(self.headers.get('Content-Length') or 0)
+        if not 0 < length <= MAX_BODY_SIZE:
+            self.send_json(400, {'error': 'invalid body size'})
+            return
+        try:
+            data = json.loads(self.rfile.read(length).decode('utf-8'))
+            accepted = webhook.dispatcher.submit_json(data)
+        except (ValueError, KeyError, TypeError):
+            webhook.counters['invalid'] += 1
+            self.send_json(400, {'error': 'invalid update'})
+            return
+        if accepted:
+            webhook.counters['accepted'] += 1
+            self.send_json(200, {'ok': True})
+        else:
+            # Telegram delivers the update again later
+            webhook.counters['rejected'] += 1
+            self.send_json(503, {'error': 'queue is full'})
+
+    def log_message(self, fmt, *args):
+        logging.debug('Webhook: ' + fmt % args)
+
+
+class WebhookServer(object):
+    """
+    HTTP server receiving Bot API updates posted to `path` with `secret`
+    token, requests without it are denied.
+
+    Updates are passed to `bot.dispatcher` and the request is answered
+    right away. `GET /health` reports queue depth of the bot pipeline.
+    """
+
+    def __init__(self, bot, host='127.0.0.1', port=8443, path='/webhook',
+                 secret=None):
+        if not secret:
+            raise ValueError('Webhook secret token is required')
+        self.bot = bot
+        self.dispatcher = bot.dispatcher
+        self.path = path
+        self.secret = secret
+        self.counters = {'accepted': 0, 'rejected': 0, 'denied': 0, 'invalid': 0}
+        self.server = ThreadingHTTPServer((host, port), WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.webhook = self
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_port
+
+    def health(self):
+        ret = {
+            'status': 'ok',
+            'requests': dict(self.counters),
+            'dispatcher': self.dispatcher.stats(),
+        }
+        for name in ('journal', 'log_delivery'):
+            component = getattr(self.bot, name, None)
+            if component is not None:
+                ret[name] = component.stats()
+        ret['queue_depth'] = sum(ret['dispatcher']['queue_depth'])
+        return ret
+
+    def start(self):
+        self.thread = Thread(
+            target=self.server.serve_forever, name='webhook', daemon=True,
+        )
+        self.thread.start()
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()